@@ -2,7 +2,8 @@ import sys
 import os
 from typing import List, Optional
 
-from fastapi import FastAPI, HTTPException, Query, Depends
+from fastapi import FastAPI, HTTPException, Query, Depends, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker, Session
@@ -10,6 +11,7 @@ from pydantic import BaseModel
 
 # Importação dos Serviços e Schemas
 from api.services.ai_analyst import process_user_query 
+from api.services.response_cache import DataVersion, ResponseCache
 from api.schemas import (
     OperadoraSimples, 
     PaginatedOperadoras, 
@@ -21,7 +23,9 @@ from api.schemas import (
 # Adiciona a raiz do projeto ao Python Path para importar o config.py corretamente
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from config import DATABASE_URL_READER
+from config import (
+    DATABASE_URL_READER, API_CACHE_MAX_ENTRIES, API_CACHE_TTL, API_VERSION_CHECK_INTERVAL
+)
 
 # --- Configuração do Banco de Dados ---
 try:
@@ -51,6 +55,48 @@ app = FastAPI(
     version="1.0.0"
 )
 
+# --- Cache de Respostas (GET) ---
+# Os dados só mudam a cada carga do ETL: as respostas ficam em memória até a próxima
+# versão (etl_versao) e levam um ETag. Cliente com o ETag atual recebe 304 sem consulta
+# ao banco (a versão em si é relida no máximo a cada API_VERSION_CHECK_INTERVAL segundos).
+response_cache = ResponseCache(API_CACHE_MAX_ENTRIES, API_CACHE_TTL)
+data_version = DataVersion(engine, API_VERSION_CHECK_INTERVAL)
+
+@app.middleware("http")
+async def cache_respostas(request: Request, call_next):
+    """
+    Serve as rotas GET de /api do cache (ou 304 Not Modified) enquanto a versão dos dados
+    não muda. Registrado antes do CORS para que este continue envolvendo as respostas.
+    """
+    if request.method != "GET" or not request.url.path.startswith("/api/"):
+        return await call_next(request)
+    version = await run_in_threadpool(data_version.current)
+    if version is None:
+        return await call_next(request)
+
+    key = ResponseCache.key(request.url.path, request.query_params)
+    etag = ResponseCache.etag(version, key)
+    validators = {"ETag": etag, "Cache-Control": "no-cache"}
+    if ResponseCache.matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=validators)
+
+    cached = response_cache.get(version, key)
+    if cached is not None:
+        body, headers = cached
+        return Response(content=body, status_code=200, headers={**headers, **validators})
+
+    response = await call_next(request)
+    if response.status_code != 200:
+        return response
+    body = b"".join([chunk async for chunk in response.body_iterator])
+    # content-length é recalculado pelo Response; ETag/Cache-Control vêm da versão
+    headers = {
+        k: v for k, v in response.headers.items()
+        if k.lower() not in ("content-length", "etag", "cache-control")
+    }
+    response_cache.set(version, key, body, headers)
+    return Response(content=body, status_code=200, headers={**headers, **validators})
+
 # Configuração de CORS (Permite acesso do Frontend Vue.js)
 app.add_middleware(
     CORSMiddleware,
@@ -204,10 +250,12 @@ def get_estatisticas(db: Session = Depends(get_db)):
     - Total de Despesas
     - Média por Operadora
     - Top 5 Operadoras (Maiores Despesas Totais)
+
+    Lê o cubo analítico (despesas_cubo), montado pelo ETL, em vez do fato bruto.
     """
     
     # 1. Totais e Média
-    kpi_query = text("SELECT SUM(valor) as total, COUNT(DISTINCT registro_ans) as qtd FROM despesas_eventos")
+    kpi_query = text("SELECT SUM(valor) as total, COUNT(DISTINCT registro_ans) as qtd FROM despesas_cubo")
     row = db.execute(kpi_query).fetchone()
     
     total = row.total or 0.0
@@ -216,9 +264,14 @@ def get_estatisticas(db: Session = Depends(get_db)):
     
     # 2. Top 5 Operadoras (Por Volume Total)
     top_query = text("""
-        SELECT o.razao_social, SUM(d.valor) as total
-        FROM despesas_eventos d
-        JOIN operadoras o ON d.registro_ans = o.registro_ans
+        WITH por_operadora AS (
+            SELECT registro_ans, SUM(valor) as total
+            FROM despesas_cubo
+            GROUP BY registro_ans
+        )
+        SELECT o.razao_social, SUM(c.total) as total
+        FROM por_operadora c
+        JOIN operadoras o ON c.registro_ans = o.registro_ans
         GROUP BY o.razao_social
         ORDER BY total DESC
         LIMIT 5
@@ -228,11 +281,10 @@ def get_estatisticas(db: Session = Depends(get_db)):
 
     # 3. Distribuição UF (Extra para preencher o schema)
     uf_query = text("""
-        SELECT o.uf, SUM(d.valor) as total
-        FROM despesas_eventos d
-        JOIN operadoras o ON d.registro_ans = o.registro_ans
-        WHERE o.uf IS NOT NULL
-        GROUP BY o.uf
+        SELECT uf, SUM(valor) as total
+        FROM despesas_cubo
+        WHERE uf IS NOT NULL
+        GROUP BY uf
         ORDER BY total DESC
     """)
     uf_rows = db.execute(uf_query).fetchall()
@@ -259,26 +311,16 @@ def get_storytelling(db: Session = Depends(get_db)):
         3. Geo Eficiência (Desempenho por Estado).
         4. Consistência (Operadoras recorrentemente acima da média).
 
+    Cada seção lê a sua visão materializada (mv_story_*, ver schema.sql), calculada
+    sobre o cubo analítico e atualizada pelo ETL ao fim de cada carga: a rota faz só
+    leituras por índice, sem agregar o fato a cada requisição.
+
     Retorna:
         DashboardStorytelling: Objeto com todas as métricas calculadas.
     """
     
     # 1. KPIs MACRO (Tendência e Atividade)
-    kpi_query = text("""
-        WITH limites AS (
-            SELECT MIN(ano*10+trimestre) as min_p, MAX(ano*10+trimestre) as max_p 
-            FROM despesas_eventos
-        ),
-        valores AS (
-            SELECT 
-                SUM(d.valor) as total_geral,
-                COUNT(DISTINCT d.registro_ans) as ativas,
-                SUM(CASE WHEN (d.ano*10+d.trimestre) = l.min_p THEN d.valor ELSE 0 END) as valor_inicio,
-                SUM(CASE WHEN (d.ano*10+d.trimestre) = l.max_p THEN d.valor ELSE 0 END) as valor_fim
-            FROM despesas_eventos d, limites l
-        )
-        SELECT total_geral, ativas, valor_inicio, valor_fim FROM valores
-    """)
+    kpi_query = text("SELECT total_geral, ativas, valor_inicio, valor_fim FROM mv_story_macro")
     kpi_row = db.execute(kpi_query).fetchone()
     
     # Tratamento de Nulos para evitar erros matemáticos
@@ -298,46 +340,17 @@ def get_storytelling(db: Session = Depends(get_db)):
     # 2. TOP MOVERS (Crescimento)
     # Identifica operadoras com maior crescimento percentual no período
     movers_query = text("""
-        WITH limites AS (
-            SELECT MIN(ano*10+trimestre) as min_p, MAX(ano*10+trimestre) as max_p 
-            FROM despesas_eventos
-        ),
-        inicio AS (
-            SELECT d.registro_ans, SUM(d.valor) as v_ini 
-            FROM despesas_eventos d, limites l 
-            WHERE (d.ano*10+d.trimestre)=l.min_p 
-            GROUP BY d.registro_ans
-        ),
-        fim AS (
-            SELECT d.registro_ans, SUM(d.valor) as v_fim 
-            FROM despesas_eventos d, limites l 
-            WHERE (d.ano*10+d.trimestre)=l.max_p 
-            GROUP BY d.registro_ans
-        )
-        SELECT 
-            o.razao_social, 
-            f.v_fim, 
-            ROUND(((f.v_fim - i.v_ini)/i.v_ini)*100, 2) as cresc
-        FROM operadoras o 
-        JOIN inicio i ON o.registro_ans = i.registro_ans 
-        JOIN fim f ON o.registro_ans = f.registro_ans
-        WHERE i.v_ini > 0 
-        ORDER BY 3 DESC 
+        SELECT razao_social, v_fim, cresc
+        FROM mv_story_movers
+        ORDER BY cresc DESC 
         LIMIT 5
     """)
     movers = db.execute(movers_query).fetchall()
 
     # 3. GEO EFICIÊNCIA (Ranking por UF)
     geo_query = text("""
-        SELECT 
-            o.uf, 
-            SUM(d.valor) as total, 
-            COUNT(DISTINCT o.registro_ans) as qtd, 
-            SUM(d.valor)/COUNT(DISTINCT o.registro_ans) as media
-        FROM despesas_eventos d 
-        JOIN operadoras o ON d.registro_ans = o.registro_ans
-        WHERE o.uf IS NOT NULL 
-        GROUP BY o.uf 
+        SELECT uf, total, qtd, media
+        FROM mv_story_geo 
         ORDER BY total DESC 
         LIMIT 10
     """)
@@ -345,29 +358,8 @@ def get_storytelling(db: Session = Depends(get_db)):
 
     # 4. CONSISTÊNCIA (Operadoras consistentemente acima da média)
     consistency_query = text("""
-        WITH metricas AS (
-            SELECT ano, trimestre, registro_ans, SUM(valor) as total 
-            FROM despesas_eventos 
-            GROUP BY ano, trimestre, registro_ans
-        ),
-        medias AS (
-            SELECT ano, trimestre, AVG(total) as m_geral 
-            FROM metricas 
-            GROUP BY ano, trimestre
-        ),
-        perf AS (
-            SELECT mt.registro_ans, 
-            CASE WHEN mt.total > mm.m_geral THEN 1 ELSE 0 END as win 
-            FROM metricas mt 
-            JOIN medias mm ON mt.ano=mm.ano AND mt.trimestre=mm.trimestre
-        )
-        SELECT o.razao_social, o.uf, SUM(p.win) as qtd 
-        FROM perf p 
-        JOIN operadoras o ON p.registro_ans = o.registro_ans
-        WHERE o.razao_social NOT ILIKE '%INATIVA%' 
-          AND o.razao_social NOT ILIKE '%DESCONHECIDA%'
-        GROUP BY o.razao_social, o.uf
-        HAVING SUM(p.win) >= 2 
+        SELECT razao_social, uf, qtd 
+        FROM mv_story_consistencia 
         ORDER BY 3 DESC, 1 
         LIMIT 50
     """)
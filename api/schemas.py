@@ -1,4 +1,4 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, field_validator
 from typing import List, Optional
 from datetime import datetime
 
@@ -14,6 +14,12 @@ class OperadoraSimples(BaseModel):
     modalidade: Optional[str]
     uf: Optional[str]
 
+    @field_validator('registro_ans', mode='before')
+    @classmethod
+    def formatar_registro(cls, value):
+        """A chave é inteira no banco; a exibição segue o formato da ANS (6 dígitos)."""
+        return f"{value:06d}" if isinstance(value, int) else value
+
     class Config:
         from_attributes = True # Permite ler direto do SQLAlchemy
 
@@ -36,7 +36,7 @@ ESQUEMA DO BANCO DE DADOS (IMUTÁVEL)
 DIMENSÃO: operadoras
 Representa os dados cadastrais das operadoras.
 <operadoras>
-- registro_ans (PK, varchar): Identificador único da operadora
+- registro_ans (PK, int): Número do registro na ANS, identificador único da operadora
 - cnpj (varchar)
 - razao_social (varchar): Nome da operadora
 - nome_fantasia (varchar)
@@ -60,10 +60,10 @@ Representa os dados cadastrais das operadoras.
 </operadoras>
 
 FATO TRANSACIONAL: despesas_eventos
-Guarda lançamentos contábeis detalhados.
+Guarda lançamentos contábeis detalhados, particionada por (ano, trimestre).
 <despesas_eventos>
-id (PK)
-registro_ans (FK → operadoras.registro_ans)
+id (PK junto com ano, trimestre)
+registro_ans (int, FK → operadoras.registro_ans)
 ano (int)
 trimestre (int)
 conta_contabil (varchar)
@@ -75,7 +75,7 @@ FATO ANALÍTICO: despesas_agregadas
 Guarda KPIs já calculados.
 <despesas_agregadas>
 id (PK)
-registro_ans (FK → operadoras.registro_ans)
+registro_ans (int, FK → operadoras.registro_ans)
 total_despesas (numeric)
 media_trimestral (numeric)
 desvio_padrao (numeric)
@@ -83,6 +83,19 @@ qtde_trimestres (int)
 data_processamento (timestamp)
 </despesas_agregadas>
 
+CUBO ANALÍTICO: despesas_cubo
+Despesas já somadas por operadora, trimestre e prefixo da conta (uf e modalidade da operadora inclusos).
+<despesas_cubo>
+registro_ans (int, FK → operadoras.registro_ans)
+ano (int)
+trimestre (int)
+conta_prefixo (varchar, 3 primeiros dígitos de conta_contabil)
+uf (varchar)
+modalidade (varchar)
+valor (numeric, soma dos lançamentos)
+qtd_lancamentos (int)
+</despesas_cubo>
+
 RELACIONAMENTOS (OBRIGATÓRIO)
 Sempre use JOIN operadoras o ON <tabela_fato>.registro_ans = o.registro_ans quando:
 A pergunta envolver nome da operadora, estado (uf), modalidade ou comparações entre operadoras.
@@ -110,6 +123,8 @@ Quando a pergunta envolver:
 “quem gastou mais” → ORDER BY SUM(valor) DESC
 ranking → ORDER BY + LIMIT
 tempo → usar ano e trimestre
+Filtre período comparando as colunas diretamente (ex: d.ano = 2024 AND d.trimestre = 3),
+nunca por expressões como ano*10+trimestre: assim só as partições do período são lidas
 
 Campos inexistentes NÃO DEVEM SER INVENTADOS
 Não existe categoria
@@ -119,9 +134,11 @@ Use aliases curtos e claros:
 o para operadoras
 d para despesas_eventos
 a para despesas_agregadas
+c para despesas_cubo
 
 BOAS PRÁTICAS
 Prefira despesas_agregadas quando a pergunta for estratégica ou resumida
+Prefira despesas_cubo para totais por UF, modalidade, trimestre ou grupo de conta
 Prefira despesas_eventos quando for analítica ou detalhada
 Agrupe corretamente usando GROUP BY
 Retorne apenas as colunas necessárias.
@@ -133,19 +150,16 @@ WHERE table_schema = 'public'
 ORDER BY table_name, ordinal_position;
 
 DEFINIÇÃO DE "MAIOR CRESCIMENTO" (Use SEMPRE esta lógica de CTEs):
-WITH limites AS (
-    SELECT MIN(ano*10+trimestre) as min_p, MAX(ano*10+trimestre) as max_p FROM despesas_eventos
-),
-inicio AS (
+WITH inicio AS (
     SELECT d.registro_ans, SUM(d.valor) as total_ini 
-    FROM despesas_eventos d, limites l 
-    WHERE (d.ano*10+d.trimestre) = l.min_p 
+    FROM despesas_eventos d 
+    WHERE (d.ano, d.trimestre) = (SELECT ano, trimestre FROM despesas_eventos ORDER BY ano, trimestre LIMIT 1)
     GROUP BY d.registro_ans
 ),
 fim AS (
     SELECT d.registro_ans, SUM(d.valor) as total_fim 
-    FROM despesas_eventos d, limites l 
-    WHERE (d.ano*10+d.trimestre) = l.max_p 
+    FROM despesas_eventos d 
+    WHERE (d.ano, d.trimestre) = (SELECT ano, trimestre FROM despesas_eventos ORDER BY ano DESC, trimestre DESC LIMIT 1)
     GROUP BY d.registro_ans
 )
 SELECT o.razao_social, i.total_ini, f.total_fim, ROUND(((f.total_fim - i.total_ini)/i.total_ini)*100, 2) as crescimento_pct
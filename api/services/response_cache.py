@@ -0,0 +1,118 @@
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+
+class DataVersion:
+    """
+    Versão dos dados publicada pelo ETL (tabela etl_versao, gravada pelo DatabaseLoader
+    no commit de cada carga). Relida do banco no máximo a cada `interval` segundos:
+    entre uma leitura e outra, cache e 304 respondem sem consultar o banco.
+    """
+
+    def __init__(self, engine, interval):
+        self.engine = engine
+        self.interval = interval
+        self._value = None
+        self._checked_at = None
+        # Aviso de versão indisponível já emitido (só se repete após uma leitura com sucesso)
+        self._unavailable = False
+        self._lock = threading.Lock()
+
+    def current(self):
+        """Versão atual, ou None se ainda não houver carga registrada (cache desligado)."""
+        now = time.monotonic()
+        with self._lock:
+            if self._checked_at is not None and now - self._checked_at < self.interval:
+                return self._value
+        try:
+            with self.engine.connect() as conn:
+                value = conn.execute(text("SELECT versao FROM etl_versao WHERE id = 1")).scalar()
+        except Exception as e:
+            # Banco sem etl_versao (schema anterior) ou indisponível: segue sem cache
+            with self._lock:
+                self._value = None
+                self._checked_at = now
+                first_failure = not self._unavailable
+                self._unavailable = True
+            if first_failure:
+                logger.warning(f"Versão dos dados indisponível, cache desligado: {e}")
+            return None
+        with self._lock:
+            self._value = value
+            self._checked_at = now
+            recovered = self._unavailable
+            self._unavailable = False
+        if recovered:
+            logger.info("Versão dos dados disponível novamente, cache religado.")
+        return value
+
+
+class ResponseCache:
+    """
+    Cache em memória (por processo) das respostas GET da API: LRU com TTL.
+    Todas as entradas pertencem a uma versão dos dados: quando o ETL publica outra,
+    o cache é esvaziado e os ETags mudam.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._version = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(path, query_params):
+        """Chave da resposta: rota + parâmetros (ordenados, para ?a=1&b=2 == ?b=2&a=1)."""
+        return path, tuple(sorted(query_params.multi_items()))
+
+    @staticmethod
+    def etag(version, key):
+        """
+        ETag fraco derivado da versão e da chave: a resposta de uma rota só muda com uma
+        carga nova, então o ETag é conhecido sem executar a consulta.
+        """
+        digest = hashlib.sha1(f"{version}|{key!r}".encode('utf-8')).hexdigest()[:24]
+        return f'W/"{digest}"'
+
+    @staticmethod
+    def matches(if_none_match, etag):
+        """Comparação fraca do If-None-Match (lista separada por vírgulas ou '*')."""
+        if not if_none_match:
+            return False
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in tags or etag.removeprefix('W/') in (tag.removeprefix('W/') for tag in tags)
+
+    def get(self, version, key):
+        """(corpo, headers) da resposta em cache, ou None."""
+        with self._lock:
+            self._sync(version)
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry['criado_em'] > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry['body'], entry['headers']
+
+    def set(self, version, key, body, headers):
+        with self._lock:
+            self._sync(version)
+            self._entries[key] = {'body': body, 'headers': headers, 'criado_em': time.monotonic()}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _sync(self, version):
+        """Versão nova dos dados: descarta as respostas da anterior."""
+        if version != self._version:
+            self._entries.clear()
+            self._version = version
@@ -12,6 +12,19 @@ PROCESSED_DIR = os.path.join(DATA_DIR, "processed")
 OUTPUT_FILE = os.path.join(DATA_DIR, "consolidado_despesas.csv")
 ENRICHED_FILE = os.path.join(DATA_DIR, "despesas_enriquecidas.csv")
 AGGREGATED_FILE = os.path.join(DATA_DIR, "despesas_agregadas.csv")
+# Datasets intermediários (colunares, particionados por Ano/Trimestre) trocados entre as etapas
+CONSOLIDATED_DATASET_DIR = os.path.join(DATA_DIR, "consolidado")
+ENRICHED_DATASET_DIR = os.path.join(DATA_DIR, "enriquecido")
+# Estado mesclável da agregação (count/sum/M2 por operadora, um parcial por trimestre)
+AGGREGATE_STATE_DIR = os.path.join(DATA_DIR, "agregados_estado")
+# Estado do ETL incremental (fingerprints das fontes já processadas)
+ETL_STATE_FILE = os.path.join(DATA_DIR, "etl_state.json")
+DOWNLOAD_MANIFEST_FILE = os.path.join(RAW_DIR, "download_manifest.json")
+# Cadastro de operadoras (CADOP): CSV baixado, manifesto HTTP e dimensão pré-processada (binária)
+CADASTRO_FILE = os.path.join(DATA_DIR, "cadastro_operadoras.csv")
+CADOP_MANIFEST_FILE = os.path.join(DATA_DIR, "cadop_manifest.json")
+CADOP_CACHE_BASE = os.path.join(DATA_DIR, "cadop_dimensao")
+LISTING_CACHE_FILE = os.path.join(RAW_DIR, "listing_cache.json")
 
 # --- 2. CONFIGURAÇÕES DE REDE E URLS ---
 ANS_BASE_URL = "https://dadosabertos.ans.gov.br/FTP/PDA/demonstracoes_contabeis/"
@@ -23,8 +36,25 @@ BACKOFF_FACTOR = 1
 USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
 HEADERS = {'User-Agent': USER_AGENT}
 
+# Downloads concorrentes: nº de workers e tamanho do pool de conexões da Session compartilhada
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "4"))
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "10"))
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # 1 MB por leitura do stream
+
+# Validade (segundos) da listagem do repositório salva em disco
+LISTING_CACHE_TTL = int(os.getenv("LISTING_CACHE_TTL", str(6 * 3600)))
+# Validade (segundos) do CADOP local antes de revalidar com GET condicional
+CADOP_CACHE_TTL = int(os.getenv("CADOP_CACHE_TTL", str(24 * 3600)))
+
 # --- 3. CONFIGURAÇÕES DE ETL (GERAL) ---
 CHUNK_SIZE = 50000 
+# Lê os CSV/TXT direto de dentro dos ZIPs baixados (sem extrair para PROCESSED_DIR)
+STREAM_FROM_ZIP = os.getenv("STREAM_FROM_ZIP", "1") == "1"
+# Processos usados na consolidação (1 = sequencial, no processo principal)
+CONSOLIDATION_WORKERS = int(os.getenv("CONSOLIDATION_WORKERS", "1"))
+# Backpressure do pipeline sobreposto: nº máximo de ZIPs aguardando consolidação e de
+# downloads em andamento (limita também o --download-workers nesse modo)
+PIPELINE_QUEUE_SIZE = 2
 FINAL_COLUMNS = ["RegistroANS", "CNPJ", "RazaoSocial", "Trimestre", "Ano", "Conta", "Descricao", "Modalidade", "Valor Despesas"]
 
 # Mapeamento para normalizar nomes de colunas do CSV Financeiro
@@ -41,6 +71,10 @@ COLUMN_MAPPING = {
 # Conta 4 (Despesas Assistenciais) e 2 (Passivo - para validações se necessário)
 # Filtramos apenas as despesas operacionais (Grupo 4) que nos interessam
 ACCOUNT_PREFIX_FILTER = ["41"]
+# Nº de dígitos da conta contábil usado como eixo do cubo analítico (despesas_cubo)
+CUBE_ACCOUNT_PREFIX_LEN = 3
+# Descarta linhas de outras contas antes do parser do pandas (ver _AccountPrefixFilter)
+RAW_LINE_PREFILTER = os.getenv("RAW_LINE_PREFILTER", "1") == "1"
  
 
 # --- 5. REGRAS DE ENRIQUECIMENTO (CADASTRO) ---
@@ -77,6 +111,12 @@ DB_HOST = os.getenv("DB_HOST", "localhost")
 DB_PORT = os.getenv("DB_PORT", "5432")
 DB_NAME = os.getenv("DB_NAME", "ans_db")
 
+# Construção de índices após a carga: workers paralelos e memória de manutenção por sessão
+DB_MAINTENANCE_WORKERS = int(os.getenv("DB_MAINTENANCE_WORKERS", "4"))
+DB_MAINTENANCE_WORK_MEM = os.getenv("DB_MAINTENANCE_WORK_MEM", "512MB")
+# Carga do fato: conexões simultâneas (uma por trimestre em andamento)
+DB_LOAD_WORKERS = int(os.getenv("DB_LOAD_WORKERS", "4"))
+
 # URL de Escrita (ETL)
 # Prioridade: 1. Variável de Ambiente (Cloud/Prod) | 2. Montagem Local (Dev)
 DATABASE_URL = os.getenv("DATABASE_URL")
@@ -96,4 +136,10 @@ if not DATABASE_URL_READER:
 if not DATABASE_URL_READER:
     # Fallback final: usa a string construída manualmente acima
     print("⚠️ AVISO: DATABASE_URL_READER/DATABASE_URL não encontradas no .env. Usando config padrão.")
-    DATABASE_URL_READER = DATABASE_URL
\ No newline at end of file
+    DATABASE_URL_READER = DATABASE_URL
+
+# Cache de respostas da API (por processo): LRU com TTL, invalidado pela versão dos dados
+# que o ETL grava em etl_versao. A versão é relida do banco no máximo a cada N segundos.
+API_CACHE_MAX_ENTRIES = int(os.getenv("API_CACHE_MAX_ENTRIES", "256"))
+API_CACHE_TTL = int(os.getenv("API_CACHE_TTL", str(3600)))
+API_VERSION_CHECK_INTERVAL = int(os.getenv("API_VERSION_CHECK_INTERVAL", "30"))
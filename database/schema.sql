@@ -1,16 +1,19 @@
 -- ============================================================================
 -- PARTE 1: ESTRUTURA DOS DADOS (DDL)
--- Recria as tabelas limpas e otimizadas
+-- Idempotente: cria apenas o que não existe, preservando os dados já carregados
+-- (a carga incremental substitui só os trimestres alterados).
+-- O reprocessamento completo (--full-refresh) monta tabelas-sombra e as troca no fim.
+--
+-- As tabelas são criadas "nuas": índices secundários e chaves estrangeiras são
+-- construídos pelo DatabaseLoader depois da carga em massa (DEFERRED_INDEXES /
+-- DEFERRED_CONSTRAINTS), seguidos de VALIDATE CONSTRAINT e ANALYZE.
 -- ============================================================================
 
--- Limpeza inicial (apenas se for admin)
-DROP TABLE IF EXISTS despesas_agregadas;
-DROP TABLE IF EXISTS despesas_eventos;
-DROP TABLE IF EXISTS operadoras;
-
 -- 1. TABELA MÃE (Dimensão): OPERADORAS
-CREATE TABLE operadoras (
-    registro_ans VARCHAR(10) PRIMARY KEY,
+-- registro_ans é o número do registro na ANS como chave inteira em todas as tabelas
+-- (joins e índices menores); o formato de 6 dígitos da ANS é só de exibição (API).
+CREATE TABLE IF NOT EXISTS operadoras (
+    registro_ans INTEGER PRIMARY KEY,
     cnpj VARCHAR(20) NOT NULL,
     razao_social VARCHAR(255) NOT NULL,
     modalidade VARCHAR(100),
@@ -32,39 +35,159 @@ CREATE TABLE operadoras (
     regiao_comercializacao VARCHAR(50),
     data_registro_ans VARCHAR(50)
 );
-CREATE INDEX idx_ops_uf ON operadoras(uf);
-CREATE INDEX idx_ops_razao ON operadoras(razao_social); -- Importante para o ILIKE da IA
+-- Índices (pós-carga): idx_ops_uf (uf), idx_ops_razao (razao_social, usado pelo ILIKE da IA)
 
 -- 2. TABELA FILHA (Fato Transacional): DESPESAS_EVENTOS
-CREATE TABLE despesas_eventos (
-    id BIGSERIAL PRIMARY KEY,
-    registro_ans VARCHAR(10) NOT NULL,
+-- Particionada por trimestre: uma partição despesas_eventos_<ano>_t<trimestre> por
+-- período, criada pelo DatabaseLoader. Carregar ou substituir um trimestre é anexar
+-- uma tabela já carregada e indexada (ATTACH PARTITION) e descartar a anterior, sem
+-- DELETE no fato. A PK de tabela particionada precisa conter a chave de partição.
+-- O id vem de uma sequência própria (não pertence à tabela): as partições são carregadas
+-- por várias conexões em paralelo e a sequência sobrevive à troca das tabelas-sombra.
+CREATE SEQUENCE IF NOT EXISTS seq_despesas_eventos;
+
+CREATE TABLE IF NOT EXISTS despesas_eventos (
+    id BIGINT NOT NULL DEFAULT nextval('seq_despesas_eventos'),
+    registro_ans INTEGER NOT NULL,
     ano INTEGER NOT NULL,
     trimestre INTEGER NOT NULL,
     conta_contabil VARCHAR(50),
     descricao VARCHAR(255),
     valor NUMERIC(18, 2) NOT NULL,
-    
-    CONSTRAINT fk_evento_operadora
-        FOREIGN KEY (registro_ans) REFERENCES operadoras(registro_ans)
-        ON DELETE CASCADE
-);
-CREATE INDEX idx_eventos_tempo ON despesas_eventos(ano, trimestre);
-CREATE INDEX idx_eventos_fk ON despesas_eventos(registro_ans);
+
+    PRIMARY KEY (ano, trimestre, id)
+) PARTITION BY RANGE (ano, trimestre);
+-- Pós-carga: fk_evento_operadora (registro_ans -> operadoras, ON DELETE CASCADE),
+-- idx_eventos_fk (registro_ans). O filtro por período é resolvido pela poda de partições.
 
 -- 3. TABELA FILHA (Fato Analítico): DESPESAS_AGREGADAS
-CREATE TABLE despesas_agregadas (
+CREATE TABLE IF NOT EXISTS despesas_agregadas (
     id SERIAL PRIMARY KEY,
-    registro_ans VARCHAR(10) NOT NULL,
+    registro_ans INTEGER NOT NULL,
     total_despesas NUMERIC(18, 2),
     media_trimestral NUMERIC(18, 2),
     desvio_padrao NUMERIC(18, 2),
     qtde_trimestres INTEGER,
-    data_processamento TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    data_processamento TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+-- Pós-carga: fk_agregada_operadora (registro_ans -> operadoras, ON DELETE CASCADE)
 
-    CONSTRAINT fk_agregada_operadora
-        FOREIGN KEY (registro_ans) REFERENCES operadoras(registro_ans)
-        ON DELETE CASCADE
+-- 4. TABELA FILHA (Cubo Analítico): DESPESAS_CUBO
+-- Rollup do fato por operadora x trimestre x prefixo de conta, com UF e modalidade
+-- da operadora. Alimenta os KPIs do dashboard sem varrer despesas_eventos.
+CREATE TABLE IF NOT EXISTS despesas_cubo (
+    registro_ans INTEGER NOT NULL,
+    ano INTEGER NOT NULL,
+    trimestre INTEGER NOT NULL,
+    conta_prefixo VARCHAR(10) NOT NULL,
+    uf VARCHAR(2),
+    modalidade VARCHAR(100),
+    valor NUMERIC(18, 2) NOT NULL,
+    qtd_lancamentos INTEGER NOT NULL,
+
+    PRIMARY KEY (ano, trimestre, registro_ans, conta_prefixo)
+);
+-- Pós-carga: fk_cubo_operadora (registro_ans -> operadoras, ON DELETE CASCADE),
+-- idx_cubo_uf (uf), idx_cubo_operadora (registro_ans)
+
+-- 5. VISÕES MATERIALIZADAS (Dashboard Storytelling)
+-- Resultado pronto de cada seção de /api/analytics/storytelling, lido do cubo.
+-- O DatabaseLoader as atualiza ao fim de cada carga com REFRESH ... CONCURRENTLY
+-- (exige o índice único de cada visão) e as recria na troca das tabelas-sombra.
+
+-- 5.1 KPIs macro: total, operadoras ativas e valores do primeiro/último trimestre
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_story_macro AS
+WITH inicio AS (
+    SELECT ano, trimestre FROM despesas_cubo ORDER BY ano, trimestre LIMIT 1
+),
+fim AS (
+    SELECT ano, trimestre FROM despesas_cubo ORDER BY ano DESC, trimestre DESC LIMIT 1
+)
+SELECT
+    1 AS id,
+    SUM(d.valor) AS total_geral,
+    COUNT(DISTINCT d.registro_ans) AS ativas,
+    SUM(CASE WHEN (d.ano, d.trimestre) = (i.ano, i.trimestre) THEN d.valor ELSE 0 END) AS valor_inicio,
+    SUM(CASE WHEN (d.ano, d.trimestre) = (f.ano, f.trimestre) THEN d.valor ELSE 0 END) AS valor_fim
+FROM despesas_cubo d, inicio i, fim f;
+
+CREATE UNIQUE INDEX IF NOT EXISTS ux_mv_story_macro ON mv_story_macro (id);
+
+-- 5.2 Top movers: crescimento de cada operadora entre o primeiro e o último trimestre
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_story_movers AS
+WITH inicio AS (
+    SELECT d.registro_ans, SUM(d.valor) AS v_ini
+    FROM despesas_cubo d
+    WHERE (d.ano, d.trimestre) = (SELECT ano, trimestre FROM despesas_cubo ORDER BY ano, trimestre LIMIT 1)
+    GROUP BY d.registro_ans
+),
+fim AS (
+    SELECT d.registro_ans, SUM(d.valor) AS v_fim
+    FROM despesas_cubo d
+    WHERE (d.ano, d.trimestre) = (SELECT ano, trimestre FROM despesas_cubo ORDER BY ano DESC, trimestre DESC LIMIT 1)
+    GROUP BY d.registro_ans
+)
+SELECT
+    o.registro_ans,
+    o.razao_social,
+    f.v_fim,
+    ROUND(((f.v_fim - i.v_ini) / i.v_ini) * 100, 2) AS cresc
+FROM operadoras o
+JOIN inicio i ON o.registro_ans = i.registro_ans
+JOIN fim f ON o.registro_ans = f.registro_ans
+WHERE i.v_ini > 0;
+
+CREATE UNIQUE INDEX IF NOT EXISTS ux_mv_story_movers ON mv_story_movers (registro_ans);
+CREATE INDEX IF NOT EXISTS idx_mv_story_movers_cresc ON mv_story_movers (cresc DESC);
+
+-- 5.3 Geo eficiência: total, operadoras e média por UF
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_story_geo AS
+SELECT
+    uf,
+    SUM(valor) AS total,
+    COUNT(DISTINCT registro_ans) AS qtd,
+    SUM(valor) / COUNT(DISTINCT registro_ans) AS media
+FROM despesas_cubo
+WHERE uf IS NOT NULL
+GROUP BY uf;
+
+CREATE UNIQUE INDEX IF NOT EXISTS ux_mv_story_geo ON mv_story_geo (uf);
+
+-- 5.4 Consistência: operadoras acima da média do mercado em 2 ou mais trimestres
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_story_consistencia AS
+WITH metricas AS (
+    SELECT ano, trimestre, registro_ans, SUM(valor) AS total
+    FROM despesas_cubo
+    GROUP BY ano, trimestre, registro_ans
+),
+medias AS (
+    SELECT ano, trimestre, AVG(total) AS m_geral
+    FROM metricas
+    GROUP BY ano, trimestre
+),
+perf AS (
+    SELECT mt.registro_ans,
+    CASE WHEN mt.total > mm.m_geral THEN 1 ELSE 0 END AS win
+    FROM metricas mt
+    JOIN medias mm ON mt.ano = mm.ano AND mt.trimestre = mm.trimestre
+)
+SELECT o.razao_social, o.uf, SUM(p.win) AS qtd
+FROM perf p
+JOIN operadoras o ON p.registro_ans = o.registro_ans
+WHERE o.razao_social NOT ILIKE '%INATIVA%'
+  AND o.razao_social NOT ILIKE '%DESCONHECIDA%'
+GROUP BY o.razao_social, o.uf
+HAVING SUM(p.win) >= 2;
+
+CREATE UNIQUE INDEX IF NOT EXISTS ux_mv_story_consistencia ON mv_story_consistencia (razao_social, uf);
+
+-- 6. CONTROLE: VERSÃO DOS DADOS
+-- Uma única linha, regravada pelo DatabaseLoader no commit de cada carga. A API compara
+-- a versão para invalidar o cache de respostas e montar os ETags.
+CREATE TABLE IF NOT EXISTS etl_versao (
+    id SMALLINT PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+    versao VARCHAR(64) NOT NULL,
+    atualizado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
 -- ============================================================================
@@ -73,16 +196,13 @@ CREATE TABLE despesas_agregadas (
 -- ============================================================================
 
 -- 1. Cria o usuário específico (se não existir)
-
-SELECT pg_terminate_backend(pid) FROM pg_stat_activity WHERE usename = 'reader';
-
--- Agora sim podemos deletar sem erro de "dependência" ou "sessão ativa"
-DROP OWNED BY reader;
-DROP ROLE IF EXISTS reader;
-
--- Cria do zero com a senha correta
+-- Idempotente e sem derrubar sessões: a API (conectada como reader) continua no ar
+-- durante a carga. O "já existe" do CREATE ROLE é ignorado pelo DatabaseLoader.init_db.
 CREATE ROLE reader WITH LOGIN PASSWORD 'AnsSemMedo2025';
 
+-- Mantém a senha alinhada mesmo quando o role já existia
+ALTER ROLE reader WITH LOGIN PASSWORD 'AnsSemMedo2025';
+
 -- 2. Garante que ele pode conectar no banco
 GRANT CONNECT ON DATABASE postgres TO reader; 
 
@@ -3,25 +3,21 @@
 -- Comparação: Primeiro Trimestre (Min) vs Último Trimestre (Max)
 -- ============================================================================
 
-WITH limites_temporais AS (
-    -- 1. Descobre dinamicamente qual é o primeiro e o último período disponível
-    SELECT 
-        MIN(ano * 10 + trimestre) as periodo_min,
-        MAX(ano * 10 + trimestre) as periodo_max
-    FROM despesas_eventos
-),
-despesas_inicio AS (
-    -- 2. Calcula despesa total de cada operadora no PRIMEIRO período
+WITH despesas_inicio AS (
+    -- 1. Calcula despesa total de cada operadora no PRIMEIRO período.
+    -- O período vem de uma subconsulta escalar comparada direto com (ano, trimestre):
+    -- o planner descarta as partições de despesas_eventos fora dele (uma expressão
+    -- como ano * 10 + trimestre obrigaria a ler todas)
     SELECT d.registro_ans, SUM(d.valor) as total_inicial
-    FROM despesas_eventos d, limites_temporais l
-    WHERE (d.ano * 10 + d.trimestre) = l.periodo_min
+    FROM despesas_eventos d
+    WHERE (d.ano, d.trimestre) = (SELECT ano, trimestre FROM despesas_eventos ORDER BY ano, trimestre LIMIT 1)
     GROUP BY d.registro_ans
 ),
 despesas_fim AS (
-    -- 3. Calcula despesa total de cada operadora no ÚLTIMO período
+    -- 2. Calcula despesa total de cada operadora no ÚLTIMO período
     SELECT d.registro_ans, SUM(d.valor) as total_final
-    FROM despesas_eventos d, limites_temporais l
-    WHERE (d.ano * 10 + d.trimestre) = l.periodo_max
+    FROM despesas_eventos d
+    WHERE (d.ano, d.trimestre) = (SELECT ano, trimestre FROM despesas_eventos ORDER BY ano DESC, trimestre DESC LIMIT 1)
     GROUP BY d.registro_ans
 )
 SELECT 
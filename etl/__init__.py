@@ -4,4 +4,5 @@ from .file_handler import FileHandler
 from .consolidator import DataConsolidator
 from .enrichment import DataEnricher
 from .aggregator import DataAggregator
-from .database_loader import DatabaseLoader
\ No newline at end of file
+from .database_loader import DatabaseLoader
+from .pipeline import OverlappedPipeline
\ No newline at end of file
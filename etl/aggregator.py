@@ -1,70 +1,332 @@
 import pandas as pd
 import numpy as np
 import os
+import json
 import logging
 from utils.compression import FileCompressor 
-from config import ENRICHED_FILE, AGGREGATED_FILE, PROCESSED_DIR
+from config import (
+    AGGREGATED_FILE, PROCESSED_DIR, ENRICHED_DATASET_DIR, AGGREGATE_STATE_DIR, CHUNK_SIZE,
+    CUBE_ACCOUNT_PREFIX_LEN
+)
+from .dataset import PartitionedDataset, PARQUET_AVAILABLE
 
 class DataAggregator:
     """
     Classe responsável por agregar dados financeiros para gerar estatísticas.
     Calcula totais trimestrais e métricas estatísticas (média, desvio padrão).
+
+    As estatísticas são mantidas como estado mesclável por operadora
+    (count, sum, M2 dos totais trimestrais - Welford/Chan): cada trimestre gera um
+    estado parcial, gravado em AGGREGATE_STATE_DIR, e o estado acumulado é a fusão
+    dos parciais. Um trimestre novo custa a leitura só das suas linhas.
+
+    O grão é o RegistroANS padronizado (chave inteira, a mesma do banco): uma linha por
+    operadora. RazaoSocial/UF/Modalidade são atributos, não chave: valem os do trimestre
+    mais recente em que estão preenchidos.
     """
+    OPERATOR_KEYS = ['RegistroANS', 'RazaoSocial', 'UF', 'Modalidade']
+    ATTRIBUTE_COLUMNS = ['RazaoSocial', 'UF', 'Modalidade']
+    # Formato do estado persistido; outro valor força a reconstrução a partir do dataset
+    STATE_VERSION = 2
+    # Grão do cubo analítico: operadora x trimestre x prefixo da conta (UF/Modalidade
+    # são atributos da operadora e vão junto, sem entrar na chave)
+    CUBE_KEYS = ['RegistroANS', 'Ano', 'Trimestre', 'ContaPrefixo']
+
     def __init__(self):
         self.logger = logging.getLogger("ANS_ETL.Aggregator")
-        self.input_file = ENRICHED_FILE
+        self.dataset = PartitionedDataset(ENRICHED_DATASET_DIR)
+        self.state_dataset = PartitionedDataset(AGGREGATE_STATE_DIR)
         self.output_file = AGGREGATED_FILE
+        # Estado acumulado (fusão de todos os parciais) + trimestres que ele cobre
+        self.total_state_file = os.path.join(AGGREGATE_STATE_DIR, '_total' + self.state_dataset.extension)
+        self.total_meta_file = os.path.join(AGGREGATE_STATE_DIR, '_total.json')
 
     def process(self, df_input=None):
         """
-        Executa o fluxo de agregação:
-        1. Lê o arquivo enriquecido (ou usa DataFrame memória).
-        2. Calcula totais por trimestre.
-        3. Gera estatísticas gerais (Média, Desvio Padrão).
-        4. Salva o resultado agregado.
+        Executa o fluxo completo de agregação (compute + save).
+
+        Retorna:
+            DataFrame: Estatísticas por operadora (None se não houver dados).
+        """
+        stats = self.compute(df_input)
+        if stats is not None:
+            self.save(stats)
+        return stats
+
+    def compute(self, df_input=None, partitions=None):
+        """
+        Calcula os KPIs por operadora (implementação única, usada pelo CSV e pelo banco):
+        1. Soma os valores por operadora e trimestre, bloco a bloco.
+        2. Converte os totais trimestrais em estado (count, sum, M2) e o funde com o
+           estado acumulado dos demais trimestres.
+        3. Deriva Total, Média, Desvio Padrão (amostral, ddof=1) e Qtde de trimestres.
+
+        Sem `df_input`, usa o dataset enriquecido e o estado persistido:
+        - `partitions` = None: reconstrói o estado de todos os trimestres.
+        - `partitions` = [(ano, trimestre), ...]: relê só esses trimestres; se forem todos
+          novos, o parcial é fundido ao acumulado; se algum substituiu um trimestre já
+          agregado, o acumulado é refeito a partir dos parciais (sem reler o fato).
+        Com `df_input` (DataFrame ou iterável de blocos), agrega em memória sem estado.
+
+        Retorna:
+            DataFrame: Estatísticas ordenadas por Total_Despesas (None se não houver dados).
         """
         self.logger.info("Iniciando Agregação Estatística...")
-        
-        cols_needed = ['RegistroANS', 'RazaoSocial', 'UF', 'Modalidade', 'Ano', 'Trimestre', 'Valor Despesas']
 
         try:
-            if df_input is None:
-                if not os.path.exists(self.input_file):
-                    self.logger.error("Arquivo enriquecido não encontrado.")
-                    return
-                df = pd.read_csv(self.input_file, sep=';', encoding='utf-8-sig', usecols=cols_needed)
+            if df_input is not None:
+                if isinstance(df_input, pd.DataFrame):
+                    self.logger.info("Usando DataFrame em memória para agregação.")
+                    chunks = [df_input]
+                else:
+                    self.logger.info("Agregando blocos recebidos em streaming.")
+                    chunks = df_input
+                state = self._state_from_totals(self._quarter_totals(chunks))
             else:
-                self.logger.info("Usando DataFrame em memória para agregação.")
-                # Filtra apenas colunas necessárias e protege o original
-                df = df_input[cols_needed].copy()
-            
-            df['Valor Despesas'] = pd.to_numeric(df['Valor Despesas'], errors='coerce').fillna(0)
+                state = self._update_state(partitions)
 
-            # 1. Totais Trimestrais
-            self.logger.info("Calculando totais trimestrais...")
-            df_trimestral = df.groupby(
-                ['RegistroANS', 'RazaoSocial', 'UF', 'Modalidade', 'Ano', 'Trimestre']
-            )['Valor Despesas'].sum().reset_index()
-            
-            df_trimestral.rename(columns={'Valor Despesas': 'Despesa_Trimestral'}, inplace=True)
+            if state is None or state.empty:
+                self.logger.error("Dataset enriquecido não encontrado.")
+                return None
 
-            # 2. Estatísticas Gerais
             self.logger.info("Calculando estatísticas finais...")
-            stats = df_trimestral.groupby(['RegistroANS', 'RazaoSocial', 'UF', 'Modalidade'])['Despesa_Trimestral'].agg(
-                Total_Despesas='sum',
-                Media_Trimestral='mean',
-                Desvio_Padrao='std',
-                Qtde_Trimestres='count'
-            ).reset_index()
-
-            stats['Desvio_Padrao'] = stats['Desvio_Padrao'].fillna(0)
-            
-            # Ordenação
-            stats.sort_values(by='Total_Despesas', ascending=False, inplace=True)
-            stats['Total_Despesas'] = stats['Total_Despesas'].round(2)
-            stats['Media_Trimestral'] = stats['Media_Trimestral'].round(2)
-            stats['Desvio_Padrao'] = stats['Desvio_Padrao'].round(2)
+            return self._stats_from_state(state)
+
+        except Exception as e:
+            self.logger.critical(f"Erro fatal na agregação: {e}")
+            raise
+
+    @staticmethod
+    def standardize_registro(series):
+        """
+        Registro ANS como chave inteira (a mesma das tabelas do banco).
+        Ex: '005711', '5711.0' e 5711 viram 5711; valores inválidos viram 0.
+        """
+        return pd.to_numeric(series, errors='coerce').fillna(0).astype('int64')
+
+    # --- Estado mesclável (Welford/Chan) ---
+    def _quarter_totals(self, chunks):
+        """
+        Totais por operadora x trimestre (somas parciais por bloco, combinadas no final).
+
+        O bloco é agrupado só por códigos inteiros (registro padronizado x período,
+        fatorados) com np.bincount, sem hashear strings longas linha a linha. Os
+        atributos descritivos vêm da primeira linha de cada operadora x trimestre.
+        """
+        attr_cols = self.ATTRIBUTE_COLUMNS
+
+        partials = []
+        for chunk in chunks:
+            if chunk.empty: continue
+            ano = pd.to_numeric(chunk['Ano'], errors='coerce').to_numpy()
+            trimestre = pd.to_numeric(chunk['Trimestre'], errors='coerce').to_numpy()
+            valores = pd.to_numeric(chunk['Valor Despesas'], errors='coerce').fillna(0).to_numpy(dtype='float64')
+
+            # Chave: registro padronizado x período (ano*10 + trimestre, 5 dígitos)
+            registros = self.standardize_registro(chunk['RegistroANS']).to_numpy()
+            periodo_linha = ano * 10 + trimestre
+            valid = ~np.isnan(periodo_linha)
+            if not valid.any(): continue
+            key = registros[valid] * 100000 + periodo_linha[valid].astype('int64')
+
+            # factorize numera as chaves na ordem de aparição: a primeira linha de cada
+            # chave é onde o código supera o máximo acumulado até a linha anterior
+            codes, keys = pd.factorize(key)
+            sums = np.bincount(codes, weights=valores[valid], minlength=len(keys))
+            running_max = np.maximum.accumulate(codes)
+            first_rows = np.flatnonzero(codes > np.concatenate(([-1], running_max[:-1])))
+
+            keys = np.asarray(keys)
+            periodo = keys % 100000
+            totals = chunk.loc[valid, attr_cols].iloc[first_rows].reset_index(drop=True)
+            totals.insert(0, 'RegistroANS', keys // 100000)
+            totals['Ano'] = periodo // 10
+            totals['Trimestre'] = periodo % 10
+            totals['Valor Despesas'] = sums
+            partials.append(totals)
+
+        if not partials:
+            return None
+        # Um mesmo trimestre pode vir em vários blocos: soma as parciais (tabela pequena)
+        df = pd.concat(partials, ignore_index=True)
+        agg = {'Valor Despesas': 'sum', **{c: 'first' for c in attr_cols}}
+        return df.groupby(['RegistroANS', 'Ano', 'Trimestre'], sort=False).agg(agg).reset_index()
 
+    def _state_from_totals(self, df_trimestral):
+        """
+        Cada total trimestral é uma observação: count=1, sum=total, M2=0, fundidas por
+        operadora. O período acompanha os atributos para a fusão escolher os mais recentes.
+        """
+        if df_trimestral is None or df_trimestral.empty:
+            return None
+        obs = df_trimestral[self.OPERATOR_KEYS].copy()
+        obs['periodo'] = (df_trimestral['Ano'] * 10 + df_trimestral['Trimestre']).astype('int64').to_numpy()
+        obs['count'] = 1
+        obs['sum'] = df_trimestral['Valor Despesas'].astype('float64').to_numpy()
+        obs['m2'] = 0.0
+        return self.merge_states([obs])
+
+    @classmethod
+    def merge_states(cls, states):
+        """
+        Funde estados (count, sum, M2) da mesma operadora - forma paralela de Chan et al.:
+            n = Σ n_i,  mean = Σ sum_i / n,  M2 = Σ [M2_i + n_i * (mean_i - mean)²]
+        Exata para qualquer partição das observações; só depende do nº de estados,
+        não do nº de linhas que os originaram.
+        Agrupa só pelo RegistroANS: cada atributo fica com o valor preenchido do período
+        mais recente (`periodo` = último trimestre que contribuiu para o estado).
+        """
+        frames = [s for s in states if s is not None and not s.empty]
+        if not frames:
+            return None
+        df = pd.concat(frames, ignore_index=True)
+        grouped = df.groupby('RegistroANS', sort=False)
+
+        merged = grouped[['count', 'sum']].sum()
+        mean = (merged['sum'] / merged['count']).rename('_mean')
+        df = df.join(mean, on='RegistroANS')
+        df['_m2'] = df['m2'] + df['count'] * (df['sum'] / df['count'] - df['_mean']) ** 2
+        merged['m2'] = df.groupby('RegistroANS', sort=False)['_m2'].sum().clip(lower=0)
+        merged['count'] = merged['count'].astype('int64')
+        merged['periodo'] = grouped['periodo'].max()
+
+        # last() ignora nulos: atributo ausente no trimestre mais recente vem do anterior
+        latest = df.sort_values('periodo', kind='stable').groupby('RegistroANS', sort=False)
+        merged = merged.join(latest[cls.ATTRIBUTE_COLUMNS].last())
+        return merged.reset_index()[cls.OPERATOR_KEYS + ['periodo', 'count', 'sum', 'm2']]
+
+    def _stats_from_state(self, state):
+        """Estatísticas finais a partir do estado (mesma semântica de groupby.agg sum/mean/std/count)."""
+        count = state['count']
+        stats = state[self.OPERATOR_KEYS].copy()
+        stats['Total_Despesas'] = state['sum']
+        stats['Media_Trimestral'] = state['sum'] / count
+        # std amostral (ddof=1); operadora com um único trimestre fica 0 (NaN no pandas)
+        stats['Desvio_Padrao'] = np.sqrt(state['m2'] / (count - 1).where(count > 1))
+        stats['Qtde_Trimestres'] = count
+
+        stats['Desvio_Padrao'] = stats['Desvio_Padrao'].fillna(0)
+
+        # Ordenação
+        stats.sort_values(by='Total_Despesas', ascending=False, inplace=True)
+        stats['Total_Despesas'] = stats['Total_Despesas'].round(2)
+        stats['Media_Trimestral'] = stats['Media_Trimestral'].round(2)
+        stats['Desvio_Padrao'] = stats['Desvio_Padrao'].round(2)
+        return stats.reset_index(drop=True)
+
+    def _partition_state(self, ano, trimestre):
+        """Estado parcial de um trimestre, lido do dataset enriquecido."""
+        cols_needed = self.OPERATOR_KEYS + ['Ano', 'Trimestre', 'Valor Despesas']
+        chunks = (df for _, df in self.dataset.iter_chunks(
+            columns=cols_needed, partitions=[(ano, trimestre)], chunk_rows=CHUNK_SIZE))
+        return self._state_from_totals(self._quarter_totals(chunks))
+
+    def _update_state(self, partitions):
+        """Atualiza os parciais dos trimestres informados e devolve o estado acumulado."""
+        covered, total = self._read_total_state()
+        stored = set(self.state_dataset.partitions())
+
+        if partitions is None or total is None or covered != stored:
+            self.logger.info("Reconstruindo o estado da agregação a partir do dataset enriquecido...")
+            self.state_dataset.clear()
+            partitions = self.dataset.partitions()
+            merge_into_total = False
+        else:
+            partitions = sorted(partitions)
+            # Trimestre substituído: seu parcial antigo não pode ser "subtraído" do acumulado
+            merge_into_total = not any(p in stored for p in partitions)
+            self.logger.info(f"Agregação incremental: {len(partitions)} trimestres.")
+
+        new_states = []
+        for ano, trimestre in partitions:
+            self.state_dataset.drop_partition(ano, trimestre)
+            state = self._partition_state(ano, trimestre)
+            if state is not None:
+                self.state_dataset.write_part(state, ano, trimestre, 'part-00000')
+                new_states.append(state)
+
+        if merge_into_total:
+            total = self.merge_states([total] + new_states)
+        else:
+            total = self.merge_states([df for _, df in self.state_dataset.iter_partitions()])
+
+        self._write_total_state(total)
+        return total
+
+    def _read_total_state(self):
+        """Estado acumulado persistido e o conjunto de trimestres que ele cobre."""
+        try:
+            with open(self.total_meta_file, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta.get('version') != self.STATE_VERSION:
+                return None, None
+            covered = {tuple(p) for p in meta['partitions']}
+            if PARQUET_AVAILABLE:
+                total = pd.read_parquet(self.total_state_file)
+            else:
+                total = pd.read_pickle(self.total_state_file)
+        except (OSError, ValueError, KeyError):
+            return None, None
+        return covered, total
+
+    def _write_total_state(self, total):
+        # Meta apagada primeiro: uma queda no meio força reconstrução, nunca um acumulado errado
+        if os.path.exists(self.total_meta_file):
+            os.remove(self.total_meta_file)
+        if total is None:
+            if os.path.exists(self.total_state_file):
+                os.remove(self.total_state_file)
+            return
+        tmp_path = self.total_state_file + '.tmp'
+        if PARQUET_AVAILABLE:
+            total.to_parquet(tmp_path, index=False)
+        else:
+            total.to_pickle(tmp_path)
+        os.replace(tmp_path, self.total_state_file)
+        with open(self.total_meta_file, 'w', encoding='utf-8') as f:
+            json.dump({
+                'version': self.STATE_VERSION,
+                'partitions': [list(p) for p in self.state_dataset.partitions()],
+            }, f)
+
+    # --- Cubo analítico (UF x Modalidade x Operadora x Trimestre x Conta) ---
+    @classmethod
+    def cube_partial(cls, df):
+        """
+        Rollup de um bloco do fato no grão do cubo (CUBE_KEYS), com soma e nº de lançamentos.
+        Espera o bloco já padronizado pelo DatabaseLoader (RegistroANS limpo, valor numérico).
+        """
+        cube = pd.DataFrame({
+            'RegistroANS': df['RegistroANS'],
+            'Ano': df['Ano'],
+            'Trimestre': df['Trimestre'],
+            'ContaPrefixo': df['Conta'].fillna('').astype(str).str.strip().str[:CUBE_ACCOUNT_PREFIX_LEN],
+            'UF': df['UF'],
+            'Modalidade': df['Modalidade'],
+            'Valor': df['Valor Despesas'],
+        })
+        return cube.groupby(cls.CUBE_KEYS, sort=False).agg(
+            UF=('UF', 'first'), Modalidade=('Modalidade', 'first'),
+            Valor=('Valor', 'sum'), Lancamentos=('Valor', 'size')
+        ).reset_index()
+
+    @classmethod
+    def merge_cube(cls, parts):
+        """Combina os rollups parciais dos blocos (uma mesma célula pode vir de vários blocos)."""
+        parts = [p for p in parts if not p.empty]
+        if not parts:
+            return None
+        cube = pd.concat(parts, ignore_index=True)
+        cube = cube.groupby(cls.CUBE_KEYS, sort=False).agg(
+            UF=('UF', 'first'), Modalidade=('Modalidade', 'first'),
+            Valor=('Valor', 'sum'), Lancamentos=('Lancamentos', 'sum')
+        ).reset_index()
+        cube['Valor'] = cube['Valor'].round(2)
+        return cube
+
+    def save(self, stats):
+        """Grava as estatísticas calculadas por compute() no CSV agregado e o compacta."""
+        try:
             self.logger.info(f"Salvando CSV agregado: {self.output_file}")
             stats.to_csv(self.output_file, index=False, sep=';', encoding='utf-8-sig')
             
@@ -78,4 +340,4 @@ class DataAggregator:
 
         except Exception as e:
             self.logger.critical(f"Erro fatal na agregação: {e}")
-            raise
\ No newline at end of file
+            raise
@@ -1,66 +1,443 @@
 import os
+import re
+import codecs
 import pandas as pd
 import logging
+import io
 import csv
+from concurrent.futures import ProcessPoolExecutor
 from utils.compression import FileCompressor
+from .file_handler import FileHandler
+from .dataset import PartitionedDataset
 from config import (
-    PROCESSED_DIR, OUTPUT_FILE, COLUMN_MAPPING, 
+    PROCESSED_DIR, OUTPUT_FILE, CONSOLIDATED_DATASET_DIR, COLUMN_MAPPING, 
     CHUNK_SIZE, FINAL_COLUMNS, 
-    ACCOUNT_PREFIX_FILTER
+    ACCOUNT_PREFIX_FILTER, STREAM_FROM_ZIP, CONSOLIDATION_WORKERS,
+    RAW_LINE_PREFILTER
 )
 
+# Coluna bruta da conta contábil (chave do pré-filtro de linhas)
+ACCOUNT_SOURCE_COLUMN = next(k for k, v in COLUMN_MAPPING.items() if v == "Conta")
+
+
+class _AccountPrefixFilter(io.RawIOBase):
+    """
+    Stream binário que repassa ao pandas apenas o cabeçalho e as linhas cuja conta contábil
+    começa com um dos prefixos de ACCOUNT_PREFIX_FILTER (predicate push-down).
+    A maior parte dos balancetes não é do grupo 41, então o parser do pandas deixa de
+    tokenizar e alocar strings para linhas que seriam descartadas em seguida.
+    O filtro é conservador: só descarta uma linha que ele consegue tokenizar até a conta
+    (aspas balanceadas, campos bem formados) e cuja conta não tem o prefixo. Qualquer
+    linha ambígua passa, e o filtro definitivo continua sendo aplicado no chunk.
+    """
+    BLOCK_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, raw, sep, prefixes):
+        super().__init__()
+        self._raw = raw
+        self._eof = False
+        self._tail = b''
+        header = raw.readline()
+        self._out = header
+        self._pos = 0
+        self._match = self._build_matcher(header, sep.encode('ascii'), prefixes)
+
+    @staticmethod
+    def _build_matcher(header, sep, prefixes):
+        """
+        Predicado que decide se a linha passa: regex ancorada que pula os campos anteriores
+        à conta e testa o prefixo; sem o prefixo, a linha só é descartada se os campos
+        anteriores à conta foram tokenizados sem ambiguidade.
+        """
+        columns = [c.strip().strip(b'"').strip() for c in header.rstrip(b'\r\n').split(sep)]
+        try:
+            index = columns.index(ACCOUNT_SOURCE_COLUMN.encode('ascii'))
+        except ValueError:
+            return None # Layout desconhecido: não filtra, o chunk decide
+
+        s = re.escape(sep)
+        # Campo entre aspas (com "" escapado) ou campo simples sem aspas
+        field = rb'(?:"(?:[^"]|"")*"|[^"' + s + rb']*)'
+        alternatives = b'|'.join(re.escape(p.encode('ascii')) for p in prefixes)
+        skip = rb'(?:' + field + s + rb'){' + str(index).encode() + rb'}'
+        target = re.compile(skip + rb'[ \t]*"?[ \t]*(?:' + alternatives + rb')').match
+        parseable = re.compile(skip).match
+
+        def keep(line):
+            if target(line):
+                return True
+            # Aspas ímpares: registro partido por quebra de linha dentro de um campo
+            if line.count(b'"') % 2:
+                return True
+            return parseable(line) is None
+        return keep
+
+    def readable(self):
+        return True
+
+    def _fill(self):
+        block = self._raw.read(self.BLOCK_SIZE)
+        if not block:
+            self._eof = True
+            data, self._tail = self._tail, b''
+        else:
+            data = self._tail + block
+            cut = data.rfind(b'\n') + 1
+            data, self._tail = data[:cut], data[cut:]
+        if not data:
+            return
+        if self._match is None:
+            self._out, self._pos = data, 0
+            return
+
+        match = self._match
+        lines = data.split(b'\n')
+        kept = [line for line in lines if match(line)]
+        self._out, self._pos = (b'\n'.join(kept) + b'\n') if kept else b'', 0
+
+    def readinto(self, buffer):
+        while self._pos >= len(self._out):
+            if self._eof:
+                return 0
+            self._fill()
+        n = min(len(buffer), len(self._out) - self._pos)
+        buffer[:n] = self._out[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+
+def _consolidate_to_partition(source, dataset_root, part_name):
+    """
+    Tarefa executada em um processo worker: consolida UMA fonte gravando suas próprias
+    partes no dataset. Função de módulo para ser picklable.
+    Retorna (linhas gravadas, partições geradas).
+    """
+    consolidator = DataConsolidator(workers=1)
+    return consolidator._consolidate_source(source, PartitionedDataset(dataset_root), part_name)
+
 class DataConsolidator:
     """
-    Consolida múltiplos arquivos CSV/TXT brutos em um único arquivo padronizado.
+    Consolida múltiplos arquivos CSV/TXT brutos em um dataset padronizado e tipado,
+    particionado por Ano/Trimestre (o CSV consolidado é exportado em etapa separada).
     Realiza normalização de colunas, detecção de encoding e filtragem de contas contábeis.
     """
-    def __init__(self):
+    SAMPLE_SIZE = 8192
+
+    def __init__(self, workers=CONSOLIDATION_WORKERS):
         self.logger = logging.getLogger("ANS_ETL.Consolidator")
         self.output_file = OUTPUT_FILE
-    
-    def _identify_separator(self, filepath, encoding):
+        self.dataset = PartitionedDataset(CONSOLIDATED_DATASET_DIR)
+        self.file_handler = FileHandler()
+        self.workers = max(1, int(workers))
+
+    def _read_sample(self, source):
+        """Lê os primeiros bytes da fonte (arquivo em disco ou membro de ZIP)."""
+        with source.open() as f:
+            return f.read(self.SAMPLE_SIZE)
+
+    def _identify_separator(self, sample, encoding):
         try:
-            with open(filepath, 'r', encoding=encoding, errors='ignore') as f:
-                sample = f.read(4096)
-                if ';' in sample and sample.count(';') > sample.count(','): return ';'
-                sniffer = csv.Sniffer()
-                return sniffer.sniff(sample, delimiters=';,\t').delimiter
+            sample = sample.decode(encoding, errors='ignore')[:4096]
+            if ';' in sample and sample.count(';') > sample.count(','): return ';'
+            sniffer = csv.Sniffer()
+            return sniffer.sniff(sample, delimiters=';,\t').delimiter
         except: return ';'
     
-    def _detect_encoding(self, filepath):
+    def _detect_encoding(self, sample):
         try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                f.read(8192)
+            # final=False: um caractere multibyte cortado no fim da amostra não conta como erro
+            codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
             return 'utf-8'
         except UnicodeDecodeError:
             return 'cp1252'
 
-    def _is_valid_file(self, filename):
-        return filename.lower().endswith(('.csv', '.txt'))
-
     def _extract_date_info(self, filepath):
-        path_parts = filepath.split(os.sep)
+        path_parts = re.split(r'[\\/]', filepath)
         for part in path_parts:
             if 'T' in part and len(part) == 6 and part[0].isdigit():
                 return part[0], part[2:]
         return None, None
 
+    def _iter_source_frames(self, source, ano, trimestre):
+        """Lê uma fonte em chunks e gera os DataFrames já normalizados e filtrados."""
+        sample = self._read_sample(source)
+        encoding = self._detect_encoding(sample)
+        sep = self._identify_separator(sample, encoding)
+
+        with source.open() as stream:
+            if RAW_LINE_PREFILTER:
+                stream = io.BufferedReader(_AccountPrefixFilter(stream, sep, ACCOUNT_PREFIX_FILTER))
+
+            # Projeção: só as colunas que o COLUMN_MAPPING (ou a saída final) aproveita
+            chunks = pd.read_csv(
+                stream, sep=sep, encoding=encoding, 
+                chunksize=CHUNK_SIZE, dtype=str, on_bad_lines='skip',
+                usecols=lambda col: col in COLUMN_MAPPING or col in FINAL_COLUMNS
+            )
+
+            for chunk in chunks:
+                chunk.rename(columns=COLUMN_MAPPING, inplace=True)
+                if "Conta" not in chunk.columns: continue
+                chunk["Conta"] = chunk["Conta"].astype(str).str.strip()
+                
+                mask = chunk["Conta"].str.startswith(tuple(ACCOUNT_PREFIX_FILTER))
+                chunk = chunk[mask]
+                chunk = chunk[chunk["Conta"].str.len() == 9]
+
+                if chunk.empty or "Valor Despesas" not in chunk.columns: continue
+
+
+                if "Ano" not in chunk.columns and ano: chunk["Ano"] = ano
+                if "Trimestre" not in chunk.columns and trimestre: chunk["Trimestre"] = trimestre
+                
+                for col in FINAL_COLUMNS:
+                    if col not in chunk.columns: chunk[col] = ""
+
+                df_final = chunk[FINAL_COLUMNS].copy()
+
+                df_final["Valor Despesas"] = (
+                    df_final["Valor Despesas"]
+                    .astype(str).str.strip()
+                    .str.replace('.', '', regex=False)
+                    .str.replace(',', '.', regex=False)
+                )
+                df_final["Valor Despesas"] = pd.to_numeric(df_final["Valor Despesas"], errors='coerce')
+                df_final = df_final[(df_final["Valor Despesas"].notnull()) & (df_final["Valor Despesas"] != 0)]
+                
+                if "RegistroANS" in df_final.columns:
+                    df_final["RegistroANS"] = df_final["RegistroANS"].astype(str).str.replace(r'\.0$', '', regex=True)
+
+                if df_final.empty: continue
+                yield df_final
+
+    def _consolidate_source(self, source, dataset, part_name):
+        """
+        Consolida uma fonte e grava o resultado tipado nas partições Ano/Trimestre do dataset.
+        Retorna (linhas gravadas, partições (ano, trimestre) geradas).
+        """
+        trimestre, ano = self._extract_date_info(source.label)
+        frames = list(self._iter_source_frames(source, ano, trimestre))
+        if not frames:
+            return 0, []
+
+        df = pd.concat(frames, ignore_index=True)
+
+        # Tipagem do formato intermediário: período inteiro (chave de partição), valor float
+        df["Ano"] = pd.to_numeric(df["Ano"], errors='coerce')
+        df["Trimestre"] = pd.to_numeric(df["Trimestre"], errors='coerce')
+        sem_periodo = df["Ano"].isna() | df["Trimestre"].isna()
+        if sem_periodo.any():
+            self.logger.warning(f"{source.name}: {sem_periodo.sum()} linhas sem Ano/Trimestre identificável foram ignoradas.")
+            df = df[~sem_periodo]
+        df = df.astype({"Ano": "int64", "Trimestre": "int64", "Valor Despesas": "float64"})
+
+        # Campos vazios viram nulos (como na releitura do antigo CSV intermediário),
+        # para o enriquecimento tratar ausências com fillna
+        text_cols = [c for c in FINAL_COLUMNS if c not in ("Ano", "Trimestre", "Valor Despesas")]
+        df[text_cols] = df[text_cols].replace("", None)
+
+        partitions = []
+        for (ano_p, trimestre_p), group in df.groupby(["Ano", "Trimestre"], sort=True):
+            dataset.write_part(group, ano_p, trimestre_p, part_name)
+            partitions.append((int(ano_p), int(trimestre_p)))
+        return len(df), partitions
+
+    def begin(self, state=None, full_refresh=False):
+        """
+        Prepara a consolidação das fontes, que podem ser alimentadas aos poucos
+        (o pipeline sobreposto entrega os ZIPs à medida que chegam).
+
+        Args:
+            state (EtlState): Estado incremental. Sem estado, o dataset é refeito do zero.
+            full_refresh (bool): Ignora o estado e reconsolida todas as fontes.
+        """
+        self.logger.info("Iniciando consolidação...")
+        self.state = state
+        if state is None or full_refresh or state.is_empty:
+            # Sem histórico confiável: partes antigas (de outra nomenclatura) não podem sobrar
+            self.dataset.clear()
+            if state is not None:
+                state.reset()
+        self.files_processed = 0
+        self.files_skipped = 0
+        self.rows_written = 0
+        self.changed_partitions = set()
+        self._seen_keys = set()
+
+        # Modo paralelo: cada fonte é consolidada em um processo e grava sua própria parte
+        self._pool = None
+        self._pending = []
+        if self.workers > 1:
+            self.logger.info(f"Consolidação paralela com {self.workers} processos.")
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+
+    @staticmethod
+    def _part_name_for_key(key):
+        # Nome estável por fonte: a reconsolidação de uma fonte substitui só a sua parte,
+        # e a ordem dos nomes acompanha a ordem das fontes (leitura determinística)
+        return "part-" + re.sub(r'[^A-Za-z0-9._-]', '_', key)
+
+    @staticmethod
+    def _zip_stem_for_key(key):
+        """ZIP de origem de uma fonte (sem extensão): 'x.zip!membro' ou pasta extraída 'x/arquivo'."""
+        if '!' in key:
+            return os.path.splitext(key.split('!', 1)[0])[0]
+        return key.split('/', 1)[0]
+
+    def _part_name(self, source):
+        return self._part_name_for_key(source.key)
+
+    def _is_unchanged(self, source):
+        """Fonte já consolidada com o mesmo fingerprint e com todas as partes ainda no disco."""
+        if self.state is None:
+            return False
+        entry = self.state.source_entry(source.key)
+        if not entry or entry['fingerprint'] != source.fingerprint:
+            return False
+        part_name = self._part_name(source)
+        return all(self.dataset.has_part(ano, trimestre, part_name) for ano, trimestre in entry['partitions'])
+
+    def _discard_source(self, key, part_name):
+        """Remove as partes antigas de uma fonte, marcando suas partições como alteradas."""
+        entry = self.state.source_entry(key) if self.state is not None else None
+        if not entry:
+            return
+        for ano, trimestre in entry['partitions']:
+            self.dataset.delete_part(ano, trimestre, part_name)
+            self.changed_partitions.add((ano, trimestre))
+
+    def _source_done(self, source, result):
+        rows, partitions = result
+        self.rows_written += rows
+        self.files_processed += 1
+        self.changed_partitions.update(partitions)
+        if self.state is not None:
+            self.state.record_source(source.key, source.fingerprint, partitions)
+        if self.files_processed % 10 == 0:
+            self.logger.info(f"   ... processados: {self.files_processed}")
+
+    def add_sources(self, sources):
+        """
+        Consolida uma lista de fontes no dataset preparado por begin(), pulando as inalteradas.
+        Erro em uma fonte interrompe a execução: as partes antigas dela já foram removidas,
+        e carregar o trimestre sem as suas linhas seria perda silenciosa de dados (o estado
+        não é salvo, então a próxima execução refaz a fonte).
+        """
+        for source in sources:
+            self._seen_keys.add(source.key)
+            if self._is_unchanged(source):
+                self.files_skipped += 1
+                continue
+
+            part_name = self._part_name(source)
+            self._discard_source(source.key, part_name)
+            if self._pool is not None:
+                future = self._pool.submit(_consolidate_to_partition, source, self.dataset.root, part_name)
+                self._pending.append((source, future))
+                continue
 
+            try:
+                self._source_done(source, self._consolidate_source(source, self.dataset, part_name))
+            except Exception as e:
+                self.logger.error(f"Erro no arquivo {source.name}: {e}")
+                raise
+
+    def add_zip(self, zip_path):
+        """Consolida os arquivos de dados de um ZIP recém-baixado."""
+        self.add_sources(self.file_handler.sources_for_zip(zip_path))
 
+    def _wait_workers(self):
+        """Aguarda os processos workers; o primeiro erro por arquivo interrompe a consolidação."""
+        pending, self._pending = self._pending, []
+        for source, future in pending:
+            try:
+                self._source_done(source, future.result())
+            except Exception as e:
+                self.logger.error(f"Erro no arquivo {source.name}: {e}")
+                raise
 
+    def _shutdown_pool(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._pool = None
 
+    def abort(self):
+        """Interrompe a consolidação (erro no pipeline), encerrando os workers."""
+        self._shutdown_pool()
 
-    def process(self):
+    def finish(self, requested=None):
+        """
+        Aguarda as fontes pendentes e encerra a consolidação.
+
+        Args:
+            requested (list): Nomes dos ZIPs da janela de trimestres (pipeline sobreposto).
+                Fontes desses ZIPs que não chegaram nesta execução (download ou revalidação
+                falhou) são mantidas como estão; só saem as fontes de ZIPs fora da janela.
+                Sem a lista, toda fonte não vista nesta execução saiu da janela.
+        """
+        try:
+            self._wait_workers()
+        finally:
+            self._shutdown_pool()
+
+        # Fontes que saíram da janela de trimestres: remove suas partes do dataset
+        if self.state is not None:
+            kept = {os.path.splitext(name)[0] for name in (requested or [])}
+            for key in self.state.source_keys():
+                if key in self._seen_keys:
+                    continue
+                if self._zip_stem_for_key(key) in kept:
+                    self.logger.warning(f"Fonte {key} não atualizada nesta execução: partes anteriores mantidas.")
+                    continue
+                self._discard_source(key, self._part_name_for_key(key))
+                self.state.forget_source(key)
+
+        self.logger.info(
+            f"Consolidação Finalizada! {self.files_processed} arquivos processados, "
+            f"{self.files_skipped} inalterados, {self.rows_written} linhas em "
+            f"{len(self.dataset.partitions())} partições ({len(self.changed_partitions)} alteradas)."
+        )
+
+    def process(self, state=None, full_refresh=False, downloads=None):
         """
         Executa a consolidação dos arquivos:
-        1. Varre o diretório de processados.
+        1. Lista as fontes (membros dos ZIPs baixados ou pastas extraídas).
         2. Detecta metadados (Trimestre, Ano, Separador, Encoding).
         3. Lê em chunks para otimização de memória.
         4. Normaliza colunas e valores numéricos.
-        5. Salva incrementalmente no arquivo de saída.
+        5. Grava o resultado tipado no dataset particionado por Ano/Trimestre.
+
+        Com um EtlState, fontes com fingerprint inalterado são puladas e
+        `changed_partitions` indica os trimestres que precisam ser reprocessados.
+
+        Com `downloads` (resultado de ANSScraper.download_many), consolida só os ZIPs
+        baixados desta janela, como o pipeline sobreposto; sem ele, todo ZIP em disco.
         """
-        self.logger.info("Iniciando consolidação...")
-        
+        if downloads is None:
+            sources, requested = self.file_handler.list_sources(), None
+        else:
+            sources = [source for result in downloads if result['path']
+                       for source in self.file_handler.sources_for_zip(result['path'])]
+            requested = [result['filename'] for result in downloads]
+        self.begin(state=state, full_refresh=full_refresh)
+        self.logger.info(f"{len(sources)} arquivos de dados encontrados ({'stream dos ZIPs' if STREAM_FROM_ZIP else 'pastas extraídas'}).")
+
+        try:
+            self.add_sources(sources)
+        except Exception as e:
+            self.logger.critical(f"Erro fatal na consolidação: {e}")
+            self.abort()
+            raise
+
+        self.finish(requested=requested)
+
+    def export_csv(self):
+        """
+        Etapa final de entrega: exporta o dataset consolidado para o CSV
+        (consolidado_despesas.csv) e gera o ZIP correspondente.
+        """
+        self.logger.info(f"Exportando CSV consolidado: {self.output_file}")
+
         # Robust Delete (Fix para Windows)
         if os.path.exists(self.output_file):
             try:
@@ -69,87 +446,24 @@ class DataConsolidator:
                 time.sleep(0.5)
             except OSError:
                 pass
-        
-        header_written = False
-        files_processed = 0
 
-        # [OTIMIZAÇÃO] Abre o arquivo UMA VEZ e mantém aberto.
-        # Isso evita Race Conditions de File Lock no Windows e acelera o processo.
-        try:
-            with open(self.output_file, 'w', encoding='utf-8-sig', newline='') as f_out:
-                for root, dirs, files in os.walk(PROCESSED_DIR):
-                    for file in files:
-                        if not self._is_valid_file(file): continue
-                        if file.endswith('.zip'): continue
-
-                        filepath = os.path.join(root, file)
-                        trimestre, ano = self._extract_date_info(filepath)
-                        
-                        try:
-                            encoding = self._detect_encoding(filepath)
-                            sep = self._identify_separator(filepath, encoding)
-                            
-                            chunks = pd.read_csv(
-                                filepath, sep=sep, encoding=encoding, 
-                                chunksize=CHUNK_SIZE, dtype=str, on_bad_lines='skip'
-                            )
-
-                            for chunk in chunks:
-                                chunk.rename(columns=COLUMN_MAPPING, inplace=True)
-                                if "Conta" not in chunk.columns: continue
-                                chunk["Conta"] = chunk["Conta"].astype(str).str.strip()
-                                
-                                mask = chunk["Conta"].str.startswith(tuple(ACCOUNT_PREFIX_FILTER))
-                                chunk = chunk[mask]
-                                chunk = chunk[chunk["Conta"].str.len() == 9]
-
-                                if chunk.empty or "Valor Despesas" not in chunk.columns: continue
-
-
-                                if "Ano" not in chunk.columns and ano: chunk["Ano"] = ano
-                                if "Trimestre" not in chunk.columns and trimestre: chunk["Trimestre"] = trimestre
-                                
-                                for col in FINAL_COLUMNS:
-                                    if col not in chunk.columns: chunk[col] = ""
-
-                                df_final = chunk[FINAL_COLUMNS].copy()
-
-                                df_final["Valor Despesas"] = (
-                                    df_final["Valor Despesas"]
-                                    .astype(str).str.strip()
-                                    .str.replace('.', '', regex=False)
-                                    .str.replace(',', '.', regex=False)
-                                )
-                                df_final["Valor Despesas"] = pd.to_numeric(df_final["Valor Despesas"], errors='coerce')
-                                df_final = df_final[(df_final["Valor Despesas"].notnull()) & (df_final["Valor Despesas"] != 0)]
-                                
-                                if "RegistroANS" in df_final.columns:
-                                    df_final["RegistroANS"] = df_final["RegistroANS"].astype(str).str.replace(r'\.0$', '', regex=True)
-
-                                if df_final.empty: continue
-
-                                # Escreve no handle aberto
-                                df_final.to_csv(
-                                    f_out, header=not header_written, 
-                                    index=False, sep=';', 
-                                    quoting=csv.QUOTE_NONNUMERIC
-                                )
-                                header_written = True
-                            
-                            files_processed += 1
-                            if files_processed % 10 == 0:
-                                self.logger.info(f"   ... processados: {files_processed}")
-
-                        except Exception as e:
-                            self.logger.error(f"Erro no arquivo {file}: {e}")
-        except Exception as e:
-            self.logger.critical(f"Erro fatal na consolidação: {e}")
-            raise
+        # [OTIMIZAÇÃO] Abre o arquivo UMA VEZ e mantém aberto, escrevendo partição a partição.
+        # Isso evita Race Conditions de File Lock no Windows e mantém a memória limitada.
+        header_written = False
+        with open(self.output_file, 'w', encoding='utf-8-sig', newline='') as f_out:
+            for _, df in self.dataset.iter_partitions(columns=FINAL_COLUMNS):
+                if df.empty: continue
+                # Período como texto preserva o layout histórico do CSV (campos entre aspas)
+                df = df.astype({"Ano": str, "Trimestre": str})
+                df.to_csv(
+                    f_out, header=not header_written, 
+                    index=False, sep=';', 
+                    quoting=csv.QUOTE_NONNUMERIC
+                )
+                header_written = True
 
-        self.logger.info(f"Consolidação Finalizada! {files_processed} arquivos processados.")
-        
         # Compacta o arquivo resultante
         self.logger.info("Iniciando compactação do arquivo consolidado...")
         zip_name = os.path.basename(self.output_file).replace('.csv', '.zip')
         dest_zip = os.path.join(PROCESSED_DIR, zip_name)
-        FileCompressor.compress(self.output_file, dest_zip)
\ No newline at end of file
+        FileCompressor.compress(self.output_file, dest_zip)
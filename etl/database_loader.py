@@ -1,37 +1,88 @@
 import pandas as pd
 import logging
 import os
-from sqlalchemy import create_engine, text
-from config import ENRICHED_FILE, AGGREGATED_FILE, BASE_DIR, DATABASE_URL
+import io
+import re
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import bindparam, create_engine, text
+from sqlalchemy.engine import make_url
+from config import (
+    BASE_DIR, DATABASE_URL, ENRICHED_DATASET_DIR, CHUNK_SIZE, CUBE_ACCOUNT_PREFIX_LEN,
+    DB_MAINTENANCE_WORKERS, DB_MAINTENANCE_WORK_MEM, DB_LOAD_WORKERS
+)
+from .dataset import PartitionedDataset
+from .enrichment import DataEnricher
+from .aggregator import DataAggregator
 
 class DatabaseLoader:
     """
     Gerencia a carga de dados (Loading) para o banco de dados PostgreSQL.
     Configura tabelas via DDL e insere dados processados.
     """
+    # Índices secundários e FKs construídos só depois da carga em massa (schema.sql cria
+    # as tabelas sem eles): {nome: (tabela, colunas)} e {restrição: tabela}
+    DEFERRED_INDEXES = {
+        'idx_ops_uf': ('operadoras', 'uf'),
+        'idx_ops_razao': ('operadoras', 'razao_social'),
+        'idx_eventos_fk': ('despesas_eventos', 'registro_ans'),
+        'idx_cubo_uf': ('despesas_cubo', 'uf'),
+        'idx_cubo_operadora': ('despesas_cubo', 'registro_ans'),
+    }
+    DEFERRED_CONSTRAINTS = {
+        'fk_evento_operadora': 'despesas_eventos',
+        'fk_agregada_operadora': 'despesas_agregadas',
+        'fk_cubo_operadora': 'despesas_cubo',
+    }
+    LOADED_TABLES = ['operadoras', 'despesas_eventos', 'despesas_agregadas', 'despesas_cubo']
+    # Tabelas-sombra da carga completa: preenchidas ao lado das reais e trocadas por rename
+    SHADOW_SUFFIX = '_stg'
+    # Fato particionado por RANGE (ano, trimestre): uma partição por trimestre
+    PARTITIONED_TABLE = 'despesas_eventos'
+    # Visões materializadas do dashboard (schema.sql), atualizadas ao fim de cada carga
+    STORY_VIEWS = ['mv_story_macro', 'mv_story_movers', 'mv_story_geo', 'mv_story_consistencia']
+
     def __init__(self):
         self.logger = logging.getLogger("ANS_ETL.Loader")
         logging.getLogger('sqlalchemy.engine').setLevel(logging.WARNING)
         try:
-            self.engine = create_engine(DATABASE_URL, echo=False)
+            # Pool com folga para os workers da carga do fato + a conexão da transação principal
+            pool_args = {}
+            if make_url(DATABASE_URL).get_backend_name() == 'postgresql':
+                pool_args = {'pool_size': max(5, DB_LOAD_WORKERS + 2)}
+            self.engine = create_engine(DATABASE_URL, echo=False, **pool_args)
             self.logger.info(f"Conectado ao banco: {DATABASE_URL.split('@')[-1]}")
         except Exception as e:
             self.logger.critical(f"Erro ao configurar engine do banco: {e}")
             raise
+        self.is_postgres = self.engine.dialect.name == 'postgresql'
+        # COPY ... FROM STDIN só existe no PostgreSQL; outros bancos usam to_sql
+        self.use_copy = self.is_postgres and self.engine.dialect.driver in ('psycopg2', 'psycopg')
+        # Vazão por tabela: {tabela: [linhas, segundos]}
+        self._load_stats = {}
+        # Tabela física de cada tabela lógica durante a carga (sombra na carga completa)
+        self._targets = {}
+        # Trimestres do fato desta carga: {(ano, trimestre): tabela avulsa} e os substituídos
+        self._staged = {}
+        self._replaced = []
+        # COPYs do fato em andamento no pool de conexões
+        self._pool = None
+        self._pending = deque()
 
-    def init_db(self):
+    def init_db(self, full_refresh=False):
         """
         Executa o script DDL (Data Definition Language) para criar as tabelas.
         Lê o arquivo schema.sql e executa os comandos SQL.
+        O script é idempotente e nunca remove tabelas nem derruba sessões da API: no
+        reprocessamento completo as tabelas novas são montadas como sombra e trocadas
+        no fim da carga (ver process / _swap_shadow_tables).
         """
-        schema_path = os.path.join(BASE_DIR, "database", "schema.sql")
         self.logger.info("Inicializando estrutura do banco de dados (DDL)...")
-        if not os.path.exists(schema_path):
-             self.logger.error(f"Schema não encontrado: {schema_path}")
+        sql_script = self._read_schema()
+        if sql_script is None:
              return
-
-        with open(schema_path, 'r', encoding='utf-8') as f:
-            sql_script = f.read()
             
         try:
 
@@ -46,6 +97,9 @@ class DatabaseLoader:
                 
                 sql_script_formatted = sql_script.replace("{DB_READER_PWD}", db_pwd)
 
+                if full_refresh:
+                    self.logger.info("Reprocessamento completo: as tabelas serão reconstruídas como sombra e trocadas ao final.")
+
                 for statement in sql_script_formatted.split(';'):
                     if statement.strip():
                         try:
@@ -68,75 +122,225 @@ class DatabaseLoader:
             self.logger.error(f"Erro ao executar DDL: {e}")
             raise
 
+    def _read_schema(self):
+        schema_path = os.path.join(BASE_DIR, "database", "schema.sql")
+        if not os.path.exists(schema_path):
+            self.logger.error(f"Schema não encontrado: {schema_path}")
+            return None
+        with open(schema_path, 'r', encoding='utf-8') as f:
+            return f.read()
+
+    def requires_full_load(self):
+        """
+        True quando o banco é de uma versão anterior do schema: fato ainda sem partições ou
+        registro_ans ainda VARCHAR. A carga incremental só troca partições do schema atual,
+        então a próxima carga precisa ser completa (que recria as tabelas pelo schema.sql).
+        """
+        if not self.is_postgres:
+            return False
+        with self.engine.connect() as conn:
+            kind = conn.execute(
+                text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:tbl)"),
+                {'tbl': self.PARTITIONED_TABLE}
+            ).scalar()
+            key_type = conn.execute(
+                text("SELECT format_type(atttypid, atttypmod) FROM pg_attribute "
+                     "WHERE attrelid = to_regclass('operadoras') AND attname = 'registro_ans'")
+            ).scalar()
+        if kind is None:
+            return False
+        return kind != 'p' or key_type != 'integer'
+
     # --- FUNÇÃO NOVA: PADRONIZAÇÃO DE ID ---
     def _standardize_id(self, series):
         """
-        Garante que o Registro ANS seja sempre uma string limpa, sem zeros à esquerda
-        e sem '.0' decimal, para garantir o match entre tabelas.
-        Ex: '005711' vira '5711', '5711.0' vira '5711'.
+        Converte o Registro ANS na chave inteira usada em todas as tabelas.
+        Ex: '005711', '5711.0' e 5711 viram 5711.
         """
-        # 1. Remove ponto flutuante (.0) se houver
-        clean = series.astype(str).str.replace(r'\.0$', '', regex=True)
-        # 2. Converte para inteiro e volta para string (remove zeros à esquerda: "005711" -> "5711")
-        #    Usamos pd.to_numeric com errors='coerce' para evitar quebra em lixo
-        return pd.to_numeric(clean, errors='coerce').fillna(0).astype(int).astype(str)
+        # Mesma regra do DataAggregator: o grão dos agregados é este ID padronizado
+        return DataAggregator.standardize_registro(series)
 
-    def process(self, df_input=None):
+    def process(self, df_input=None, partitions=None, dimension=None, aggregator=None):
         """
         Orquestra o pipeline de carga:
-        1. Lê o arquivo CSV final (ou recebe DataFrame).
+        1. Lê o dataset enriquecido em blocos (ou recebe DataFrame / iterável de blocos).
         2. Padroniza IDs (RegistroANS).
         3. Carrega Operadoras (Dimensão).
         4. Carrega Despesas (Fato).
-        5. Calcula e Carrega Agregados (ELT).
+        5. Calcula os agregados uma única vez (DataAggregator.compute) e carrega o
+           resultado em despesas_agregadas, conferindo a tabela contra o DataFrame.
+        6. Monta o cubo analítico (despesas_cubo) a partir dos mesmos blocos do fato.
+        7. Anexa as partições do fato, constrói índices e FKs adiados, valida as
+           restrições e roda ANALYZE.
+        8. Atualiza as visões materializadas do dashboard (STORY_VIEWS) e grava a nova
+           versão dos dados em etl_versao (cache e ETags da API).
+        9. Após o commit, grava o mesmo DataFrame em despesas_agregadas.csv.
+
+        Os blocos são carregados à medida que chegam (ex: direto de
+        DataEnricher.iter_enriched), sem montar o histórico inteiro em memória.
+        A tabela operadoras recebe o cadastro completo de `dimension` (CADOP,
+        ver DataEnricher.load_dimension); o fato traz apenas a chave e os atributos
+        usados na agregação. Sem `dimension`, o CADOP é carregado aqui.
+
+        Sem `partitions` (carga completa, PostgreSQL), tudo é gravado em tabelas-sombra
+        (<tabela>_stg, criadas a partir do schema.sql) e trocado pelas reais com RENAME
+        na mesma transação: a API mantém as conexões e nunca vê a carga pela metade.
+
+        O fato é particionado por trimestre: cada trimestre é carregado numa tabela avulsa,
+        indexada e anexada a despesas_eventos no fim (ver _attach_partitions). As tabelas
+        avulsas recebem COPY em paralelo, até DB_LOAD_WORKERS conexões, cada uma na sua
+        transação: são rascunho fora do fato, e só a transação principal (que as anexa)
+        publica a carga. Uma falha em qualquer worker desfaz a carga inteira e as remove.
+
+        Com `partitions` (lista de (ano, trimestre)), a carga é incremental: só esses
+        trimestres são substituídos em despesas_eventos (troca de partição, sem DELETE)
+        e em despesas_cubo. Os agregados vêm do dataset
+        enriquecido completo (não de uma releitura do fato no banco) e substituem a
+        tabela inteira, que tem uma linha por operadora. Tudo roda em uma única transação.
+
+        Retorna:
+            bool: True se a carga foi concluída.
         """
         self.logger.info("Iniciando Pipeline de Carga (ETL -> SQL)...")
 
         try:
             if df_input is None:
-                if not os.path.exists(ENRICHED_FILE):
-                    self.logger.error("Arquivo enriquecido não encontrado.")
-                    return
-                
-                self.logger.info("Lendo arquivo enriquecido...")
-                df = pd.read_csv(ENRICHED_FILE, sep=';', encoding='utf-8-sig', dtype=str)
-            else:
+                self.logger.info("Lendo dataset enriquecido...")
+                dataset = PartitionedDataset(ENRICHED_DATASET_DIR)
+                chunks = (df for _, df in dataset.iter_chunks(partitions=partitions, chunk_rows=CHUNK_SIZE))
+            elif isinstance(df_input, pd.DataFrame):
                 self.logger.info("Usando DataFrame em memória para carga.")
-                df = df_input.copy() # Copia para segurança
-            
-            # --- PADRONIZAÇÃO CRÍTICA DO ID ---
-            df['RegistroANS'] = self._standardize_id(df['RegistroANS'])
-            
-            # Tratamento de Tipos
-            df['Valor Despesas'] = df['Valor Despesas'].str.replace(',', '.', regex=False)
-            df['Valor Despesas'] = pd.to_numeric(df['Valor Despesas'], errors='coerce').fillna(0)
-            df['Ano'] = pd.to_numeric(df['Ano'], errors='coerce')
-            df['Trimestre'] = pd.to_numeric(df['Trimestre'], errors='coerce')
+                chunks = [df_input.copy()] # Copia para segurança
+            else:
+                self.logger.info("Carregando blocos recebidos em streaming.")
+                chunks = df_input
+
+            if dimension is None:
+                dimension = DataEnricher().load_dimension()
+            dimension = self._prepare_dimension(dimension)
+            if aggregator is None:
+                aggregator = DataAggregator()
+            self._load_stats = {}
+
+            swap = partitions is None and self.is_postgres
+            with self.engine.begin() as conn, ThreadPoolExecutor(max_workers=DB_LOAD_WORKERS) as pool:
+                self._pool = pool
+                if swap:
+                    # Sombras nuas: carrega sem manter índices nem checar FKs linha a linha
+                    self._create_shadow_tables(conn)
+                elif partitions is None:
+                    self._truncate(['despesas_cubo', 'despesas_agregadas', 'despesas_eventos', 'operadoras'], conn)
+                else:
+                    self.logger.info(f"Carga incremental: {len(partitions)} trimestres alterados.")
+                    self._clear_partitions(partitions, conn)
+                    self._backfill_cubo(conn)
+
+                self.logger.info("Carregando tabelas: OPERADORAS e DESPESAS_EVENTOS...")
+                loaded_ops = set()
+                cube_parts = []
+                rows = 0
+                for chunk in chunks:
+                    if chunk.empty: continue
+                    df = self._prepare_chunk(chunk)
+                    # Operadoras novas antes das despesas que as referenciam (FK)
+                    self._upsert_operadoras(self._new_operators(df, dimension, loaded_ops), conn)
+                    self._load_despesas(df, conn)
+                    # Rollup do bloco para o cubo (pequeno: operadora x trimestre x conta)
+                    cube_parts.append(aggregator.cube_partial(df))
+                    rows += len(df)
+                self._wait_loads()
+
+                if partitions is None and rows == 0:
+                    # Levanta para desfazer o TRUNCATE: o banco continua com a carga anterior
+                    raise ValueError("Dataset enriquecido não encontrado.")
+                self.logger.info(f"{rows} linhas de despesas carregadas.")
 
-            self._load_operadoras(df)
-            self._load_despesas(df)
-            self._load_agregadas()
+                # O dataset enriquecido já está completo: agrega uma vez para banco e CSV
+                stats = aggregator.compute(partitions=partitions)
+                if stats is None:
+                    raise ValueError("Agregação sem dados.")
+                self._load_agregadas(stats, conn)
+                self._load_cubo(aggregator.merge_cube(cube_parts), conn)
+                self._attach_partitions(conn)
+                self._build_deferred(conn)
+                if swap:
+                    self._swap_shadow_tables(conn)
+                else:
+                    self._refresh_views(conn)
+                self._stamp_data_version(conn)
 
+            aggregator.save(stats)
+            self._log_load_stats()
             self.logger.info("✅ Pipeline de Banco de Dados finalizado com sucesso!")
+            return True
 
         except Exception as e:
             self.logger.critical(f"Falha fatal durante a carga no banco: {e}")
+            self._drop_staged()
+            return False
+        finally:
+            self._targets = {}
+            self._staged = {}
+            self._replaced = []
+            self._pool = None
+            self._pending.clear()
+
+    def _prepare_chunk(self, df):
+        """Padroniza ID e tipos de um bloco do dataset enriquecido."""
+        df = df.copy()
+        # Chave como veio do enriquecimento: é ela que casa com o CADOP
+        df['_chave_cadop'] = df['RegistroANS']
+        # --- PADRONIZAÇÃO CRÍTICA DO ID ---
+        df['RegistroANS'] = self._standardize_id(df['RegistroANS'])
+
+        # Tratamento de Tipos (o dataset intermediário já traz o valor como float)
+        if not pd.api.types.is_numeric_dtype(df['Valor Despesas']):
+            df['Valor Despesas'] = df['Valor Despesas'].str.replace(',', '.', regex=False)
+        df['Valor Despesas'] = pd.to_numeric(df['Valor Despesas'], errors='coerce').fillna(0)
+        # Inteiro anulável: o COPY não aceita '2025.0' em coluna INTEGER
+        df['Ano'] = pd.to_numeric(df['Ano'], errors='coerce').astype('Int64')
+        df['Trimestre'] = pd.to_numeric(df['Trimestre'], errors='coerce').astype('Int64')
+        return df
+
+    # Atributos da operadora que já vêm no fato enriquecido (valores pós-join, com fallback)
+    FACT_OPERATOR_COLUMNS = ['RegistroANS', 'CNPJ', 'RazaoSocial', 'Modalidade', 'UF']
+    # Atributos cadastrais que vêm direto da dimensão (CADOP)
+    DIMENSION_COLUMNS = [
+        'Nome_Fantasia', 'Logradouro', 'Numero', 'Complemento', 'Bairro', 'Cidade', 'CEP',
+        'DDD', 'Telefone', 'Fax', 'Endereco_eletronico', 'Representante', 'Cargo_Representante',
+        'Regiao_de_Comercializacao', 'Data_Registro_ANS'
+    ]
+
+    def _prepare_dimension(self, dimension):
+        """Atributos cadastrais do CADOP indexados pela chave original do join."""
+        if dimension is None:
+            return None
+        cols = ['RegistroANS'] + [c for c in self.DIMENSION_COLUMNS if c in dimension.columns]
+        return dimension[cols].rename(columns={'RegistroANS': '_chave_cadop'})
+
+    def _new_operators(self, df, dimension, loaded):
+        """
+        Monta as linhas da tabela operadoras para os registros do bloco ainda não gravados
+        nesta carga. Só as operadoras novas são deduplicadas (primeira ocorrência no fato)
+        e o cadastro completo vem da dimensão, sem carregar o endereço em cada despesa.
+        """
+        df_ops = df.loc[~df['RegistroANS'].isin(loaded)]
+        if df_ops.empty:
+            return df_ops
+        cols = ['_chave_cadop'] + [c for c in self.FACT_OPERATOR_COLUMNS if c in df_ops.columns]
+        df_ops = df_ops[cols].drop_duplicates(subset=['RegistroANS'])
+        loaded.update(df_ops['RegistroANS'])
+
+        if dimension is not None:
+            df_ops = df_ops.merge(dimension, on='_chave_cadop', how='left')
+        df_ops = df_ops.drop(columns=['_chave_cadop'])
 
-    def _load_operadoras(self, df):
-        self.logger.info("Carregando tabela: OPERADORAS...")
-        cols_ops = [
-            'RegistroANS', 'CNPJ', 'RazaoSocial', 'Modalidade', 'UF',
-            'Nome_Fantasia', 'Logradouro', 'Numero', 'Complemento', 'Bairro', 'Cidade', 'CEP',
-            'DDD', 'Telefone', 'Fax', 'Endereco_eletronico', 'Representante', 'Cargo_Representante',
-            'Regiao_de_Comercializacao', 'Data_Registro_ANS'
-        ]
         # Garante que as colunas existem (caso o enriquecimento tenha falhado parcialmente)
-        for col in cols_ops:
-            if col not in df.columns:
-                df[col] = None
+        for col in self.FACT_OPERATOR_COLUMNS + self.DIMENSION_COLUMNS:
+            if col not in df_ops.columns:
+                df_ops[col] = None
+        df_ops = df_ops[self.FACT_OPERATOR_COLUMNS + self.DIMENSION_COLUMNS].copy()
 
-        df_ops = df[cols_ops].drop_duplicates(subset=['RegistroANS']).copy()
-        
         # Tratamento de CNPJ nulo
         df_ops['CNPJ'] = df_ops['CNPJ'].fillna('00.000.000/0000-00')
         df_ops.loc[df_ops['CNPJ'].str.strip() == '', 'CNPJ'] = '00.000.000/0000-00'
@@ -151,10 +355,59 @@ class DatabaseLoader:
             'Regiao_de_Comercializacao': 'regiao_comercializacao', 'Data_Registro_ANS': 'data_registro_ans'
         }
         df_ops.rename(columns=rename_ops, inplace=True)
-        df_ops.to_sql('operadoras', self.engine, if_exists='append', index=False, method='multi', chunksize=1000)
+        return df_ops
+
+    def _upsert_operadoras(self, df_ops, conn):
+        """
+        Insere operadoras novas e atualiza o cadastro das existentes.
+        No PostgreSQL o bloco entra por COPY numa tabela temporária e o upsert é um único
+        INSERT ... SELECT ... ON CONFLICT; nos demais bancos, executemany parametrizado.
+        """
+        if df_ops.empty:
+            return
+        start = time.perf_counter()
+        cols = list(df_ops.columns)
+        col_list = ', '.join(cols)
+        updates = ", ".join(f"{c} = EXCLUDED.{c}" for c in cols if c != 'registro_ans')
+        conflict = f"ON CONFLICT (registro_ans) DO UPDATE SET {updates}, data_atualizacao = CURRENT_TIMESTAMP"
+
+        table = self._table('operadoras')
 
-    def _load_despesas(self, df):
-        self.logger.info("Carregando tabela: DESPESAS_EVENTOS...")
+        if self.use_copy:
+            conn.execute(text(
+                f"CREATE TEMP TABLE IF NOT EXISTS tmp_operadoras (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP"
+            ))
+            conn.execute(text("TRUNCATE tmp_operadoras"))
+            self._copy_frame(df_ops, 'tmp_operadoras', conn)
+            conn.execute(text(f"INSERT INTO {table} ({col_list}) SELECT {col_list} FROM tmp_operadoras {conflict}"))
+        else:
+            stmt = text(f"INSERT INTO {table} ({col_list}) VALUES ({', '.join(':' + c for c in cols)}) {conflict}")
+            records = df_ops.astype(object).where(df_ops.notna(), None).to_dict('records')
+            conn.execute(stmt, records)
+        self._record_load('operadoras', len(df_ops), time.perf_counter() - start)
+
+    def _clear_partitions(self, partitions, conn):
+        """
+        Remove de despesas_cubo os trimestres que serão recarregados. No PostgreSQL as
+        partições do fato são descartadas inteiras em _attach_partitions; nos demais
+        bancos o fato é uma tabela comum e os trimestres saem por DELETE.
+        """
+        self._replaced = [(int(ano), int(trimestre)) for ano, trimestre in partitions]
+        for ano, trimestre in self._replaced:
+            params = {'ano': ano, 'trimestre': trimestre}
+            if not self.is_postgres:
+                conn.execute(text("DELETE FROM despesas_eventos WHERE ano = :ano AND trimestre = :trimestre"), params)
+            conn.execute(text("DELETE FROM despesas_cubo WHERE ano = :ano AND trimestre = :trimestre"), params)
+
+    def _truncate(self, tables, conn):
+        """Esvazia as tabelas na transação corrente (o SQLite não tem TRUNCATE: usa DELETE)."""
+        if self.is_postgres:
+            conn.execute(text(f"TRUNCATE TABLE {', '.join(tables)}"))
+            return
+        for table in tables:
+            conn.execute(text(f"DELETE FROM {table}"))
+
+    def _load_despesas(self, df, conn):
         cols_fact = ['RegistroANS', 'Ano', 'Trimestre', 'Conta', 'Descricao', 'Valor Despesas']
         df_fact = df[cols_fact].copy()
         
@@ -164,37 +417,396 @@ class DatabaseLoader:
             'Valor Despesas': 'valor'
         }
         df_fact.rename(columns=rename_fact, inplace=True)
-        df_fact.to_sql('despesas_eventos', self.engine, if_exists='append', index=False, method='multi', chunksize=5000)
+        table = self._table(self.PARTITIONED_TABLE)
+        if not self.is_postgres:
+            self._bulk_insert(df_fact, table, conn)
+            return
 
-    def _load_agregadas(self):
-        self.logger.info("Carregando tabela: DESPESAS_AGREGADAS (Via SQL)...")
-        
-        # ELT: Transformação dentro do banco para máxima performance
-        query_elt = text("""
-            TRUNCATE TABLE despesas_agregadas;
-            
-            INSERT INTO despesas_agregadas (registro_ans, total_despesas, media_trimestral, desvio_padrao, qtde_trimestres, data_processamento)
-            WITH trimestral AS (
-                SELECT registro_ans, ano, trimestre, SUM(valor) as total
-                FROM despesas_eventos
-                GROUP BY registro_ans, ano, trimestre
+        # Cada trimestre vai para a sua tabela avulsa, carregada por uma conexão do pool
+        for (ano, trimestre), part in df_fact.groupby(['ano', 'trimestre'], sort=False):
+            stage = self._stage_partition(ano, trimestre)
+            self._pending.append(self._pool.submit(self._copy_partition, part, stage))
+        # Limita os blocos em memória aguardando COPY
+        self._wait_loads(limit=2 * DB_LOAD_WORKERS)
+
+    def _load_agregadas(self, stats, conn):
+        """
+        Carrega em despesas_agregadas as estatísticas calculadas pelo DataAggregator
+        (as mesmas gravadas no CSV) e confere a tabela contra o DataFrame:
+        nº de linhas e soma de total_despesas. Divergência desfaz a transação.
+        """
+        self.logger.info("Carregando tabela: DESPESAS_AGREGADAS (DataAggregator)...")
+        df_agg = stats[['RegistroANS', 'Total_Despesas', 'Media_Trimestral', 'Desvio_Padrao', 'Qtde_Trimestres']].copy()
+        df_agg['RegistroANS'] = self._standardize_id(df_agg['RegistroANS'])
+        df_agg.rename(columns={
+            'RegistroANS': 'registro_ans', 'Total_Despesas': 'total_despesas',
+            'Media_Trimestral': 'media_trimestral', 'Desvio_Padrao': 'desvio_padrao',
+            'Qtde_Trimestres': 'qtde_trimestres'
+        }, inplace=True)
+        # Grão: uma linha por registro_ans. Duplicata indica agregação por outra chave
+        duplicados = df_agg['registro_ans'][df_agg['registro_ans'].duplicated()].unique()
+        if len(duplicados):
+            raise ValueError(
+                f"Agregados com registro_ans duplicado ({len(duplicados)} operadoras, "
+                f"ex.: {duplicados[:5].tolist()})"
+            )
+
+        table = self._table('despesas_agregadas')
+        self._truncate([table], conn)
+        self._bulk_insert(df_agg, table, conn)
+
+        # Verificação de consistência tabela x CSV (tabela pequena: uma linha por operadora)
+        db_rows, db_total = conn.execute(
+            text(f"SELECT COUNT(*), COALESCE(SUM(total_despesas), 0) FROM {table}")
+        ).one()
+        expected_total = round(float(df_agg['total_despesas'].sum()), 2)
+        if db_rows != len(df_agg) or abs(float(db_total) - expected_total) > 0.01:
+            raise ValueError(
+                f"Agregados divergentes: banco {db_rows} linhas / {float(db_total):.2f}, "
+                f"CSV {len(df_agg)} linhas / {expected_total:.2f}"
             )
-            SELECT 
-                registro_ans,
-                COALESCE(SUM(total), 0),
-                COALESCE(AVG(total), 0),
-                COALESCE(STDDEV(total), 0),
-                COUNT(*),
-                NOW()
-            FROM trimestral
-            GROUP BY registro_ans;
-        """)
+        self.logger.info(f"✅ Tabela Agregada carregada e conferida ({db_rows} operadoras).")
 
+    def _backfill_cubo(self, conn):
+        """
+        Banco carregado antes da existência do cubo: monta-o uma vez a partir do fato
+        já gravado, sem os trimestres desta carga (_clear_partitions), que entram pelo
+        fluxo normal. No PostgreSQL as partições deles ainda estão no fato até
+        _attach_partitions, por isso o filtro explícito.
+        """
+        if conn.execute(text("SELECT EXISTS (SELECT 1 FROM despesas_cubo)")).scalar():
+            return
+        if not conn.execute(text("SELECT EXISTS (SELECT 1 FROM despesas_eventos)")).scalar():
+            return
+        self.logger.info("Cubo analítico vazio: construindo a partir de DESPESAS_EVENTOS (uma única vez)...")
+        # Período como ano*10 + trimestre: um único NOT IN com os trimestres substituídos
+        periodos = [ano * 10 + trimestre for ano, trimestre in self._replaced] or [0]
+        conn.execute(text("""
+            INSERT INTO despesas_cubo (registro_ans, ano, trimestre, conta_prefixo, uf, modalidade, valor, qtd_lancamentos)
+            SELECT d.registro_ans, d.ano, d.trimestre,
+                   SUBSTR(TRIM(COALESCE(d.conta_contabil, '')), 1, :prefixo),
+                   MAX(o.uf), MAX(o.modalidade), SUM(d.valor), COUNT(*)
+            FROM despesas_eventos d
+            LEFT JOIN operadoras o ON o.registro_ans = d.registro_ans
+            WHERE d.ano * 10 + d.trimestre NOT IN :periodos
+            GROUP BY 1, 2, 3, 4
+        """).bindparams(bindparam('periodos', expanding=True)),
+            {'prefixo': CUBE_ACCOUNT_PREFIX_LEN, 'periodos': periodos})
+
+    def _load_cubo(self, cube, conn):
+        """
+        Carrega o cubo analítico dos trimestres desta carga (os demais já estão na tabela).
+        A API lê dele os KPIs de mercado, UF, crescimento e consistência sem varrer o fato.
+        """
+        if cube is None:
+            return
+        self.logger.info(f"Carregando tabela: DESPESAS_CUBO ({len(cube)} células)...")
+        df_cube = cube.rename(columns={
+            'RegistroANS': 'registro_ans', 'Ano': 'ano', 'Trimestre': 'trimestre',
+            'ContaPrefixo': 'conta_prefixo', 'UF': 'uf', 'Modalidade': 'modalidade',
+            'Valor': 'valor', 'Lancamentos': 'qtd_lancamentos'
+        })
+        self._bulk_insert(df_cube, self._table('despesas_cubo'), conn)
+
+    # --- Partições do fato ---
+    def _partition_name(self, ano, trimestre):
+        return f"{self.PARTITIONED_TABLE}_{int(ano)}_t{int(trimestre)}"
+
+    def _stage_partition(self, ano, trimestre):
+        """
+        Tabela avulsa que recebe o trimestre, criada e confirmada em transação própria para
+        ser visível às conexões do pool. Usa a definição do fato no schema.sql, sem a cláusula
+        de partição: a sombra ainda não foi confirmada e o fato publicado pode ser de uma
+        versão anterior do schema. A PK sai logo após o CREATE e volta depois do COPY.
+        """
+        key = (int(ano), int(trimestre))
+        stage = self._staged.get(key)
+        if stage is None:
+            stage = f"{self._partition_name(*key)}{self.SHADOW_SUFFIX}"
+            columns = re.sub(
+                r'\s*PARTITION BY\s.*$', '', self._schema_tables()[self.PARTITIONED_TABLE],
+                flags=re.DOTALL | re.IGNORECASE
+            )
+            with self.engine.begin() as ddl:
+                ddl.execute(text(f"DROP TABLE IF EXISTS {stage}"))
+                ddl.execute(text(f"CREATE TABLE {stage}{columns}"))
+                ddl.execute(text(f"ALTER TABLE {stage} DROP CONSTRAINT {stage}_pkey"))
+            self._staged[key] = stage
+        return stage
+
+    def _copy_partition(self, df, stage):
+        """Executada no pool: COPY de um bloco do trimestre, na transação da conexão do worker."""
+        start = time.perf_counter()
+        with self.engine.begin() as conn:
+            self._copy_frame(df, stage, conn)
+        return len(df), time.perf_counter() - start
+
+    def _wait_loads(self, limit=0):
+        """Aguarda os COPYs em andamento até restarem `limit`; o erro de um worker sobe daqui."""
+        while len(self._pending) > limit:
+            rows, seconds = self._pending.popleft().result()
+            self._record_load(self._table(self.PARTITIONED_TABLE), rows, seconds)
+
+    def _drop_staged(self):
+        """Remove as tabelas avulsas de uma carga abortada (foram confirmadas fora da transação)."""
+        if not self._staged:
+            return
         try:
-            with self.engine.connect() as conn:
-                conn.execute(query_elt)
-                conn.commit()
-            self.logger.info("✅ Tabela Agregada calculada com sucesso via SQL.")
+            with self.engine.begin() as conn:
+                for stage in self._staged.values():
+                    conn.execute(text(f"DROP TABLE IF EXISTS {stage}"))
         except Exception as e:
-            self.logger.error(f"Erro ao calcular agregados via SQL: {e}")
-            raise 
\ No newline at end of file
+            self.logger.warning(f"Tabelas avulsas da carga não removidas: {e}")
+
+    def _attach_partitions(self, conn):
+        """
+        Anexa ao fato os trimestres carregados nesta execução.
+        Antes do ATTACH cada tabela avulsa recebe PK, índice e FK equivalentes aos do fato
+        (o PostgreSQL adota os existentes em vez de reconstruí-los) e um CHECK do período,
+        que dispensa a varredura de validação: com o fato bloqueado, só sobram operações
+        de catálogo. Na carga incremental a partição anterior do trimestre é descartada
+        com DROP, e a nova assume o nome dela. Na carga completa as partições são anexadas
+        ao fato-sombra e renomeadas na troca (_swap_shadow_tables).
+        """
+        if not self.is_postgres:
+            return
+        start = time.perf_counter()
+        parent = self._table(self.PARTITIONED_TABLE)
+        operadoras = self._table('operadoras')
+        for (ano, trimestre), stage in self._staged.items():
+            conn.execute(text(f"ALTER TABLE {stage} ADD CONSTRAINT {stage}_pkey PRIMARY KEY (ano, trimestre, id)"))
+            conn.execute(text(f"CREATE INDEX {stage}_registro_ans_idx ON {stage}(registro_ans)"))
+            conn.execute(text(
+                f"ALTER TABLE {stage} ADD CONSTRAINT periodo_particao CHECK (ano = {ano} AND trimestre = {trimestre})"
+            ))
+            conn.execute(text(
+                f"ALTER TABLE {stage} ADD CONSTRAINT fk_evento_operadora FOREIGN KEY (registro_ans) "
+                f"REFERENCES {operadoras}(registro_ans) ON DELETE CASCADE NOT VALID"
+            ))
+            conn.execute(text(f"ALTER TABLE {stage} VALIDATE CONSTRAINT fk_evento_operadora"))
+
+        if not self._targets:
+            # Trimestres substituídos (inclusive os que deixaram de existir na fonte)
+            for ano, trimestre in sorted(set(self._replaced) | set(self._staged)):
+                conn.execute(text(f"DROP TABLE IF EXISTS {self._partition_name(ano, trimestre)}"))
+        for (ano, trimestre), stage in sorted(self._staged.items()):
+            partition = stage if self._targets else self._rename_partition(stage, ano, trimestre, conn)
+            conn.execute(text(
+                f"ALTER TABLE {parent} ATTACH PARTITION {partition} "
+                f"FOR VALUES FROM ({ano}, {trimestre}) TO ({ano}, {trimestre + 1})"
+            ))
+            # Redundante com a restrição da partição
+            conn.execute(text(f"ALTER TABLE {partition} DROP CONSTRAINT periodo_particao"))
+        if self._staged:
+            self.logger.info(
+                f"{len(self._staged)} partições de DESPESAS_EVENTOS anexadas em {time.perf_counter() - start:.1f}s."
+            )
+
+    def _rename_partition(self, stage, ano, trimestre, conn):
+        """Dá à tabela avulsa (e à sua PK e índice) o nome definitivo da partição."""
+        partition = self._partition_name(ano, trimestre)
+        conn.execute(text(f"ALTER TABLE {stage} RENAME TO {partition}"))
+        conn.execute(text(f"ALTER TABLE {partition} RENAME CONSTRAINT {stage}_pkey TO {partition}_pkey"))
+        conn.execute(text(f"ALTER INDEX {stage}_registro_ans_idx RENAME TO {partition}_registro_ans_idx"))
+        return partition
+
+    # --- Carga em massa ---
+    def _copy_frame(self, df, table, conn):
+        """
+        Grava o DataFrame na tabela pela conexão da transação corrente.
+        PostgreSQL: COPY ... FROM STDIN (CSV) a partir de um buffer em memória, sem
+        arquivo temporário. Outros bancos: to_sql com INSERT multi-valores.
+        """
+        if not self.use_copy:
+            df.to_sql(table, conn, if_exists='append', index=False, method='multi', chunksize=5000)
+            return
+
+        buffer = io.StringIO()
+        df.to_csv(buffer, index=False, header=False, na_rep='\\N')
+        buffer.seek(0)
+        copy_sql = f"COPY {table} ({', '.join(df.columns)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')"
+
+        # Cursor DBAPI da mesma conexão: o COPY participa da transação do engine.begin()
+        cursor = conn.connection.cursor()
+        try:
+            if self.engine.dialect.driver == 'psycopg2':
+                cursor.copy_expert(copy_sql, buffer)
+            else:
+                with cursor.copy(copy_sql) as copy:
+                    copy.write(buffer.getvalue())
+        finally:
+            cursor.close()
+
+    def _bulk_insert(self, df, table, conn):
+        """Carga em massa de uma tabela, contabilizando a vazão."""
+        if df.empty:
+            return
+        start = time.perf_counter()
+        self._copy_frame(df, table, conn)
+        self._record_load(table, len(df), time.perf_counter() - start)
+
+    def _record_load(self, table, rows, seconds):
+        totals = self._load_stats.setdefault(table, [0, 0.0])
+        totals[0] += rows
+        totals[1] += seconds
+
+    def _log_load_stats(self):
+        """Resumo de linhas/s por tabela (COPY no PostgreSQL, to_sql nos demais)."""
+        method = "COPY" if self.use_copy else "to_sql"
+        self.logger.info("Vazão da carga por tabela:")
+        for table, (rows, seconds) in self._load_stats.items():
+            rate = rows / seconds if seconds > 0 else 0.0
+            self.logger.info(f"   {table}: {rows} linhas em {seconds:.1f}s ({rate:,.0f} linhas/s, {method})")
+
+    # --- Índices e restrições adiados ---
+    def _build_deferred(self, conn):
+        """
+        Constrói (ou confirma) os índices e FKs depois da carga, com workers paralelos de
+        manutenção, valida as FKs em uma única varredura e atualiza as estatísticas do
+        planner com ANALYZE. Idempotente: na carga incremental só falta o ANALYZE.
+        Nas tabelas-sombra os índices recebem o sufixo da sombra até a troca.
+        """
+        if not self.is_postgres:
+            return
+        start = time.perf_counter()
+        self.logger.info("Construindo índices e restrições (pós-carga)...")
+        # SET LOCAL vale só para esta transação
+        conn.execute(text(f"SET LOCAL max_parallel_maintenance_workers = {int(DB_MAINTENANCE_WORKERS)}"))
+        conn.execute(text("SELECT set_config('maintenance_work_mem', :mem, true)"), {'mem': DB_MAINTENANCE_WORK_MEM})
+
+        suffix = self.SHADOW_SUFFIX if self._targets else ''
+        for index, (table, columns) in self.DEFERRED_INDEXES.items():
+            conn.execute(text(f"CREATE INDEX IF NOT EXISTS {index}{suffix} ON {self._table(table)}({columns})"))
+
+        operadoras = self._table('operadoras')
+        for constraint, table in self.DEFERRED_CONSTRAINTS.items():
+            table = self._table(table)
+            exists = conn.execute(
+                text("SELECT 1 FROM pg_constraint WHERE conname = :name AND conrelid = CAST(:tbl AS regclass)"),
+                {'name': constraint, 'tbl': table}
+            ).first()
+            if exists:
+                continue
+            add_fk = (
+                f"ALTER TABLE {table} ADD CONSTRAINT {constraint} FOREIGN KEY (registro_ans) "
+                f"REFERENCES {operadoras}(registro_ans) ON DELETE CASCADE"
+            )
+            if table == self._table(self.PARTITIONED_TABLE):
+                # Tabela particionada não aceita NOT VALID; as partições já trazem a FK
+                # validada (_attach_partitions) e o PostgreSQL apenas a adota
+                conn.execute(text(add_fk))
+                continue
+            # NOT VALID + VALIDATE: a verificação é uma junção em lote, não um lookup por linha
+            conn.execute(text(f"{add_fk} NOT VALID"))
+            conn.execute(text(f"ALTER TABLE {table} VALIDATE CONSTRAINT {constraint}"))
+
+        for table in self.LOADED_TABLES:
+            conn.execute(text(f"ANALYZE {self._table(table)}"))
+        self.logger.info(f"Índices, FKs e estatísticas prontos em {time.perf_counter() - start:.1f}s.")
+
+    # --- Troca atômica das tabelas-sombra (carga completa) ---
+    def _table(self, name):
+        """Tabela física que recebe os dados da tabela lógica `name` nesta carga."""
+        return self._targets.get(name, name)
+
+    def _schema_tables(self):
+        """{tabela: definição} dos CREATE TABLE do schema.sql (o trecho após o nome)."""
+        ddl = {}
+        for statement in (self._read_schema() or '').split(';'):
+            match = re.search(r'CREATE TABLE IF NOT EXISTS\s+(\w+)', statement, re.IGNORECASE)
+            if match:
+                ddl[match.group(1)] = statement[match.end():]
+        return ddl
+
+    def _create_views(self, conn):
+        """Cria (se faltarem) as visões materializadas e seus índices a partir do schema.sql."""
+        for statement in (self._read_schema() or '').split(';'):
+            if 'mv_story_' in statement and 'CREATE' in statement:
+                conn.execute(text(statement))
+
+    def _refresh_views(self, conn):
+        """
+        Atualiza as visões do dashboard na transação da carga: publicadas no mesmo commit
+        que os dados. CONCURRENTLY mantém a versão anterior legível pela API durante o
+        refresh (usa o índice único de cada visão); visão ainda não populada usa o comum.
+        """
+        if not self.is_postgres:
+            return
+        start = time.perf_counter()
+        self._create_views(conn)
+        for view in self.STORY_VIEWS:
+            populated = conn.execute(
+                text("SELECT ispopulated FROM pg_matviews WHERE matviewname = :view"), {'view': view}
+            ).scalar()
+            mode = "CONCURRENTLY " if populated else ""
+            conn.execute(text(f"REFRESH MATERIALIZED VIEW {mode}{view}"))
+        self.logger.info(f"Visões do dashboard atualizadas em {time.perf_counter() - start:.1f}s.")
+
+    def _stamp_data_version(self, conn):
+        """
+        Grava uma versão nova dos dados em etl_versao, na transação da carga: a API só vê
+        a versão nova junto com os dados novos e então invalida o cache de respostas.
+        """
+        version = uuid.uuid4().hex
+        conn.execute(text("""
+            INSERT INTO etl_versao (id, versao, atualizado_em) VALUES (1, :versao, CURRENT_TIMESTAMP)
+            ON CONFLICT (id) DO UPDATE SET versao = EXCLUDED.versao, atualizado_em = EXCLUDED.atualizado_em
+        """), {'versao': version})
+        self.logger.info(f"Versão dos dados publicada: {version}")
+
+    def _create_shadow_tables(self, conn):
+        """
+        Cria <tabela>_stg para cada tabela carregada, com o DDL do schema.sql (tabelas
+        nuas, mesma definição das reais). Sobras de uma execução interrompida são removidas.
+        """
+        ddl = self._schema_tables()
+        for table in reversed(self.LOADED_TABLES):
+            conn.execute(text(f"DROP TABLE IF EXISTS {table}{self.SHADOW_SUFFIX} CASCADE"))
+        for table in self.LOADED_TABLES:
+            if table not in ddl:
+                raise ValueError(f"DDL da tabela {table} não encontrado no schema.sql")
+            conn.execute(text(f"CREATE TABLE {table}{self.SHADOW_SUFFIX}{ddl[table]}"))
+        self._targets = {table: f"{table}{self.SHADOW_SUFFIX}" for table in self.LOADED_TABLES}
+        self.logger.info("Carga completa em tabelas-sombra (a API segue lendo as atuais).")
+
+    def _swap_shadow_tables(self, conn):
+        """
+        Troca as tabelas reais pelas sombras com RENAME, na transação da carga: os leitores
+        esperam só o instante do lock e, após o commit, já resolvem os nomes para as novas.
+        As visões do dashboard dependem das tabelas antigas: saem antes da troca e são
+        recriadas (já populadas) sobre as novas. Depois ajusta nomes de partições, índices,
+        PKs e sequências e repõe o SELECT do usuário leitor.
+        """
+        tables = self.LOADED_TABLES
+        start = time.perf_counter()
+        conn.execute(text(f"LOCK TABLE {', '.join(tables)} IN ACCESS EXCLUSIVE MODE"))
+        conn.execute(text(f"DROP MATERIALIZED VIEW IF EXISTS {', '.join(self.STORY_VIEWS)}"))
+        for table in tables:
+            conn.execute(text(f"ALTER TABLE {table} RENAME TO {table}_old"))
+            conn.execute(text(f"ALTER TABLE {table}{self.SHADOW_SUFFIX} RENAME TO {table}"))
+        conn.execute(text(f"DROP TABLE {', '.join(f'{t}_old' for t in tables)}"))
+
+        # Nomes definitivos (os antigos, inclusive os das partições, foram liberados pelo DROP)
+        for (ano, trimestre), stage in sorted(self._staged.items()):
+            self._rename_partition(stage, ano, trimestre, conn)
+        for index in self.DEFERRED_INDEXES:
+            conn.execute(text(f"ALTER INDEX {index}{self.SHADOW_SUFFIX} RENAME TO {index}"))
+        for table in tables:
+            pkey = conn.execute(
+                text("SELECT conname FROM pg_constraint WHERE conrelid = CAST(:tbl AS regclass) AND contype = 'p'"),
+                {'tbl': table}
+            ).scalar()
+            if pkey and pkey != f"{table}_pkey":
+                conn.execute(text(f"ALTER TABLE {table} RENAME CONSTRAINT {pkey} TO {table}_pkey"))
+            sequence = conn.execute(
+                text("SELECT pg_get_serial_sequence(:tbl, 'id')"), {'tbl': table}
+            ).scalar() if table == 'despesas_agregadas' else None
+            if sequence and sequence.split('.')[-1].strip('"') != f"{table}_id_seq":
+                conn.execute(text(f"ALTER SEQUENCE {sequence} RENAME TO {table}_id_seq"))
+
+        self._create_views(conn)
+
+        if conn.execute(text("SELECT 1 FROM pg_roles WHERE rolname = 'reader'")).first():
+            conn.execute(text(f"GRANT SELECT ON {', '.join(tables + self.STORY_VIEWS)} TO reader"))
+        self._targets = {}
+        self.logger.info(f"Tabelas-sombra promovidas em {time.perf_counter() - start:.2f}s.")
@@ -0,0 +1,147 @@
+import os
+import re
+import shutil
+import logging
+import pandas as pd
+
+# PyArrow é opcional: sem ele o dataset continua tipado, mas em pickle (sem projeção/mmap)
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    PARQUET_AVAILABLE = True
+except ImportError:
+    PARQUET_AVAILABLE = False
+
+
+class PartitionedDataset:
+    """
+    Dataset colunar tipado, particionado por Ano/Trimestre, usado como formato
+    intermediário entre as etapas do ETL (consolidação -> enriquecimento -> agregação/carga).
+
+    Layout em disco:
+        <root>/ano=2025/trimestre=1/part-00000.parquet
+
+    Cada partição pode ter vários arquivos 'part-*' (um por arquivo-fonte); a leitura
+    sempre os concatena em ordem de nome, o que torna o resultado determinístico.
+    """
+    _PARTITION_RE = re.compile(r'^ano=(\d+)$')
+    _QUARTER_RE = re.compile(r'^trimestre=(\d+)$')
+
+    def __init__(self, root):
+        self.root = root
+        self.extension = '.parquet' if PARQUET_AVAILABLE else '.pkl'
+        self.logger = logging.getLogger("ANS_ETL.Dataset")
+        os.makedirs(self.root, exist_ok=True)
+        if not PARQUET_AVAILABLE:
+            self.logger.warning("pyarrow não instalado: dataset intermediário salvo em pickle (sem leitura colunar).")
+
+    # --- Navegação ---
+    def partition_dir(self, ano, trimestre):
+        return os.path.join(self.root, f"ano={int(ano)}", f"trimestre={int(trimestre)}")
+
+    def partitions(self):
+        """Lista as partições existentes como tuplas (ano, trimestre), em ordem cronológica."""
+        found = []
+        if not os.path.isdir(self.root):
+            return found
+        for year_dir in os.listdir(self.root):
+            year_match = self._PARTITION_RE.match(year_dir)
+            if not year_match: continue
+            for quarter_dir in os.listdir(os.path.join(self.root, year_dir)):
+                quarter_match = self._QUARTER_RE.match(quarter_dir)
+                if quarter_match and self._part_files(int(year_match.group(1)), int(quarter_match.group(1))):
+                    found.append((int(year_match.group(1)), int(quarter_match.group(1))))
+        return sorted(found)
+
+    def _part_files(self, ano, trimestre):
+        folder = self.partition_dir(ano, trimestre)
+        if not os.path.isdir(folder):
+            return []
+        return [
+            os.path.join(folder, f) for f in sorted(os.listdir(folder))
+            if f.startswith('part-') and f.endswith(self.extension)
+        ]
+
+    # --- Escrita ---
+    def write_part(self, df, ano, trimestre, part_name):
+        """
+        Grava um DataFrame como um arquivo da partição (ano, trimestre).
+        A escrita é atômica (arquivo temporário + rename).
+        """
+        folder = self.partition_dir(ano, trimestre)
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f"{part_name}{self.extension}")
+        tmp_path = path + '.tmp'
+
+        df = df.reset_index(drop=True)
+        if PARQUET_AVAILABLE:
+            pq.write_table(pa.Table.from_pandas(df, preserve_index=False), tmp_path, compression='snappy')
+        else:
+            df.to_pickle(tmp_path)
+        os.replace(tmp_path, path)
+        return path
+
+    def delete_part(self, ano, trimestre, part_name):
+        """Remove um arquivo específico da partição (ex: a parte de uma fonte que mudou)."""
+        path = os.path.join(self.partition_dir(ano, trimestre), f"{part_name}{self.extension}")
+        if os.path.exists(path):
+            os.remove(path)
+
+    def has_part(self, ano, trimestre, part_name):
+        return os.path.exists(os.path.join(self.partition_dir(ano, trimestre), f"{part_name}{self.extension}"))
+
+    def drop_partition(self, ano, trimestre):
+        shutil.rmtree(self.partition_dir(ano, trimestre), ignore_errors=True)
+
+    def clear(self):
+        """Remove todas as partições (reprocessamento completo)."""
+        shutil.rmtree(self.root, ignore_errors=True)
+        os.makedirs(self.root, exist_ok=True)
+
+    # --- Leitura ---
+    def _read_file(self, path, columns):
+        if PARQUET_AVAILABLE:
+            # memory_map evita copiar o arquivo para um buffer antes de decodificar as colunas
+            return pq.read_table(path, columns=columns, memory_map=True).to_pandas()
+        df = pd.read_pickle(path)
+        return df[columns] if columns else df
+
+    def read_partition(self, ano, trimestre, columns=None):
+        """Lê uma partição (todas as partes concatenadas); DataFrame vazio se não existir."""
+        frames = [self._read_file(path, columns) for path in self._part_files(ano, trimestre)]
+        if not frames:
+            return pd.DataFrame(columns=columns) if columns else pd.DataFrame()
+        return pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+
+    def iter_partitions(self, columns=None, partitions=None):
+        """Gera ((ano, trimestre), DataFrame) partição a partição, em ordem cronológica."""
+        for ano, trimestre in (partitions if partitions is not None else self.partitions()):
+            yield (ano, trimestre), self.read_partition(ano, trimestre, columns)
+
+    def iter_chunks(self, columns=None, partitions=None, chunk_rows=None):
+        """
+        Gera ((ano, trimestre), DataFrame) em blocos de no máximo `chunk_rows` linhas,
+        arquivo a arquivo. A memória fica limitada ao bloco, não à partição nem ao histórico.
+        """
+        for ano, trimestre in (partitions if partitions is not None else self.partitions()):
+            for path in self._part_files(ano, trimestre):
+                if PARQUET_AVAILABLE:
+                    parquet_file = pq.ParquetFile(path, memory_map=True)
+                    if chunk_rows is None:
+                        yield (ano, trimestre), parquet_file.read(columns=columns).to_pandas()
+                        continue
+                    for batch in parquet_file.iter_batches(batch_size=chunk_rows, columns=columns):
+                        yield (ano, trimestre), pa.Table.from_batches([batch]).to_pandas()
+                    continue
+
+                df = self._read_file(path, columns)
+                step = chunk_rows or max(len(df), 1)
+                for start in range(0, len(df), step):
+                    yield (ano, trimestre), df.iloc[start:start + step].reset_index(drop=True)
+
+    def read(self, columns=None, partitions=None):
+        """Lê o dataset inteiro (ou só as partições indicadas) em um único DataFrame."""
+        frames = [df for _, df in self.iter_partitions(columns, partitions) if not df.empty]
+        if not frames:
+            return pd.DataFrame(columns=columns) if columns else pd.DataFrame()
+        return pd.concat(frames, ignore_index=True)
@@ -1,14 +1,20 @@
 import pandas as pd
 import os
+import io
+import json
+import time
+import hashlib
 import logging
-import requests
-import sys
 
 # Importações locais
+from .dataset import PartitionedDataset, PARQUET_AVAILABLE
+from .state import EtlState
+from utils.http_client import HttpClient
+from utils.download_manifest import DownloadManifest
 from config import (
-    DATA_DIR, OUTPUT_FILE, ENRICHED_FILE,
-    CADASTRO_URL, USER_AGENT, 
-    CADOP_POSSIBLE_MAPPINGS
+    ENRICHED_FILE, CONSOLIDATED_DATASET_DIR, ENRICHED_DATASET_DIR,
+    CHUNK_SIZE, CADASTRO_URL, CADASTRO_FILE, CADOP_MANIFEST_FILE, CADOP_CACHE_BASE,
+    CADOP_CACHE_TTL, DOWNLOAD_CHUNK_SIZE, CADOP_POSSIBLE_MAPPINGS
 )
 
 # Tenta importar o validador. Se não existir, cria um dummy para não quebrar.
@@ -19,6 +25,8 @@ except ImportError:
     class CNPJValidator:
         @staticmethod
         def validate(cnpj): return True
+        @staticmethod
+        def validate_many(values): return [True] * len(values)
 
 class DataEnricher:
     """
@@ -26,45 +34,111 @@ class DataEnricher:
     dados cadastrais (Dimensão) obtidos do portal da ANS.
     """
     
-    CADASTRO_FILE = os.path.join(DATA_DIR, "cadastro_operadoras.csv")
+    CADASTRO_FILE = CADASTRO_FILE
+    CADASTRO_NAME = os.path.basename(CADASTRO_FILE)
+
+    # Atributos da dimensão copiados para cada linha do fato (os que a agregação usa).
+    # Endereço, contatos etc. ficam só na dimensão (tabela operadoras).
+    JOIN_COLUMNS = ['RegistroANS', 'CNPJ_Cad', 'RazaoSocial_Cad', 'UF', 'Modalidade']
 
     def __init__(self):
         self.logger = logging.getLogger("ANS_ETL.Enricher")
         self.enriched_file = ENRICHED_FILE
+        self.source_dataset = PartitionedDataset(CONSOLIDATED_DATASET_DIR)
+        self.dataset = PartitionedDataset(ENRICHED_DATASET_DIR)
+        self._dimension = None
+        # Validadores HTTP + instante da última checagem do CADOP
+        self.manifest = DownloadManifest(CADOP_MANIFEST_FILE)
+        self.cache_file = CADOP_CACHE_BASE + ('.parquet' if PARQUET_AVAILABLE else '.pkl')
+        self.cache_meta_file = CADOP_CACHE_BASE + '.json'
+        self.cadop_info = {}
 
-    def download_cadastro(self):
+    def download_cadastro(self, force=False):
         """
-        Baixa o CSV de Operadoras Ativas (CADOP) se ele ainda não existir.
+        Garante um CADOP local atualizado.
+        - Dentro de CADOP_CACHE_TTL desde a última checagem: usa o arquivo local sem rede.
+        - Fora do prazo: GET condicional (ETag/Last-Modified do manifesto); 304 só renova o prazo.
+        - Falha de rede com arquivo local presente: segue com a cópia local (aviso no log).
+
+        Args:
+            force (bool): Ignora o TTL e revalida com o servidor.
         """
-        if os.path.exists(self.CADASTRO_FILE):
-            self.logger.info("Arquivo de cadastro já existe localmente.")
+        entry = self.manifest.get(self.CADASTRO_NAME)
+        exists = os.path.exists(self.CADASTRO_FILE)
+
+        if exists and not force and entry and time.time() - entry.get('checked_at', 0) < CADOP_CACHE_TTL:
+            self.logger.info("Cadastro local dentro da validade; revalidação pulada.")
             return
 
-        self.logger.info("Baixando cadastro oficial da ANS (CADOP)...")
+        headers = DownloadManifest.conditional_headers(entry) if exists else {}
+        self.logger.info("Revalidando cadastro oficial da ANS (CADOP)..." if headers else "Baixando cadastro oficial da ANS (CADOP)...")
+        client = HttpClient(pool_size=1)
         try:
-            headers = {'User-Agent': USER_AGENT}
-            # verify=False é necessário pois o cert da ANS frequentemente expira ou é autoassinado
-            with requests.get(CADASTRO_URL, headers=headers, stream=True, verify=False, timeout=60) as r:
-                r.raise_for_status()
-                with open(self.CADASTRO_FILE, 'wb') as f:
-                    for chunk in r.iter_content(chunk_size=8192):
-                        f.write(chunk)
+            with client.get(CADASTRO_URL, stream=True, headers=headers or None) as r:
+                if r.status_code == 304:
+                    self.logger.info("Cadastro não modificado (304).")
+                    self.manifest.update(self.CADASTRO_NAME, checked_at=time.time())
+                    return
+
+                # Grava em .tmp e troca no fim: um download interrompido não corrompe o CSV atual
+                tmp_path = self.CADASTRO_FILE + '.tmp'
+                digest = hashlib.sha256()
+                with open(tmp_path, 'wb') as f:
+                    for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        if chunk:
+                            f.write(chunk)
+                            digest.update(chunk)
+                os.replace(tmp_path, self.CADASTRO_FILE)
+                self.manifest.update(
+                    self.CADASTRO_NAME, url=CADASTRO_URL, complete=True, checked_at=time.time(),
+                    size=os.path.getsize(self.CADASTRO_FILE), sha256=digest.hexdigest(),
+                    etag=r.headers.get('ETag'), last_modified=r.headers.get('Last-Modified')
+                )
             self.logger.info("Download concluído com sucesso.")
         except Exception as e:
+            if exists:
+                self.logger.warning(f"Revalidação do cadastro falhou ({e}). Usando a cópia local.")
+                return
             self.logger.error(f"Erro crítico no download do cadastro: {e}")
             raise
+        finally:
+            client.close()
+
+    def cadastro_fingerprint(self):
+        """
+        Impressão digital do CADOP local para o ETL incremental: o SHA-256 do manifesto
+        (estável quando a ANS republica o mesmo conteúdo), ou tamanho+mtime como fallback.
+        """
+        entry = self.manifest.get(self.CADASTRO_NAME)
+        if entry and entry.get('sha256') and entry.get('size') == (
+                os.path.getsize(self.CADASTRO_FILE) if os.path.exists(self.CADASTRO_FILE) else None):
+            return f"sha256={entry['sha256']}"
+        return EtlState.file_fingerprint(self.CADASTRO_FILE)
+
+    def _detect_encoding(self, raw):
+        """Decodifica os bytes do CADOP uma única vez (cp1252 primeiro, como a ANS publica)."""
+        for encoding in ('cp1252', 'utf-8'):
+            try:
+                return raw.decode(encoding), encoding
+            except UnicodeDecodeError:
+                continue
+        return raw.decode('utf-8', errors='replace'), 'utf-8'
 
     def load_cadop_robust(self):
         """
         Lê o arquivo CADOP lidando com diferentes encodings e separadores.
+        O arquivo é lido do disco uma vez; o encoding detectado e o mapeamento de colunas
+        aplicado ficam em self.cadop_info (gravados junto com o cache binário).
         Retorna: 
             DataFrame: Dados cadastrais limpos e normalizados.
         """
-        # 1. Tentativa de Leitura (Encoding Windows vs UTF8)
-        try:
-            df = pd.read_csv(self.CADASTRO_FILE, sep=';', encoding='cp1252', dtype=str, on_bad_lines='skip')
-        except:
-            df = pd.read_csv(self.CADASTRO_FILE, sep=';', encoding='utf-8', dtype=str, on_bad_lines='skip')
+        # 1. Leitura única + detecção de encoding (Windows vs UTF8) em memória
+        with open(self.CADASTRO_FILE, 'rb') as f:
+            text, encoding = self._detect_encoding(f.read())
+        if text.startswith('\ufeff'):
+            text = text[1:]
+        df = pd.read_csv(io.StringIO(text), sep=';', dtype=str, on_bad_lines='skip')
+        del text
 
         # 2. Normalização de Colunas (Upper Case + Strip)
         df.columns = [c.strip().upper() for c in df.columns]
@@ -84,6 +158,7 @@ class DataEnricher:
                 raise ValueError(f"Coluna RegistroANS não encontrada no CADOP. Colunas disponíveis: {df.columns}")
 
         df.rename(columns=final_rename_map, inplace=True)
+        self.cadop_info = {'encoding': encoding, 'column_mapping': final_rename_map}
 
         # 4. Seleção e Limpeza
         # Garante que temos apenas as colunas mapeadas que existem no DF
@@ -101,54 +176,88 @@ class DataEnricher:
         # Remove duplicatas (Pega o primeiro registro ativo encontrado)
         df.drop_duplicates(subset=['RegistroANS'], inplace=True)
         
+        return df.reset_index(drop=True)
+
+    # --- Cache binário da dimensão (CADOP já normalizado) ---
+    @staticmethod
+    def _mapping_signature():
+        """Muda quando as regras de mapeamento do config mudam (invalida o cache binário)."""
+        return hashlib.sha256(json.dumps(CADOP_POSSIBLE_MAPPINGS, sort_keys=True).encode()).hexdigest()[:16]
+
+    def _read_cached_dimension(self):
+        """Dimensão pré-processada, se o cache corresponder ao CSV e ao mapeamento atuais."""
+        try:
+            with open(self.cache_meta_file, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if (meta.get('source') != EtlState.file_fingerprint(self.CADASTRO_FILE)
+                or meta.get('mapping') != self._mapping_signature()
+                or not os.path.exists(self.cache_file)):
+            return None
+        try:
+            df = pd.read_parquet(self.cache_file) if PARQUET_AVAILABLE else pd.read_pickle(self.cache_file)
+        except Exception as e:
+            self.logger.warning(f"Cache do cadastro ilegível ({e}). Reprocessando o CSV.")
+            return None
+        self.cadop_info = {'encoding': meta.get('encoding'), 'column_mapping': meta.get('column_mapping', {})}
         return df
 
-    def process(self, save_to_disk=True):
+    def _write_cached_dimension(self, df):
+        """Grava a dimensão normalizada + metadados (encoding, mapeamento, fingerprint do CSV)."""
+        tmp_path = self.cache_file + '.tmp'
+        if PARQUET_AVAILABLE:
+            df.to_parquet(tmp_path, index=False, compression='snappy')
+        else:
+            df.to_pickle(tmp_path)
+        os.replace(tmp_path, self.cache_file)
+
+        meta = dict(self.cadop_info, source=EtlState.file_fingerprint(self.CADASTRO_FILE),
+                    mapping=self._mapping_signature(), rows=len(df))
+        with open(self.cache_meta_file + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(meta, f, indent=2, sort_keys=True)
+        os.replace(self.cache_meta_file + '.tmp', self.cache_meta_file)
+
+    def load_dimension(self):
         """
-        Executa o enriquecimento de dados:
-        1. Carrega dados financeiros consolidados.
-        2. Baixa e carrega dados cadastrais (CADOP).
-        3. Cruza informações (Join) pelo RegistroANS.
-        4. Valida CNPJs.
-        5. Opcionalmente salva arquivo final enriquecido.
-        6. Retorna DataFrame enriquecido.
+        Dimensão de operadoras (CADOP normalizado, uma linha por RegistroANS).
+        Carregada uma vez por instância e compartilhada com a carga da tabela operadoras.
+        Vem do cache binário quando o CSV não mudou desde o último processamento.
         """
-        self.logger.info("Iniciando Enriquecimento de Dados...")
-        
-        # --- PASSO 1: Carregar Dados Financeiros ---
-        if not os.path.exists(OUTPUT_FILE):
-            self.logger.error("Arquivo consolidado (consolidado_despesas.csv) não encontrado.")
-            return
-
-        try:
-            # Tenta abrir (se estiver aberto no Excel, vai dar erro aqui)
-            with open(OUTPUT_FILE, 'r'): pass 
-            
-            df_despesas = pd.read_csv(OUTPUT_FILE, sep=';', encoding='utf-8-sig', dtype=str)
-        except PermissionError:
-            self.logger.critical(f"ERRO DE PERMISSÃO: O arquivo '{OUTPUT_FILE}' está aberto. Feche-o e tente novamente.")
-            return
+        if self._dimension is None:
+            self.download_cadastro()
+            self._dimension = self._read_cached_dimension()
+            if self._dimension is not None:
+                self.logger.info(f"Cadastro carregado do cache pré-processado ({len(self._dimension)} operadoras).")
+            else:
+                self.logger.info("Processando arquivo de cadastro...")
+                self._dimension = self.load_cadop_robust()
+                try:
+                    self._write_cached_dimension(self._dimension)
+                except OSError as e:
+                    # Cache é otimização: falha ao gravar não interrompe o enriquecimento
+                    self.logger.warning(f"Não foi possível gravar o cache do cadastro: {e}")
+        return self._dimension
 
+    def _enrich_chunk(self, df_despesas, df_ops):
+        """
+        Enriquece um bloco de despesas (Fato) com a visão estreita da dimensão CADOP
+        (JOIN_COLUMNS), já carregada em memória. Cada linha depende só da própria
+        operadora, então o resultado por blocos é igual ao do join sobre o histórico inteiro.
+        """
         # Remove colunas vazias/placeholders para evitar colisão no merge
         cols_to_drop = [c for c in ['Modalidade', 'UF'] if c in df_despesas.columns]
         if cols_to_drop:
-            df_despesas.drop(columns=cols_to_drop, inplace=True)
+            df_despesas = df_despesas.drop(columns=cols_to_drop)
 
         # Limpeza da Chave Primária (Financeiro)
         df_despesas['RegistroANS'] = df_despesas['RegistroANS'].str.strip().str.replace('"', '').str.replace("'", "")
 
-        # --- PASSO 2: Carregar Dados Cadastrais ---
-        self.download_cadastro()
-        self.logger.info("Processando arquivo de cadastro...")
-        df_ops = self.load_cadop_robust()
-
-        # --- PASSO 3: Executar o Join (Left Join) ---
-        self.logger.info("Cruzando dados financeiros com cadastrais...")
-        
+        # --- Join (Left Join) ---
         # Left Join: Mantém todas as despesas, traz dados da operadora se existir
         df_merged = pd.merge(df_despesas, df_ops, on='RegistroANS', how='left')
 
-        # --- PASSO 4: Consolidar Colunas ---
+        # --- Consolidar Colunas ---
         # Se CNPJ do cadastro existe, usa ele. Se não, mantém o que tinha (se houver).
         if 'CNPJ_Cad' in df_merged.columns:
             df_merged['CNPJ'] = df_merged['CNPJ_Cad'].fillna(df_merged['CNPJ'] if 'CNPJ' in df_merged else "")
@@ -159,7 +268,7 @@ class DataEnricher:
         # Limpa colunas temporárias do Join
         df_merged.drop(columns=['CNPJ_Cad', 'RazaoSocial_Cad'], inplace=True, errors='ignore')
 
-        # --- PASSO 5: Tratamento de Falhas (Dados Faltantes) ---
+        # --- Tratamento de Falhas (Dados Faltantes) ---
         # Operadoras que não deram match no cadastro (provavelmente canceladas)
         df_merged['RazaoSocial'] = df_merged['RazaoSocial'].fillna("OPERADORA INATIVA/DESCONHECIDA")
         
@@ -174,43 +283,117 @@ class DataEnricher:
         else:
             df_merged['UF'] = df_merged['UF'].fillna('ND')
 
-        # --- PASSO 6: Validação de Qualidade (CNPJ) ---
-        self.logger.info("Executando validação algorítmica de CNPJs...")
-        
-        # Aplica o validador
-        df_merged['CNPJ_Valido'] = df_merged['CNPJ'].apply(lambda x: CNPJValidator.validate(x))
-        
-        # Estatísticas de Qualidade
-        total = len(df_merged)
-        invalidos = len(df_merged[~df_merged['CNPJ_Valido']])
-        self.logger.info(f"Qualidade dos Dados: {invalidos} registros com CNPJ inválido ou ausente de {total} ({invalidos/total:.1%}).")
+        # --- Validação de Qualidade (CNPJ) ---
+        # Em lote: cada CNPJ distinto é validado uma vez, sem loop Python por linha
+        df_merged['CNPJ_Valido'] = CNPJValidator.validate_many(df_merged['CNPJ'])
+        return df_merged
+
+    def iter_enriched(self, partitions=None, chunk_rows=CHUNK_SIZE):
+        """
+        Enriquecimento em streaming: lê o dataset consolidado em blocos, cruza cada bloco
+        com o CADOP (única estrutura mantida inteira em memória), grava o bloco no dataset
+        enriquecido e o entrega ao consumidor (ex: DatabaseLoader).
+        O pico de memória depende do tamanho do bloco e do CADOP, não do histórico.
+
+        Args:
+            partitions (list): Partições (ano, trimestre) a reprocessar; None = todas.
+            chunk_rows (int): Linhas por bloco.
+
+        Gera:
+            tuple: ((ano, trimestre), DataFrame enriquecido do bloco).
+        """
+        self.logger.info("Iniciando Enriquecimento de Dados (streaming)...")
+
+        # --- PASSO 1: Carregar Dados Cadastrais (Dimensão, em memória) ---
+        # O fato recebe só os atributos de JOIN_COLUMNS: mantém as linhas estreitas
+        dimension = self.load_dimension()
+        df_ops = dimension[[c for c in self.JOIN_COLUMNS if c in dimension.columns]]
+
+        # --- PASSO 2: Preparar o destino ---
+        if partitions is None:
+            partitions = self.source_dataset.partitions()
+            self.dataset.clear()
+        else:
+            partitions = sorted(partitions)
+            self.logger.info(f"Enriquecimento incremental: {len(partitions)} partições alteradas.")
+            # Partições que deixaram de existir na consolidação somem também aqui
+            for ano, trimestre in partitions:
+                self.dataset.drop_partition(ano, trimestre)
+
+        # --- PASSO 3: Join + Validação bloco a bloco ---
+        self.logger.info("Cruzando dados financeiros com cadastrais e validando CNPJs...")
+        total = invalidos = 0
+        part_index = {}
+        for (ano, trimestre), df_despesas in self.source_dataset.iter_chunks(partitions=partitions, chunk_rows=chunk_rows):
+            if df_despesas.empty: continue
+            df_chunk = self._enrich_chunk(df_despesas, df_ops)
+
+            total += len(df_chunk)
+            invalidos += int((~df_chunk['CNPJ_Valido']).sum())
+
+            # Um arquivo por bloco; o índice mantém a ordem original na releitura
+            index = part_index.get((ano, trimestre), 0)
+            part_index[(ano, trimestre)] = index + 1
+            self.dataset.write_part(df_chunk, ano, trimestre, f"part-{index:05d}")
+            yield (ano, trimestre), df_chunk
+
+        if total:
+            self.logger.info(f"Qualidade dos Dados: {invalidos} registros com CNPJ inválido ou ausente de {total} ({invalidos/total:.1%}).")
+
+    def process(self, save_to_disk=True, partitions=None):
+        """
+        Executa o enriquecimento de dados (modo em memória, sobre iter_enriched):
+        1. Carrega dados financeiros consolidados (dataset particionado), opcionalmente
+           só as partições (ano, trimestre) informadas (ETL incremental).
+        2. Baixa e carrega dados cadastrais (CADOP).
+        3. Cruza informações (Join) pelo RegistroANS, trazendo só os atributos de
+           JOIN_COLUMNS (o fato continua estreito; o cadastro completo fica na dimensão).
+        4. Valida CNPJs.
+        5. Grava o dataset enriquecido (particionado por Ano/Trimestre).
+        6. Opcionalmente exporta o CSV final enriquecido.
+        7. Retorna DataFrame enriquecido (das partições processadas).
+
+        Para volumes grandes prefira iter_enriched, que não acumula o resultado.
+        """
+        frames = [df for _, df in self.iter_enriched(partitions=partitions)]
+        if not frames:
+            if partitions is None:
+                self.logger.error(f"Dataset consolidado vazio ou inexistente: {self.source_dataset.root}")
+                return
+            return pd.DataFrame()
+        df_merged = pd.concat(frames, ignore_index=True)
 
-        # --- PASSO 7: Salvar Resultado ---
         if save_to_disk:
-            self.logger.info(f"Salvando arquivo final: {self.enriched_file}")
-            
-            try:
-                # Delete manual antecipado (Fix para Windows/Lock)
-                if os.path.exists(self.enriched_file):
-                    try:
-                        os.remove(self.enriched_file)
-                        # Pequeno delay para garantir que o SO liberou o arquivo
-                        import time
-                        time.sleep(0.5)
-                    except OSError:
-                        pass
-
-                # [CORREÇÃO] Abre o arquivo manualmente (bypass pandas internal open)
-                # A debug script provou que open() funciona.
-                with open(self.enriched_file, 'w', encoding='utf-8-sig', newline='') as f:
-                    df_merged.to_csv(f, index=False, sep=';')
-                    
-                self.logger.info("Enriquecimento concluído com sucesso!")
-            except PermissionError:
-                self.logger.critical("ERRO DE PERMISSÃO: O arquivo 'despesas_enriquecidas.csv' está aberto no Excel.")
-                self.logger.critical("   -> FECHE O ARQUIVO e rode novamente.")
-            except Exception as e:
-                self.logger.error(f"Erro ao salvar arquivo: {e}")
-                raise
-        
-        return df_merged
\ No newline at end of file
+            self.export_csv()
+        return df_merged
+
+    def export_csv(self):
+        """Exporta o dataset enriquecido para o CSV final, bloco a bloco."""
+        self.logger.info(f"Salvando arquivo final: {self.enriched_file}")
+
+        try:
+            # Delete manual antecipado (Fix para Windows/Lock)
+            if os.path.exists(self.enriched_file):
+                try:
+                    os.remove(self.enriched_file)
+                    # Pequeno delay para garantir que o SO liberou o arquivo
+                    import time
+                    time.sleep(0.5)
+                except OSError:
+                    pass
+
+            # [CORREÇÃO] Abre o arquivo manualmente (bypass pandas internal open)
+            # A debug script provou que open() funciona.
+            with open(self.enriched_file, 'w', encoding='utf-8-sig', newline='') as f:
+                header_written = False
+                for _, df_chunk in self.dataset.iter_chunks(chunk_rows=CHUNK_SIZE):
+                    df_chunk.to_csv(f, index=False, sep=';', header=not header_written)
+                    header_written = True
+
+            self.logger.info("Enriquecimento concluído com sucesso!")
+        except PermissionError:
+            self.logger.critical("ERRO DE PERMISSÃO: O arquivo 'despesas_enriquecidas.csv' está aberto no Excel.")
+            self.logger.critical("   -> FECHE O ARQUIVO e rode novamente.")
+        except Exception as e:
+            self.logger.error(f"Erro ao salvar arquivo: {e}")
+            raise
@@ -1,7 +1,65 @@
 import os
 import zipfile
 import shutil
-from config import RAW_DIR, PROCESSED_DIR 
+from config import RAW_DIR, PROCESSED_DIR, STREAM_FROM_ZIP
+
+VALID_EXTENSIONS = ('.csv', '.txt')
+
+
+class SourceFile:
+    """
+    Referência a um arquivo de dados brutos: um CSV/TXT em disco ou um membro dentro de um ZIP.
+    Guarda apenas caminhos (é picklable), e abre o conteúdo como stream binário sob demanda.
+    """
+    def __init__(self, path, member=None, fingerprint=None):
+        self.path = path
+        self.member = member
+        self._fingerprint = fingerprint
+
+    @property
+    def key(self):
+        """Identificador estável da fonte entre execuções (independe do diretório base)."""
+        if self.member is None:
+            return f"{os.path.basename(os.path.dirname(self.path))}/{os.path.basename(self.path)}"
+        return f"{os.path.basename(self.path)}!{self.member}"
+
+    @property
+    def fingerprint(self):
+        """
+        Impressão digital do conteúdo, usada pelo ETL incremental.
+        Membros de ZIP usam CRC32 + tamanho do diretório do ZIP (sem descompactar nada);
+        arquivos em disco usam tamanho + mtime.
+        """
+        if self._fingerprint is None:
+            st = os.stat(self.path)
+            self._fingerprint = f"size={st.st_size}:mtime={st.st_mtime_ns}"
+        return self._fingerprint
+
+    @property
+    def label(self):
+        """Caminho lógico usado em logs e na detecção de trimestre/ano (ex: raw/1T2025/1T2025.csv)."""
+        if self.member is None:
+            return self.path
+        folder = os.path.splitext(self.path)[0]
+        return os.path.join(folder, *self.member.split('/'))
+
+    @property
+    def name(self):
+        return os.path.basename(self.label)
+
+    def open(self):
+        """Abre o conteúdo em modo binário (o membro é descompactado em stream, sem tocar o disco)."""
+        if self.member is None:
+            return open(self.path, 'rb')
+        zf = zipfile.ZipFile(self.path, 'r')
+        try:
+            # O stream do membro mantém sua própria referência ao arquivo do ZIP
+            return zf.open(self.member)
+        finally:
+            zf.close()
+
+    def __repr__(self):
+        return f"SourceFile({self.label!r})"
 
 
 class FileHandler:
@@ -27,6 +85,7 @@ class FileHandler:
     def extract_zip(self, zip_path):
         """
         Extrai um arquivo ZIP para o diretório de processamento.
+        Não faz nada se a pasta extraída for mais recente que o ZIP.
         Retorna o caminho da pasta extraída ou None em caso de erro.
         """
         if not os.path.exists(zip_path):
@@ -38,6 +97,9 @@ class FileHandler:
                 # Cria uma pasta dedicada para o conteúdo do ZIP
                 folder_name = os.path.splitext(os.path.basename(zip_path))[0]
                 target_path = os.path.join(self.extract_dir, folder_name)
+
+                if os.path.isdir(target_path) and os.path.getmtime(target_path) >= os.path.getmtime(zip_path):
+                    return target_path
                 
                 # Limpa a pasta alvo se já existir para evitar mistura de dados antigos
                 if os.path.exists(target_path):
@@ -54,4 +116,51 @@ class FileHandler:
             return None
         except Exception as e:
             print(f"Erro inesperado na extração: {e}")
-            return None
\ No newline at end of file
+            return None
+
+    def list_zip_sources(self, zip_path):
+        """Lista os membros CSV/TXT de um ZIP como SourceFile (sem extrair)."""
+        try:
+            with zipfile.ZipFile(zip_path, 'r') as zf:
+                members = [
+                    (info.filename, f"crc32={info.CRC:08x}:size={info.file_size}")
+                    for info in zf.infolist()
+                    if not info.is_dir() and info.filename.lower().endswith(VALID_EXTENSIONS)
+                ]
+        except zipfile.BadZipFile:
+            print(f"Arquivo ZIP corrompido: {zip_path}")
+            return []
+        return [SourceFile(zip_path, member, fingerprint) for member, fingerprint in sorted(members)]
+
+    def sources_for_zip(self, zip_path):
+        """Fontes de um ZIP baixado: membros em stream, ou a pasta extraída correspondente."""
+        if STREAM_FROM_ZIP:
+            return self.list_zip_sources(zip_path)
+
+        folder = os.path.join(self.extract_dir, os.path.splitext(os.path.basename(zip_path))[0])
+        sources = []
+        for root, dirs, files in os.walk(folder):
+            dirs.sort()
+            for file in sorted(files):
+                if file.lower().endswith(VALID_EXTENSIONS):
+                    sources.append(SourceFile(os.path.join(root, file)))
+        return sources
+
+    def list_sources(self):
+        """
+        Lista todos os arquivos brutos a consolidar.
+        Com STREAM_FROM_ZIP, lê direto dos ZIPs baixados; senão, varre as pastas extraídas.
+        """
+        sources = []
+        if STREAM_FROM_ZIP:
+            for file in sorted(os.listdir(self.download_dir)):
+                if file.lower().endswith('.zip'):
+                    sources.extend(self.list_zip_sources(os.path.join(self.download_dir, file)))
+            return sources
+
+        for root, dirs, files in os.walk(self.extract_dir):
+            dirs.sort()
+            for file in sorted(files):
+                if file.lower().endswith(VALID_EXTENSIONS):
+                    sources.append(SourceFile(os.path.join(root, file)))
+        return sources
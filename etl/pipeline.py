@@ -0,0 +1,105 @@
+import time
+import queue
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from config import DOWNLOAD_WORKERS, PIPELINE_QUEUE_SIZE
+
+
+class OverlappedPipeline:
+    """
+    Pipeline produtor/consumidor entre Download e Consolidação.
+    Os downloads rodam em um pool de threads e cada ZIP concluído entra numa fila limitada;
+    uma thread consumidora consolida o trimestre N enquanto o N+1 ainda está baixando.
+    Backpressure: no máximo `queue_size` downloads são submetidos por vez, e o próximo só
+    sai quando o mais antigo entra na fila. Se a consolidação atrasar, a fila enche, o put
+    bloqueia e nenhum download novo começa.
+    """
+    _SENTINEL = object()
+
+    def __init__(self, scraper, consolidator, download_workers=DOWNLOAD_WORKERS, queue_size=PIPELINE_QUEUE_SIZE):
+        self.logger = logging.getLogger("ANS_ETL.Pipeline")
+        self.scraper = scraper
+        self.consolidator = consolidator
+        self.download_workers = max(1, int(download_workers))
+        self.queue = queue.Queue(maxsize=max(1, int(queue_size)))
+        self._consumer_error = None
+        self._consolidation_seconds = 0.0
+
+    def _consume(self):
+        """Thread consumidora: consolida os ZIPs na ordem em que são enfileirados."""
+        while True:
+            item = self.queue.get()
+            try:
+                if item is self._SENTINEL:
+                    return
+                if self._consumer_error is not None:
+                    continue # Continua drenando a fila para não travar os produtores
+                start = time.perf_counter()
+                self.logger.info(f"Consolidando {item['filename']}...")
+                self.consolidator.add_zip(item['path'])
+                self._consolidation_seconds += time.perf_counter() - start
+            except Exception as e:
+                self.logger.critical(f"Erro fatal na consolidação de {item['filename']}: {e}")
+                self._consumer_error = e
+            finally:
+                self.queue.task_done()
+
+    def run(self, files, state=None, full_refresh=False):
+        """
+        Executa Download + Consolidação sobrepostos.
+
+        Args:
+            files (list): Itens retornados por ANSScraper.get_top_quarters_files.
+            state (EtlState): Estado incremental repassado ao consolidador (opcional).
+            full_refresh (bool): Reconsolida todas as fontes, ignorando o estado.
+
+        Retorna:
+            list: Estatísticas de download por arquivo (ver ANSScraper.download_many).
+        """
+        start = time.perf_counter()
+        self.consolidator.begin(state=state, full_refresh=full_refresh)
+        consumer = threading.Thread(target=self._consume, name="consolidator", daemon=True)
+        consumer.start()
+
+        results = []
+        in_flight = deque()
+        window = self.queue.maxsize
+
+        def enqueue_oldest():
+            # Enfileira na ordem da listagem (saída determinística); o put bloqueia se a fila encher
+            result = in_flight.popleft().result()
+            results.append(result)
+            if result['path']:
+                self.queue.put(result)
+
+        try:
+            workers = min(self.download_workers, window)
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="download") as pool:
+                for item in files:
+                    if len(in_flight) >= window:
+                        enqueue_oldest()
+                    in_flight.append(pool.submit(self.scraper.download_with_stats, item['url'], item['filename']))
+                while in_flight:
+                    enqueue_oldest()
+            download_seconds = time.perf_counter() - start
+        finally:
+            self.queue.put(self._SENTINEL)
+            consumer.join()
+
+        if self._consumer_error is not None:
+            self.consolidator.abort()
+            raise self._consumer_error
+        # Um ZIP da janela que falhou no download mantém as partes já consolidadas
+        self.consolidator.finish(requested=[item['filename'] for item in files])
+
+        elapsed = time.perf_counter() - start
+        download_mb = sum(r['bytes'] for r in results) / (1024 * 1024)
+        self.logger.info(
+            f"Pipeline Download→Consolidação: {elapsed:.1f}s de parede | "
+            f"downloads {download_seconds:.1f}s ({download_mb:.1f} MB) | "
+            f"consolidação ocupada {self._consolidation_seconds:.1f}s"
+        )
+        return results
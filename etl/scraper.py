@@ -1,11 +1,20 @@
 import re
 import os
-from bs4 import BeautifulSoup
+import time
+import json
+import hashlib
+import zipfile
+import requests
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urljoin
 
 # Imports novos
-from config import ANS_BASE_URL
+from config import (
+    ANS_BASE_URL, DOWNLOAD_WORKERS, DOWNLOAD_CHUNK_SIZE, DOWNLOAD_MANIFEST_FILE,
+    LISTING_CACHE_FILE, LISTING_CACHE_TTL, STREAM_FROM_ZIP
+)
 from utils.http_client import HttpClient
+from utils.download_manifest import DownloadManifest
 from .file_handler import FileHandler
 
 class ANSScraper:
@@ -14,19 +23,47 @@ class ANSScraper:
     delegando a infraestrutura para HttpClient e FileHandler.
     """
     
-    def __init__(self):
-        self.client = HttpClient() # Injeção da dependência de rede
+    def __init__(self, client=None):
+        self.client = client or HttpClient() # Injeção da dependência de rede
         self.file_handler = FileHandler()
+        self.manifest = DownloadManifest(DOWNLOAD_MANIFEST_FILE)
         self.base_url = ANS_BASE_URL
 
-    def _get_soup(self, url):
-        """Helper para obter o BeautifulSoup de uma URL."""
+    # Extrator de links por regex: as listagens do FTP da ANS são índices Apache simples,
+    # então não precisamos montar a árvore DOM inteira só para ler os href.
+    _HREF_RE = re.compile(r'''href\s*=\s*["']?([^"'\s>]+)''', re.IGNORECASE)
+
+    def _get_links(self, url):
+        """Helper para obter a lista de href de uma URL (None em caso de falha)."""
         try:
             response = self.client.get(url)
-            return BeautifulSoup(response.text, 'html.parser')
+            return self._HREF_RE.findall(response.text)
         except Exception:
             return None # O log já foi feito no HttpClient
 
+    def _load_listing_cache(self):
+        """Retorna os candidatos em cache se ainda estiverem dentro do TTL, senão None."""
+        try:
+            with open(LISTING_CACHE_FILE, 'r', encoding='utf-8') as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        age = time.time() - cache.get('fetched_at', 0)
+        if cache.get('base_url') != self.base_url or age > LISTING_CACHE_TTL:
+            return None
+        print(f" Usando listagem em cache ({age / 60:.0f} min atrás).")
+        return cache.get('candidates')
+
+    def _save_listing_cache(self, candidates):
+        tmp_path = LISTING_CACHE_FILE + '.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'base_url': self.base_url, 'fetched_at': time.time(), 'candidates': candidates}, f)
+            os.replace(tmp_path, LISTING_CACHE_FILE)
+        except OSError as e:
+            print(f" Aviso: não foi possível salvar o cache da listagem: {e}")
+
     def _detect_quarter(self, filename):
         filename = filename.lower()
         patterns = [
@@ -40,45 +77,59 @@ class ANSScraper:
                 else: return int(g2), int(g1)
         return None
 
-    def get_top_quarters_files(self, limit=3):
+    def _crawl_candidates(self):
         """
-        Navega no site da ANS para identificar os arquivos trimestrais mais recentes.
-        
-        Args:
-            limit (int): Número máximo de trimestres para retornar.
-            
-        Retorna:
-            list: Lista de dicionários com metadados dos arquivos encontrados.
+        Lê a listagem raiz e, em paralelo, as listagens dos anos mais recentes.
+        Retorna todos os ZIPs trimestrais encontrados (ou None se a raiz falhar)
+        e um flag indicando se todas as listagens de ano foram lidas com sucesso.
         """
         print(f" Mapeando estrutura do repositório: {self.base_url}")
-        soup = self._get_soup(self.base_url)
-        if not soup: return []
+        links = self._get_links(self.base_url)
+        if links is None: return None, False
 
-        
-        links = soup.find_all('a')
         years = []
-        for l in links:
-            href = l.get('href')
-            if href and re.match(r'^\d{4}/?$', href.strip()):
+        for href in links:
+            if re.match(r'^\d{4}/?$', href.strip()):
                 years.append(int(href.strip('/')))
         years.sort(reverse=True)
-        
+        years = years[:3]
+
+        year_urls = [urljoin(self.base_url, f"{year}/") for year in years]
+        with ThreadPoolExecutor(max_workers=max(1, len(year_urls)), thread_name_prefix="crawl") as pool:
+            listings = list(pool.map(self._get_links, year_urls))
+
         candidates = []
-        for year in years[:3]:
-            year_url = urljoin(self.base_url, f"{year}/")
-            year_soup = self._get_soup(year_url)
-            if not year_soup: continue
-            
-            file_links = year_soup.find_all('a')
-            for f_link in file_links:
-                href = f_link.get('href')
-                if not href or not href.lower().endswith('.zip'): continue
+        for year, year_url, file_links in zip(years, year_urls, listings):
+            if not file_links: continue
+            for href in file_links:
+                if not href.lower().endswith('.zip'): continue
                 detected = self._detect_quarter(href)
                 if detected and detected[0] == year:
                     candidates.append({
                         'year': detected[0], 'quarter': detected[1],
                         'url': urljoin(year_url, href), 'filename': href
                     })
+        return candidates, all(l is not None for l in listings)
+
+    def get_top_quarters_files(self, limit=3, use_cache=True):
+        """
+        Navega no site da ANS para identificar os arquivos trimestrais mais recentes.
+        A listagem é cacheada em disco por LISTING_CACHE_TTL segundos.
+        
+        Args:
+            limit (int): Número máximo de trimestres para retornar.
+            use_cache (bool): Se False, ignora o cache e refaz a varredura.
+            
+        Retorna:
+            list: Lista de dicionários com metadados dos arquivos encontrados.
+        """
+        candidates = self._load_listing_cache() if use_cache else None
+        if candidates is None:
+            candidates, complete = self._crawl_candidates()
+            if candidates is None: return []
+            # Só cacheia varreduras completas; uma falha parcial não pode "congelar" por horas
+            if complete and candidates:
+                self._save_listing_cache(candidates)
 
         unique_quarters = sorted(list(set((c['year'], c['quarter']) for c in candidates)), reverse=True)[:limit]
         final_files = [c for c in candidates if (c['year'], c['quarter']) in unique_quarters]
@@ -86,8 +137,9 @@ class ANSScraper:
 
     def download_file(self, url, filename):
         """
-        Baixa um arquivo específico, com suporte a stream e barra de progresso simples.
-        Descompacta automaticamente após o download.
+        Baixa um arquivo específico, com suporte a stream.
+        Descompacta após o download, a menos que STREAM_FROM_ZIP esteja ativo
+        (nesse caso o consolidador lê direto do ZIP).
         
         Args:
             url (str): URL de origem.
@@ -96,26 +148,234 @@ class ANSScraper:
         Retorna:
             str: Caminho do arquivo local baixado, ou None em caso de falha.
         """
-        """Baixa usando o HttpClient com stream."""
+        return self.download_with_stats(url, filename)['path']
+
+    def download_with_stats(self, url, filename):
+        """
+        Executa o download em stream e mede a vazão, apoiado no manifesto:
+        - Arquivo completo: o SHA-256 local é recalculado e comparado com o do manifesto
+          (divergência = baixa de novo). Com validadores, GET condicional (304 = nada a
+          baixar); se a revalidação falhar por erro de rede, segue com a cópia conferida.
+        - Arquivo parcial (.part) de uma execução interrompida: retoma via Range/If-Range
+          (só com ETag forte; sem ele, baixa o arquivo inteiro).
+        - Arquivo republicado pela ANS (200 na revalidação): baixa novamente.
+
+        Retorna:
+            dict: {'filename', 'path', 'bytes', 'seconds', 'status'}. 'path' é None em caso
+                  de falha e 'bytes' conta apenas o que trafegou pela rede nesta execução.
+        """
         local_path = os.path.join(self.file_handler.download_dir, filename)
-        
-        if os.path.exists(local_path):
-            print(f"   Arquivo já existe: {filename}")
-            self.file_handler.extract_zip(local_path)
-            return local_path
+        part_path = local_path + '.part'
+        stats = {'filename': filename, 'path': None, 'bytes': 0, 'seconds': 0.0, 'status': 'failed'}
+        start = time.perf_counter()
 
-        print(f" Baixando {filename}...", end='', flush=True)
         try:
-            # Aqui usamos o get com stream=True do nosso wrapper
-            with self.client.get(url, stream=True) as r:
-                with open(local_path, 'wb') as f:
-                    for chunk in r.iter_content(chunk_size=8192):
-                        if chunk: f.write(chunk)
-            print(" Concluído.")
-            
-            self.file_handler.extract_zip(local_path)
-            return local_path
+            self._reconcile_local_file(url, filename, local_path, part_path)
+            entry = self.manifest.get(filename)
+
+            verified = self.manifest.is_verified(filename, local_path)
+            if not verified and os.path.exists(local_path):
+                # Tamanho confere, conteúdo não: cópia local corrompida, baixa do zero
+                print(f"   SHA-256 divergente do manifesto, baixando novamente: {filename}")
+                os.remove(local_path)
+                self.manifest.update(filename, complete=False)
+                entry = None
+
+            if verified:
+                headers = DownloadManifest.conditional_headers(entry)
+                if not headers:
+                    # Servidor não forneceu validadores: vale a cópia conferida pelo SHA-256
+                    print(f"   Arquivo já existe: {filename}")
+                    stats['status'] = 'cached'
+                else:
+                    try:
+                        with self.client.get(url, stream=True, headers=headers) as r:
+                            if r.status_code == 304:
+                                print(f"   Não modificado (304): {filename}")
+                                stats['status'] = 'not_modified'
+                            else:
+                                print(f" Arquivo republicado pela ANS, baixando novamente: {filename}")
+                                sha256 = self._write_response(r, part_path, stats)
+                                self._finalize(url, filename, r, sha256, part_path, local_path)
+                                stats['status'] = 'downloaded'
+                    except requests.exceptions.RequestException as e:
+                        # Revalidação é opcional: a cópia local já foi conferida (SHA-256)
+                        # (a nova versão, se houver, só substitui o arquivo em _finalize)
+                        print(f"   Aviso: revalidação de {filename} falhou ({e}). Usando a cópia local.")
+                        stats['status'] = 'cached'
+            else:
+                r, sha256 = self._resume_or_download(url, filename, part_path, entry, stats)
+                self._finalize(url, filename, r, sha256, part_path, local_path)
+
+            stats['seconds'] = time.perf_counter() - start
+            if stats['bytes']:
+                print(f" Concluído: {filename} ({self._format_rate(stats['bytes'], stats['seconds'])})")
+
+            if not STREAM_FROM_ZIP:
+                self.file_handler.extract_zip(local_path)
+            stats['path'] = local_path
+            return stats
         except Exception as e:
-            print(f" Falha (ver log).")
-            if os.path.exists(local_path): os.remove(local_path)
-            return None
\ No newline at end of file
+            # O .part é mantido de propósito: a próxima execução retoma de onde parou
+            print(f" Falha em {filename} (ver log): {e}")
+            return stats
+
+    def _reconcile_local_file(self, url, filename, local_path, part_path):
+        """
+        Trata arquivos locais sem registro completo no manifesto (execuções antigas ou
+        interrompidas): adota o arquivo se o HEAD confirmar o tamanho, senão o converte
+        em .part para ser retomado.
+        """
+        if not os.path.exists(local_path) or self.manifest.is_complete(filename, local_path):
+            return
+
+        if os.path.exists(part_path):
+            # Já há um download mais recente em andamento; o arquivo final está obsoleto
+            os.remove(local_path)
+            return
+
+        head = self.client.head(url)
+        remote_size = head.headers.get('Content-Length')
+        local_size = os.path.getsize(local_path)
+        validators = {
+            'etag': head.headers.get('ETag'),
+            'last_modified': head.headers.get('Last-Modified'),
+        }
+
+        if remote_size is not None and int(remote_size) == local_size:
+            self.manifest.update(
+                filename, url=url, size=local_size, complete=True,
+                sha256=DownloadManifest.sha256_of(local_path).hexdigest(), **validators
+            )
+        else:
+            print(f"   Arquivo local incompleto ({local_size} bytes), retomando: {filename}")
+            os.replace(local_path, part_path)
+            self.manifest.update(filename, url=url, complete=False, **validators)
+
+    def _resume_or_download(self, url, filename, part_path, entry, stats):
+        """
+        Baixa para o .part, retomando com Range quando houver bytes parciais válidos.
+        Retorna a resposta (já consumida) e o SHA-256 do arquivo completo.
+        """
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        etag = (entry or {}).get('etag')
+        if offset and not (etag and not etag.startswith('W/')):
+            # Last-Modified e ETag fraco não garantem bytes idênticos: retomar poderia
+            # emendar duas versões do arquivo. Sem ETag forte, baixa o arquivo inteiro
+            print(f"   Sem ETag forte para retomar {filename}; baixando do início.")
+            os.remove(part_path)
+            offset = 0
+
+        headers = {}
+        if offset:
+            # If-Range: se o arquivo mudou no servidor, ele devolve 200 com o arquivo inteiro
+            headers['Range'] = f"bytes={offset}-"
+            headers['If-Range'] = etag
+
+        print(f" Baixando {filename}{f' (retomando de {offset} bytes)' if offset else ''}...")
+        try:
+            r = self.client.get(url, stream=True, headers=headers or None)
+        except requests.exceptions.HTTPError as e:
+            if e.response is None or e.response.status_code != 416:
+                raise
+            # 416: o parcial já cobre o arquivo todo (ou é maior que ele). Recomeça limpo.
+            os.remove(part_path)
+            return self._resume_or_download(url, filename, part_path, None, stats)
+
+        with r:
+            self.manifest.update(
+                filename, url=url, complete=False,
+                etag=r.headers.get('ETag') or (entry or {}).get('etag'),
+                last_modified=r.headers.get('Last-Modified') or (entry or {}).get('last_modified')
+            )
+            stats['status'] = 'resumed' if r.status_code == 206 else 'downloaded'
+            sha256 = self._write_response(r, part_path, stats)
+
+        if r.status_code == 206 and not self._zip_is_intact(part_path):
+            # Bytes antigos do .part não batem com os novos (CRC dos membros): recomeça limpo
+            print(f"   ZIP retomado inválido, baixando do início: {filename}")
+            os.remove(part_path)
+            return self._resume_or_download(url, filename, part_path, None, stats)
+        return r, sha256
+
+    @staticmethod
+    def _zip_is_intact(path):
+        """Confere o CRC de todos os membros de um ZIP (arquivos que não são ZIP passam)."""
+        if not path.lower().endswith(('.zip', '.zip.part')):
+            return True
+        try:
+            with zipfile.ZipFile(path) as zf:
+                return zf.testzip() is None
+        except (zipfile.BadZipFile, OSError):
+            return False
+
+    def _write_response(self, r, part_path, stats):
+        """Grava o corpo da resposta no .part (anexando se for 206) e retorna o SHA-256 final."""
+        if r.status_code == 206:
+            mode, digest = 'ab', DownloadManifest.sha256_of(part_path)
+        else:
+            mode, digest = 'wb', hashlib.sha256()
+
+        with open(part_path, mode) as f:
+            for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                if chunk:
+                    f.write(chunk)
+                    digest.update(chunk)
+                    stats['bytes'] += len(chunk)
+        return digest.hexdigest()
+
+    def _finalize(self, url, filename, r, sha256, part_path, local_path):
+        """Confere o tamanho esperado, promove o .part e registra o arquivo no manifesto."""
+        size = os.path.getsize(part_path)
+        expected = self._expected_size(r)
+        if expected is not None and size != expected:
+            raise IOError(f"download incompleto ({size} de {expected} bytes)")
+
+        os.replace(part_path, local_path)
+        self.manifest.update(
+            filename, url=url, size=size, sha256=sha256, complete=True,
+            etag=r.headers.get('ETag'), last_modified=r.headers.get('Last-Modified')
+        )
+
+    @staticmethod
+    def _expected_size(r):
+        """Tamanho total do arquivo segundo os cabeçalhos (None se não der para saber)."""
+        if r.status_code == 206:
+            total = r.headers.get('Content-Range', '').rpartition('/')[2]
+            return int(total) if total.isdigit() else None
+        if r.headers.get('Content-Encoding') or r.headers.get('Content-Length') is None:
+            return None
+        return int(r.headers['Content-Length'])
+
+    def download_many(self, files, workers=DOWNLOAD_WORKERS):
+        """
+        Baixa vários arquivos com concorrência limitada, reutilizando a Session
+        (pool de conexões) do HttpClient entre as threads.
+
+        Args:
+            files (list): Itens retornados por get_top_quarters_files.
+            workers (int): Nº máximo de downloads simultâneos (1 = sequencial).
+
+        Retorna:
+            list: Um dict de estatísticas por arquivo (ver download_with_stats), na ordem de entrada.
+        """
+        workers = max(1, int(workers))
+        start = time.perf_counter()
+
+        if workers == 1:
+            results = [self.download_with_stats(item['url'], item['filename']) for item in files]
+        else:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="download") as pool:
+                results = list(pool.map(lambda item: self.download_with_stats(item['url'], item['filename']), files))
+
+        elapsed = time.perf_counter() - start
+        total_bytes = sum(r['bytes'] for r in results)
+        print(f" Downloads finalizados: {len(files)} arquivos, {workers} workers, "
+              f"{self._format_rate(total_bytes, elapsed)} agregados.")
+        return results
+
+    @staticmethod
+    def _format_rate(n_bytes, seconds):
+        mb = n_bytes / (1024 * 1024)
+        rate = mb / seconds if seconds > 0 else 0.0
+        return f"{mb:.1f} MB em {seconds:.1f}s, {rate:.2f} MB/s"
@@ -0,0 +1,92 @@
+import os
+import json
+import logging
+from datetime import datetime
+
+from config import ETL_STATE_FILE
+
+
+class EtlState:
+    """
+    Estado persistente do ETL incremental (JSON).
+    Registra a impressão digital (fingerprint) de cada arquivo-fonte já consolidado e as
+    partições Ano/Trimestre que ele gerou, para que execuções seguintes reprocessem
+    somente fontes novas ou alteradas.
+
+    O estado só deve ser salvo ao final de uma execução bem-sucedida: se a carga falhar,
+    a próxima execução refaz as mesmas fontes.
+    """
+    # Incrementar quando as regras de consolidação mudarem (força reprocessamento completo)
+    VERSION = 1
+
+    def __init__(self, path=ETL_STATE_FILE):
+        self.path = path
+        self.logger = logging.getLogger("ANS_ETL.State")
+        self._data = self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return self._empty()
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            self.logger.warning(f"Estado do ETL ilegível ({e}). Reprocessamento completo.")
+            return self._empty()
+        if data.get('version') != self.VERSION:
+            self.logger.warning("Versão do estado do ETL mudou. Reprocessamento completo.")
+            return self._empty()
+        return data
+
+    def _empty(self):
+        return {'version': self.VERSION, 'sources': {}, 'fingerprints': {}}
+
+    @property
+    def is_empty(self):
+        return not self._data['sources']
+
+    def reset(self):
+        """Esquece todas as fontes (usado no reprocessamento completo)."""
+        self._data = self._empty()
+
+    # --- Fontes consolidadas ---
+    def source_entry(self, key):
+        entry = self._data['sources'].get(key)
+        if not entry:
+            return None
+        return {'fingerprint': entry['fingerprint'], 'partitions': [tuple(p) for p in entry['partitions']]}
+
+    def record_source(self, key, fingerprint, partitions):
+        self._data['sources'][key] = {
+            'fingerprint': fingerprint,
+            'partitions': sorted([int(a), int(t)] for a, t in partitions),
+        }
+
+    def forget_source(self, key):
+        self._data['sources'].pop(key, None)
+
+    def source_keys(self):
+        return list(self._data['sources'])
+
+    # --- Outras impressões digitais (ex: arquivo CADOP) ---
+    def fingerprint(self, name):
+        return self._data['fingerprints'].get(name)
+
+    def set_fingerprint(self, name, value):
+        self._data['fingerprints'][name] = value
+
+    def save(self):
+        self._data['updated_at'] = datetime.now().isoformat(timespec='seconds')
+        tmp_path = self.path + '.tmp'
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._data, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    @staticmethod
+    def file_fingerprint(path):
+        """Impressão digital barata de um arquivo em disco (tamanho + mtime)."""
+        if not os.path.exists(path):
+            return None
+        st = os.stat(path)
+        return f"size={st.st_size}:mtime={st.st_mtime_ns}"
@@ -1,8 +1,10 @@
 from asyncio.log import logger
 import sys
+import argparse
 import logging
 import time
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 # Importação do módulo local (garanta que a pasta 'etl' tenha um __init__.py)
 try:
@@ -11,6 +13,9 @@ try:
     from etl.enrichment import DataEnricher
     from etl.aggregator import DataAggregator
     from etl.database_loader import DatabaseLoader
+    from etl.pipeline import OverlappedPipeline
+    from etl.state import EtlState
+    from config import DOWNLOAD_WORKERS, CONSOLIDATION_WORKERS
 except ImportError as e:
     print(f"Erro Crítico: Não foi possível importar o módulo ETL. Verifique a estrutura de pastas.\nDetalhe: {e}")
     sys.exit(1)
@@ -28,17 +33,50 @@ def setup_logger():
     logger.addHandler(handler)
     return logger
 
+def parse_args(argv=None):
+    """Lê as opções de linha de comando do pipeline."""
+    parser = argparse.ArgumentParser(description="Pipeline ETL de despesas das operadoras (ANS).")
+    parser.add_argument(
+        "--download-workers", type=int, default=DOWNLOAD_WORKERS,
+        help=f"Downloads simultâneos (1 = sequencial). Padrão: {DOWNLOAD_WORKERS}"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=CONSOLIDATION_WORKERS,
+        help=f"Processos de consolidação, um arquivo-fonte por processo (1 = sem paralelismo). Padrão: {CONSOLIDATION_WORKERS}"
+    )
+    parser.add_argument(
+        "--sequential", action="store_true",
+        help="Executa download e consolidação em etapas separadas (sem sobreposição)."
+    )
+    parser.add_argument(
+        "--refresh-listing", action="store_true",
+        help="Ignora o cache da listagem do repositório da ANS e refaz a varredura."
+    )
+    parser.add_argument(
+        "--full-refresh", action="store_true",
+        help="Reprocessa todas as fontes e recria as tabelas (ignora o estado incremental)."
+    )
+    return parser.parse_args(argv)
+
 def main():
     """
     Função principal que orquestra todo o pipeline de ETL (Extract, Transform, Load).
     
     Fluxo de Execução:
     1. Scraping: Identifica e baixa arquivos da ANS.
-    2. Consolidação: Une arquivos CSV/TXT brutos.
-    3. Enriquecimento: Adiciona dados cadastrais (CADOP).
-    4. Agregação: Calcula KPIs e estatísticas.
-    5. Carga no Banco: Salva os dados processados no PostgreSQL e gera o arquivo consolidado final.
+    2. Consolidação: Une arquivos CSV/TXT brutos (sobreposta ao download por padrão).
+    3. Enriquecimento + Carga no Banco: Adiciona dados cadastrais (CADOP) em blocos,
+       carregando cada bloco no PostgreSQL à medida que é enriquecido.
+    4. Agregação: Calcula KPIs e estatísticas uma vez, na mesma transação da carga;
+       o resultado vai para a tabela despesas_agregadas e para o CSV agregado.
+    5. Exportação: Gera o CSV/ZIP consolidado a partir do dataset intermediário.
+
+    As etapas trocam dados por datasets colunares particionados por Ano/Trimestre
+    (data/consolidado e data/enriquecido). A execução é incremental: só as fontes com
+    fingerprint novo ou alterado são reconsolidadas, e só os trimestres afetados são
+    reenriquecidos e recarregados no banco (--full-refresh refaz tudo).
     """
+    args = parse_args()
     logger = setup_logger()
     logger.info("=== Iniciando Pipeline de Extração ANS ===")
     
@@ -50,7 +88,7 @@ def main():
         
         # 2. Etapa de Identificação (Scraping & Regex)
         logger.info("Etapa 1: Identificando trimestres disponíveis...")
-        files_to_download = scraper.get_top_quarters_files(limit=3)
+        files_to_download = scraper.get_top_quarters_files(limit=3, use_cache=not args.refresh_listing)
         
         if not files_to_download:
             logger.warning("Nenhum arquivo encontrado ou erro de conexão com a ANS.")
@@ -60,60 +98,91 @@ def main():
         for f in files_to_download:
             logger.info(f"   -> Encontrado: {f['filename']} (Ref: {f['quarter']}T{f['year']})")
         
-        # 3. Etapa de Download e Extração
+        # 3. Etapa de Download e Consolidação
         logger.info("-" * 40)
-        logger.info("Etapa 2: Iniciando Download e Extração...")
-        
+        consolidator = DataConsolidator(workers=args.workers)
+        enricher = DataEnricher()
+        state = EtlState()
+
         success_count = 0
         failure_count = 0
-        
-        for item in files_to_download:
-            try:
-                result = scraper.download_file(item['url'], item['filename'])
-                if result:
-                    logger.info(f"Sucesso: {item['filename']}")
+
+        # O CADOP não depende dos ZIPs: baixa em paralelo enquanto os trimestres chegam
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="cadop") as side_pool:
+            cadop_future = side_pool.submit(enricher.download_cadastro)
+
+            if args.sequential:
+                logger.info(f"Etapa 2: Iniciando Download e Extração ({args.download_workers} workers)...")
+                download_results = scraper.download_many(files_to_download, workers=args.download_workers)
+
+                logger.info("-" * 40)
+                logger.info("Etapa 3: Iniciando Consolidação e Limpeza dos Dados...")
+                consolidator.process(state=state, full_refresh=args.full_refresh, downloads=download_results)
+            else:
+                logger.info(f"Etapas 2-3: Download ({args.download_workers} workers) e Consolidação sobrepostos...")
+                pipeline = OverlappedPipeline(scraper, consolidator, download_workers=args.download_workers)
+                download_results = pipeline.run(files_to_download, state=state, full_refresh=args.full_refresh)
+
+            for result in download_results:
+                if result['path']:
+                    logger.info(f"Sucesso: {result['filename']}")
                     success_count += 1
                 else:
-                    logger.error(f"Falha: {item['filename']}")
+                    logger.error(f"Falha: {result['filename']}")
                     failure_count += 1
+
+            try:
+                cadop_future.result()
             except Exception as e:
-                logger.error(f"Erro inesperado ao processar {item['filename']}: {str(e)}")
-                failure_count += 1
+                # O enriquecimento tenta baixar de novo e reporta o erro no fluxo normal
+                logger.warning(f"Pré-download do CADOP falhou: {e}")
 
-        logger.info("-" * 40)
-        logger.info("Etapa 3: Iniciando Consolidação e Limpeza dos Dados...")
-        
-        consolidator = DataConsolidator()
-        consolidator.process()
+        # Um CADOP novo muda os atributos de todas as linhas: reprocessa todos os trimestres
+        cadop_fingerprint = enricher.cadastro_fingerprint()
+        full_run = args.full_refresh or state.fingerprint('cadop') != cadop_fingerprint
+        changed = sorted(consolidator.changed_partitions)
 
-        # 4. Etapa de Enriquecimento
-        logger.info("-" * 40)
-        logger.info("Etapa 4: Enriquecimento de Dados (Cadastral)...")
-        
-        enricher = DataEnricher()
-        # [MODIFICAÇÃO] Processamento em memória para evitar erro de disco e lock do Windows
-        # save_to_disk=False evita criar o arquivo intermediário gigante que causava OSError
-        df_enriched = enricher.process(save_to_disk=False)
+        if not full_run and not changed:
+            logger.info("-" * 40)
+            logger.info("Nenhuma fonte nova ou alterada: enriquecimento, agregação e carga pulados.")
+        else:
+            partitions = None if full_run else changed
 
-        if df_enriched is not None and not df_enriched.empty:
-            # 5. Etapa de Agregação (Summarization)
+            # 4. Etapa de Enriquecimento + Carga (streaming)
             logger.info("-" * 40)
-            logger.info("Etapa 5: Agregação de Despesas (KPIs)...")
-            
+            logger.info("Etapa 4: Enriquecimento de Dados (Cadastral) com Carga no Banco (SQL)...")
+
+            # Cada bloco enriquecido é gravado no dataset e carregado no banco em seguida:
+            # nenhum estágio mantém o histórico inteiro em memória
+            loader = DatabaseLoader()
+            loader.init_db(full_refresh=args.full_refresh) # Cria tabelas
+            if partitions is not None and loader.requires_full_load():
+                # Schema anterior no banco (fato sem partições ou chave VARCHAR): só a carga
+                # completa recria as tabelas pelo schema.sql atual
+                logger.info("Banco com schema anterior ao atual: carga completa.")
+                partitions = None
+            # O cadastro completo vai direto do CADOP para a dimensão; o fato segue estreito
+            dimension = enricher.load_dimension()
+            enriched_chunks = (df for _, df in enricher.iter_enriched(partitions=partitions))
+
+            # 5. Etapa de Agregação (KPIs): calculada uma vez dentro da carga, após o fato;
+            # o mesmo resultado alimenta a tabela despesas_agregadas e o CSV agregado
             aggregator = DataAggregator()
-            aggregator.process(df_input=df_enriched) # Passa o DF direto
+            if not loader.process(df_input=enriched_chunks, partitions=partitions, dimension=dimension, aggregator=aggregator):
+                # Estado não é salvo: a próxima execução refaz as mesmas fontes
+                logger.error("Falha no Enriquecimento/Carga; o estado incremental não foi atualizado.")
+                sys.exit(1)
 
+            # 6. Exportação dos entregáveis (CSV/ZIP), separada do formato intermediário colunar
             logger.info("-" * 40)
-            logger.info("Etapa 6: Carga no Banco de Dados (SQL)...")
-            
-            loader = DatabaseLoader()
-            loader.init_db() # Cria tabelas
-            loader.process(df_input=df_enriched) # Passa o DF direto
-        else:
-            logger.error("Falha no Enriquecimento: DataFrame vazio ou nulo.")
-            sys.exit(1)
+            logger.info("Etapa 6: Exportação do CSV consolidado...")
+            consolidator.export_csv()
+
+        # Só agora o estado reflete o que está no banco
+        state.set_fingerprint('cadop', cadop_fingerprint)
+        state.save()
 
-        # 6. Resumo Final
+        # 7. Resumo Final
         elapsed_time = time.time() - start_time
         logger.info("-" * 40)
         logger.info(f"Processo Finalizado em {elapsed_time:.2f} segundos.")
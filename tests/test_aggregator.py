@@ -0,0 +1,98 @@
+import numpy as np
+import pandas as pd
+
+from etl.aggregator import DataAggregator
+from etl.dataset import PartitionedDataset
+
+
+def _rows():
+    # Mesma operadora com ID formatado de jeitos diferentes e atributos que mudam
+    return pd.DataFrame({
+        'RegistroANS': ['005711', '5711', '5711.0', '5711', '123456'],
+        'RazaoSocial': ['ANTIGA SA', 'ANTIGA SA', 'NOVA SA', 'NOVA SA', 'OUTRA'],
+        'UF': ['SP', 'SP', 'RJ', None, 'MG'],
+        'Modalidade': ['Cooperativa', 'Cooperativa', 'Cooperativa', 'Cooperativa', 'Autogestão'],
+        'Ano': [2024, 2024, 2025, 2025, 2025],
+        'Trimestre': [4, 4, 1, 2, 1],
+        'Valor Despesas': [10.0, 5.0, 30.0, 40.0, 7.0],
+    })
+
+
+def test_one_row_per_registro_with_latest_attributes():
+    stats = DataAggregator().compute(_rows())
+
+    assert not stats['RegistroANS'].duplicated().any()
+    op = stats.set_index('RegistroANS').loc[5711]
+    # Trimestre mais recente (2025T2) não tem UF: vale a do anterior preenchido
+    assert op['RazaoSocial'] == 'NOVA SA'
+    assert op['UF'] == 'RJ'
+    assert op['Qtde_Trimestres'] == 3
+    assert op['Total_Despesas'] == 85.0
+    assert op['Media_Trimestral'] == round(85.0 / 3, 2)
+    assert op['Desvio_Padrao'] == round(float(np.std([15.0, 30.0, 40.0], ddof=1)), 2)
+
+
+def test_merge_order_does_not_change_state():
+    agg = DataAggregator()
+    rows = _rows()
+    parts = [agg._state_from_totals(agg._quarter_totals([df])) for _, df in rows.groupby(['Ano', 'Trimestre'])]
+
+    forward = agg.merge_states(parts).sort_values('RegistroANS').reset_index(drop=True)
+    backward = agg.merge_states(parts[::-1]).sort_values('RegistroANS').reset_index(drop=True)
+    pd.testing.assert_frame_equal(forward, backward)
+
+
+def _quarter(ano, trimestre, seed):
+    rng = np.random.default_rng(seed)
+    n = 400
+    registros = rng.choice([5711, 123456, 300001, 419999], size=n)
+    return pd.DataFrame({
+        'RegistroANS': registros.astype(str),
+        'RazaoSocial': [f'OPERADORA {r}' for r in registros],
+        'UF': 'SP',
+        'Modalidade': 'Cooperativa',
+        'Ano': ano,
+        'Trimestre': trimestre,
+        'Valor Despesas': rng.normal(1000, 300, size=n).round(2),
+    })
+
+
+def _expected(df):
+    """Referência: soma por operadora x trimestre e, sobre os totais, sum/mean/std(ddof=1)/count."""
+    df = df.assign(RegistroANS=df['RegistroANS'].astype('int64'))
+    totais = df.groupby(['RegistroANS', 'Ano', 'Trimestre'])['Valor Despesas'].sum()
+    stats = totais.groupby('RegistroANS').agg(['sum', 'mean', 'std', 'count'])
+    stats['std'] = stats['std'].fillna(0)
+    return stats.round(2)
+
+
+def _assert_matches(stats, df):
+    expected = _expected(df)
+    got = stats.set_index('RegistroANS').sort_index()
+    np.testing.assert_allclose(got['Total_Despesas'], expected['sum'], atol=0.01)
+    np.testing.assert_allclose(got['Media_Trimestral'], expected['mean'], atol=0.01)
+    np.testing.assert_allclose(got['Desvio_Padrao'], expected['std'], atol=0.01)
+    assert got['Qtde_Trimestres'].tolist() == expected['count'].tolist()
+
+
+def test_merge_and_replace_match_pandas(tmp_path):
+    agg = DataAggregator()
+    agg.dataset = PartitionedDataset(str(tmp_path / "enriquecido"))
+    agg.state_dataset = PartitionedDataset(str(tmp_path / "estado"))
+    agg.total_state_file = str(tmp_path / "estado" / ("_total" + agg.state_dataset.extension))
+    agg.total_meta_file = str(tmp_path / "estado" / "_total.json")
+
+    quarters = {(2024, 4): _quarter(2024, 4, 1), (2025, 1): _quarter(2025, 1, 2)}
+    for (ano, trimestre), df in quarters.items():
+        agg.dataset.write_part(df, ano, trimestre, 'part-a')
+    _assert_matches(agg.compute(partitions=None), pd.concat(quarters.values()))
+
+    # Trimestre novo: parcial fundido ao acumulado
+    quarters[(2025, 2)] = _quarter(2025, 2, 3)
+    agg.dataset.write_part(quarters[(2025, 2)], 2025, 2, 'part-a')
+    _assert_matches(agg.compute(partitions=[(2025, 2)]), pd.concat(quarters.values()))
+
+    # Trimestre substituído: acumulado refeito a partir dos parciais
+    quarters[(2025, 1)] = _quarter(2025, 1, 4)
+    agg.dataset.write_part(quarters[(2025, 1)], 2025, 1, 'part-a')
+    _assert_matches(agg.compute(partitions=[(2025, 1)]), pd.concat(quarters.values()))
@@ -0,0 +1,37 @@
+import pandas as pd
+
+from etl import consolidator as consolidator_module
+from etl.consolidator import DataConsolidator
+from etl.file_handler import SourceFile
+
+RAW = (
+    'DATA;REG_ANS;CD_CONTA_CONTABIL;DESCRICAO;VL_SALDO_INICIAL;VL_SALDO_FINAL\n'
+    '"2025-01-01";"5711";"411111111";"EVENTOS";"0";"100,50"\n'
+    '2025-01-01;5711;311111111;RECEITAS;0;999,00\n'
+    # "" escapado e separador dentro de campo entre aspas, antes da conta
+    '"2025 ""T1""";"5711";"411111112";"A;B";"0";"10,00"\n'
+    '"2025 ""T1""";5711;211111111;"C ""D""";0;20,00\n'
+    # Campo com quebra de linha entre aspas (o registro ocupa duas linhas físicas)
+    '2025-01-01;"57\n11";411111113;EVENTOS;0;30,00\n'
+    # Espaços ao redor da conta e aspas no meio de um campo sem aspas
+    '2025-01-01;5711; "411111114" ;EVENTOS;0;40,00\n'
+    '2025-01-01;57"11;411111115;EVENTOS;0;50,00\n'
+    '2025-01-01;5711;  411111116;EVENTOS;0;60,00\n'
+)
+
+
+def _frames(path, monkeypatch, prefilter):
+    monkeypatch.setattr(consolidator_module, 'RAW_LINE_PREFILTER', prefilter)
+    frames = DataConsolidator(workers=1)._iter_source_frames(SourceFile(str(path)), '2025', '1')
+    return pd.concat(list(frames), ignore_index=True)
+
+
+def test_prefilter_matches_unfiltered_read(tmp_path, monkeypatch):
+    path = tmp_path / "1T2025.csv"
+    path.write_text(RAW, encoding='utf-8')
+
+    filtered = _frames(path, monkeypatch, True)
+    unfiltered = _frames(path, monkeypatch, False)
+
+    pd.testing.assert_frame_equal(filtered, unfiltered)
+    assert len(unfiltered) == 5
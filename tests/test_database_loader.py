@@ -0,0 +1,113 @@
+import pandas as pd
+from sqlalchemy import text
+
+from etl import aggregator as aggregator_module
+from etl import database_loader as loader_module
+from etl.aggregator import DataAggregator
+from etl.database_loader import DatabaseLoader
+from etl.dataset import PartitionedDataset
+
+# Equivalente SQLite das tabelas do schema.sql (sem partições, roles nem visões)
+SQLITE_DDL = [
+    """CREATE TABLE operadoras (
+        registro_ans INTEGER PRIMARY KEY, cnpj VARCHAR(20) NOT NULL, razao_social VARCHAR(255) NOT NULL,
+        modalidade VARCHAR(100), data_atualizacao TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        nome_fantasia VARCHAR(255), logradouro VARCHAR(255), numero VARCHAR(50), complemento VARCHAR(255),
+        bairro VARCHAR(100), cidade VARCHAR(100), uf VARCHAR(2), cep VARCHAR(20), ddd VARCHAR(5),
+        telefone VARCHAR(50), fax VARCHAR(50), endereco_eletronico VARCHAR(255), representante VARCHAR(255),
+        cargo_representante VARCHAR(255), regiao_comercializacao VARCHAR(50), data_registro_ans VARCHAR(50)
+    )""",
+    """CREATE TABLE despesas_eventos (
+        id INTEGER PRIMARY KEY, registro_ans INTEGER NOT NULL, ano INTEGER NOT NULL, trimestre INTEGER NOT NULL,
+        conta_contabil VARCHAR(50), descricao VARCHAR(255), valor NUMERIC(18, 2) NOT NULL
+    )""",
+    """CREATE TABLE despesas_agregadas (
+        id INTEGER PRIMARY KEY, registro_ans INTEGER NOT NULL, total_despesas NUMERIC(18, 2),
+        media_trimestral NUMERIC(18, 2), desvio_padrao NUMERIC(18, 2), qtde_trimestres INTEGER,
+        data_processamento TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )""",
+    """CREATE TABLE despesas_cubo (
+        registro_ans INTEGER NOT NULL, ano INTEGER NOT NULL, trimestre INTEGER NOT NULL,
+        conta_prefixo VARCHAR(10) NOT NULL, uf VARCHAR(2), modalidade VARCHAR(100),
+        valor NUMERIC(18, 2) NOT NULL, qtd_lancamentos INTEGER NOT NULL,
+        PRIMARY KEY (ano, trimestre, registro_ans, conta_prefixo)
+    )""",
+    """CREATE TABLE etl_versao (
+        id SMALLINT PRIMARY KEY DEFAULT 1, versao VARCHAR(64) NOT NULL, atualizado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )""",
+]
+
+
+def _enriched(ano, trimestre, valor):
+    return pd.DataFrame({
+        'RegistroANS': ['005711', '5711', '123456'],
+        'CNPJ': ['11.222.333/0001-81', '11.222.333/0001-81', None],
+        'RazaoSocial': ['OPERADORA A', 'OPERADORA A', 'OPERADORA B'],
+        'Modalidade': ['Cooperativa Médica', 'Cooperativa Médica', 'Autogestão'],
+        'UF': ['SP', 'SP', 'MG'],
+        'Ano': ano,
+        'Trimestre': trimestre,
+        'Conta': ['411111111', '411211111', '411111111'],
+        'Descricao': 'EVENTOS',
+        'Valor Despesas': [valor, 10.0, 5.0],
+    })
+
+
+def test_sqlite_fallback_full_and_incremental_load(tmp_path, monkeypatch):
+    monkeypatch.setattr(loader_module, 'DATABASE_URL', f"sqlite:///{tmp_path / 'ans.db'}")
+    monkeypatch.setattr(aggregator_module, 'PROCESSED_DIR', str(tmp_path))
+    loader = DatabaseLoader()
+    with loader.engine.begin() as conn:
+        for ddl in SQLITE_DDL:
+            conn.execute(text(ddl))
+
+    aggregator = DataAggregator()
+    aggregator.dataset = PartitionedDataset(str(tmp_path / "enriquecido"))
+    aggregator.state_dataset = PartitionedDataset(str(tmp_path / "estado"))
+    aggregator.total_state_file = str(tmp_path / "estado" / ("_total" + aggregator.state_dataset.extension))
+    aggregator.total_meta_file = str(tmp_path / "estado" / "_total.json")
+    aggregator.output_file = str(tmp_path / "despesas_agregadas.csv")
+    dimension = pd.DataFrame({'RegistroANS': ['005711', '123456'], 'Cidade': ['São Paulo', 'Belo Horizonte']})
+
+    quarters = {(2025, 1): _enriched(2025, 1, 100.0), (2025, 2): _enriched(2025, 2, 200.0)}
+    for (ano, trimestre), df in quarters.items():
+        aggregator.dataset.write_part(df, ano, trimestre, 'part-a')
+    assert loader.process(df_input=list(quarters.values()), dimension=dimension, aggregator=aggregator)
+
+    # Carga completa repetida: esvazia e recarrega (DELETE no lugar do TRUNCATE)
+    assert loader.process(df_input=list(quarters.values()), dimension=dimension, aggregator=aggregator)
+
+    # Incremental: substitui só o 2º trimestre
+    quarters[(2025, 2)] = _enriched(2025, 2, 300.0)
+    aggregator.dataset.write_part(quarters[(2025, 2)], 2025, 2, 'part-a')
+    assert loader.process(df_input=[quarters[(2025, 2)]], partitions=[(2025, 2)], dimension=dimension, aggregator=aggregator)
+
+    with loader.engine.connect() as conn:
+        assert conn.execute(text("SELECT COUNT(*), SUM(valor) FROM despesas_eventos")).one() == (6, 430.0)
+        assert conn.execute(text("SELECT SUM(valor) FROM despesas_cubo")).scalar() == 430.0
+        agregadas = dict(conn.execute(text("SELECT registro_ans, total_despesas FROM despesas_agregadas")).all())
+        assert agregadas == {5711: 420.0, 123456: 10.0}
+        assert conn.execute(text("SELECT cidade FROM operadoras WHERE registro_ans = 5711")).scalar() == 'São Paulo'
+        assert conn.execute(text("SELECT COUNT(*) FROM etl_versao")).scalar() == 1
+
+
+def test_cube_backfill_skips_replaced_quarters(tmp_path, monkeypatch):
+    monkeypatch.setattr(loader_module, 'DATABASE_URL', f"sqlite:///{tmp_path / 'ans.db'}")
+    loader = DatabaseLoader()
+    with loader.engine.begin() as conn:
+        for ddl in SQLITE_DDL:
+            conn.execute(text(ddl))
+        conn.execute(text("INSERT INTO operadoras (registro_ans, cnpj, razao_social, uf) VALUES (5711, '-', 'A', 'SP')"))
+        conn.execute(text(
+            "INSERT INTO despesas_eventos (registro_ans, ano, trimestre, conta_contabil, valor) VALUES "
+            "(5711, 2025, 1, '411111111', 100), (5711, 2025, 1, '411211111', 10), (5711, 2025, 2, '411111111', 200)"
+        ))
+
+        # Como no PostgreSQL: o trimestre substituído ainda está no fato durante o backfill
+        loader._replaced = [(2025, 2)]
+        loader._backfill_cubo(conn)
+
+        cubo = conn.execute(text(
+            "SELECT ano, trimestre, conta_prefixo, uf, valor, qtd_lancamentos FROM despesas_cubo ORDER BY conta_prefixo"
+        )).all()
+    assert cubo == [(2025, 1, '411', 'SP', 110, 2)]
@@ -0,0 +1,152 @@
+import threading
+import time
+import zipfile
+
+import pandas as pd
+import pytest
+
+from etl.consolidator import DataConsolidator
+from etl.dataset import PartitionedDataset
+from etl.pipeline import OverlappedPipeline
+from etl.state import EtlState
+
+
+class FailingScraper:
+    """Scraper falso: todo download falha (rede indisponível)."""
+
+    def download_with_stats(self, url, filename):
+        return {'filename': filename, 'path': None, 'bytes': 0, 'seconds': 0.0, 'status': 'failed'}
+
+
+def _consolidated(tmp_path, sources):
+    """Dataset e estado como deixados por uma execução anterior bem-sucedida."""
+    dataset = PartitionedDataset(str(tmp_path / "dataset"))
+    state = EtlState(path=str(tmp_path / "etl_state.json"))
+    df = pd.DataFrame({'RegistroANS': ['5711'], 'Valor Despesas': [10.0]})
+    for key, (ano, trimestre) in sources.items():
+        part_name = DataConsolidator._part_name_for_key(key)
+        dataset.write_part(df, ano, trimestre, part_name)
+        state.record_source(key, "crc=1:size=1", [(ano, trimestre)])
+    consolidator = DataConsolidator(workers=1)
+    consolidator.dataset = dataset
+    return consolidator, dataset, state
+
+
+def test_failed_download_keeps_quarter(tmp_path):
+    kept_key = "1T2025.zip!1T2025.csv"
+    old_key = "1T2024.zip!1T2024.csv"
+    consolidator, dataset, state = _consolidated(tmp_path, {kept_key: (2025, 1), old_key: (2024, 1)})
+
+    files = [{'url': 'http://ans/1T2025.zip', 'filename': '1T2025.zip'}]
+    OverlappedPipeline(FailingScraper(), consolidator, download_workers=1).run(files, state=state)
+
+    # O trimestre da janela cujo download falhou continua intacto
+    assert kept_key in state.source_keys()
+    assert dataset.has_part(2025, 1, DataConsolidator._part_name_for_key(kept_key))
+    assert (2025, 1) not in consolidator.changed_partitions
+    # O trimestre fora da janela sai do dataset e do estado
+    assert old_key not in state.source_keys()
+    assert not dataset.has_part(2024, 1, DataConsolidator._part_name_for_key(old_key))
+    assert consolidator.changed_partitions == {(2024, 1)}
+
+
+class SlowScraper:
+    """Scraper falso: conta os downloads iniciados (cada um "baixa" em 10 ms)."""
+
+    def __init__(self):
+        self.started = 0
+        self._lock = threading.Lock()
+
+    def download_with_stats(self, url, filename):
+        with self._lock:
+            self.started += 1
+        time.sleep(0.01)
+        return {'filename': filename, 'path': filename, 'bytes': 0, 'seconds': 0.01, 'status': 'downloaded'}
+
+
+class BlockedConsolidator:
+    """Consolidador falso que trava no primeiro ZIP até ser liberado."""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.added = []
+
+    def begin(self, state=None, full_refresh=False):
+        pass
+
+    def add_zip(self, path):
+        self.release.wait()
+        self.added.append(path)
+
+    def finish(self, requested=None):
+        pass
+
+
+def test_stalled_consolidation_stops_new_downloads():
+    scraper, consolidator = SlowScraper(), BlockedConsolidator()
+    files = [{'url': f'http://ans/{i}T2025.zip', 'filename': f'{i}T2025.zip'} for i in range(10)]
+    pipeline = OverlappedPipeline(scraper, consolidator, download_workers=4, queue_size=1)
+
+    runner = threading.Thread(target=pipeline.run, args=(files,))
+    runner.start()
+    time.sleep(0.3)
+    # Um ZIP consolidando (travado) + um na fila + um download aguardando vaga
+    assert scraper.started == 3
+
+    consolidator.release.set()
+    runner.join(timeout=5)
+    assert consolidator.added == [item['filename'] for item in files]
+
+
+def _write_zip(path, quarter):
+    with zipfile.ZipFile(path, 'w') as zf:
+        zf.writestr(f'{quarter}.csv', (
+            'DATA;REG_ANS;CD_CONTA_CONTABIL;DESCRICAO;VL_SALDO_INICIAL;VL_SALDO_FINAL\n'
+            f'2025-01-01;5711;411111111;EVENTOS;0;100,50\n'
+        ))
+
+
+def test_sequential_mode_consolidates_only_the_window(tmp_path):
+    raw = tmp_path / "raw"
+    raw.mkdir()
+    _write_zip(raw / "1T2025.zip", "1T2025")
+    _write_zip(raw / "4T2023.zip", "4T2023")  # sobra de uma janela antiga, ainda no disco
+
+    consolidator = DataConsolidator(workers=1)
+    consolidator.dataset = PartitionedDataset(str(tmp_path / "dataset"))
+    consolidator.file_handler.download_dir = str(raw)
+    downloads = [{'filename': '1T2025.zip', 'path': str(raw / "1T2025.zip")}]
+    consolidator.process(state=EtlState(path=str(tmp_path / "etl_state.json")), downloads=downloads)
+
+    assert consolidator.dataset.partitions() == [(2025, 1)]
+
+
+class OkScraper:
+    """Scraper falso: o ZIP da janela já está no disco."""
+
+    def __init__(self, raw):
+        self.raw = raw
+
+    def download_with_stats(self, url, filename):
+        return {'filename': filename, 'path': str(self.raw / filename), 'bytes': 0, 'seconds': 0.0, 'status': 'cached'}
+
+
+def test_source_error_fails_the_run(tmp_path, monkeypatch):
+    raw = tmp_path / "raw"
+    raw.mkdir()
+    _write_zip(raw / "1T2025.zip", "1T2025")
+    key = "1T2025.zip!1T2025.csv"
+    consolidator, dataset, state = _consolidated(tmp_path, {key: (2025, 1)})
+    consolidator.file_handler.download_dir = str(raw)
+
+    def broken(*args):
+        raise ValueError("CSV ilegível")
+    monkeypatch.setattr(consolidator, '_consolidate_source', broken)
+
+    files = [{'url': 'http://ans/1T2025.zip', 'filename': '1T2025.zip'}]
+    # A execução falha (main.py sai com 1 sem salvar o estado) em vez de carregar o
+    # trimestre sem as linhas da fonte
+    with pytest.raises(ValueError):
+        OverlappedPipeline(OkScraper(raw), consolidator, download_workers=1).run(files, state=state)
+    with pytest.raises(ValueError):
+        consolidator.process(state=state, downloads=[{'filename': '1T2025.zip', 'path': str(raw / "1T2025.zip")}])
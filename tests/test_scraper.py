@@ -0,0 +1,140 @@
+import io
+import threading
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from etl import scraper as scraper_module
+from etl.scraper import ANSScraper
+from utils.download_manifest import DownloadManifest
+
+
+def _zip_bytes(text):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('1T2025.csv', text)
+    return buf.getvalue()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Servidor da ANS simulado: ETag, 304 condicional e Range com If-Range."""
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self._respond(head=True)
+
+    def do_GET(self):
+        self._respond(head=False)
+
+    def _respond(self, head):
+        site = self.server.site
+        site['requests'].append(dict(self.headers))
+        body, etag = site['body'], site['etag']
+
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        start = 0
+        range_header = self.headers.get('Range')
+        if range_header and self.headers.get('If-Range') == etag:
+            start = int(range_header.removeprefix('bytes=').rstrip('-'))
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{len(body) - 1}/{len(body)}")
+        else:
+            self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body) - start))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body[start:])
+
+
+@pytest.fixture
+def site():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    server.site = {'body': _zip_bytes('v1;' * 5000), 'etag': '"v1"', 'requests': []}
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.site['url'] = f"http://127.0.0.1:{server.server_port}/1T2025.zip"
+    yield server.site
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def scraper(tmp_path, monkeypatch):
+    monkeypatch.setattr(scraper_module, 'STREAM_FROM_ZIP', True)
+    s = ANSScraper()
+    s.file_handler.download_dir = str(tmp_path)
+    s.manifest = DownloadManifest(str(tmp_path / 'manifest.json'))
+    return s
+
+
+def _local(scraper):
+    with open(f"{scraper.file_handler.download_dir}/1T2025.zip", 'rb') as f:
+        return f.read()
+
+
+def test_truncated_download_resumes(site, scraper, tmp_path):
+    half = len(site['body']) // 2
+    (tmp_path / '1T2025.zip.part').write_bytes(site['body'][:half])
+    scraper.manifest.update('1T2025.zip', url=site['url'], complete=False, etag=site['etag'])
+
+    stats = scraper.download_with_stats(site['url'], '1T2025.zip')
+
+    assert stats['status'] == 'resumed'
+    assert stats['bytes'] == len(site['body']) - half
+    assert site['requests'][-1]['If-Range'] == site['etag']
+    assert _local(scraper) == site['body']
+    assert scraper.manifest.is_verified('1T2025.zip', str(tmp_path / '1T2025.zip'))
+
+
+def test_weak_etag_downloads_whole_file(site, scraper, tmp_path):
+    site['etag'] = 'W/"v1"'
+    (tmp_path / '1T2025.zip.part').write_bytes(b'lixo de outra versao')
+    scraper.manifest.update('1T2025.zip', url=site['url'], complete=False, etag=site['etag'])
+
+    stats = scraper.download_with_stats(site['url'], '1T2025.zip')
+
+    assert stats['status'] == 'downloaded'
+    assert 'Range' not in site['requests'][-1]
+    assert _local(scraper) == site['body']
+
+
+def test_unchanged_file_is_reused_with_304(site, scraper):
+    scraper.download_with_stats(site['url'], '1T2025.zip')
+
+    stats = scraper.download_with_stats(site['url'], '1T2025.zip')
+
+    assert stats['status'] == 'not_modified'
+    assert stats['bytes'] == 0
+    assert site['requests'][-1]['If-None-Match'] == site['etag']
+
+
+def test_republished_file_is_downloaded_again(site, scraper):
+    scraper.download_with_stats(site['url'], '1T2025.zip')
+    site['body'], site['etag'] = _zip_bytes('v2;' * 5000), '"v2"'
+
+    stats = scraper.download_with_stats(site['url'], '1T2025.zip')
+
+    assert stats['status'] == 'downloaded'
+    assert _local(scraper) == site['body']
+    assert scraper.manifest.get('1T2025.zip')['etag'] == '"v2"'
+
+
+def test_corrupted_local_copy_is_downloaded_again(site, scraper, tmp_path):
+    scraper.download_with_stats(site['url'], '1T2025.zip')
+    local = tmp_path / '1T2025.zip'
+    local.write_bytes(bytes(len(site['body'])))  # mesmo tamanho, conteúdo diferente
+
+    stats = scraper.download_with_stats(site['url'], '1T2025.zip')
+
+    assert stats['status'] == 'downloaded'
+    assert 'If-None-Match' not in site['requests'][-1]
+    assert local.read_bytes() == site['body']
@@ -0,0 +1,41 @@
+import numpy as np
+
+from utils.validators import CNPJValidator
+
+CASES = [
+    '11.222.333/0001-81',       # válido, com pontuação
+    '11222333000181',           # válido, só dígitos
+    ' 11.222.333/0001-81 ',     # espaços nas bordas
+    'CNPJ: 11222333000181',     # letras e pontuação misturadas
+    '11222333000181',           # repetido (valores distintos são validados uma vez)
+    '11222333000182',           # 2º dígito verificador errado
+    '11222333000191',           # 1º dígito verificador errado
+    '00000000000000',           # sequências repetidas passam no Módulo 11
+    '11111111111111',
+    '1122233300018',            # curto
+    '112223330001811',          # longo
+    '11.222.333/0001-8',
+    '',
+    '...///--',
+    None,
+    np.nan,
+    11222333000181,             # numérico
+    '١١٢٢٢٣٣٣٠٠٠١٨١',           # dígitos não-ASCII (\d do re aceita)
+]
+
+
+def test_validate_many_matches_scalar():
+    expected = [CNPJValidator.validate(value) for value in CASES]
+    assert CNPJValidator.validate_many(CASES).tolist() == expected
+    assert any(expected) and not all(expected)
+
+
+def test_format_many_matches_scalar():
+    # Nulos: o escalar formata str(None)/str(nan), que não tem dígitos, e devolve ''
+    expected = [CNPJValidator.format(value) for value in CASES]
+    assert CNPJValidator.format_many(CASES).tolist() == expected
+
+
+def test_empty_input():
+    assert CNPJValidator.validate_many([]).tolist() == []
+    assert CNPJValidator.format_many([]).tolist() == []
@@ -0,0 +1,99 @@
+import os
+import json
+import hashlib
+import threading
+import logging
+from datetime import datetime
+
+
+class DownloadManifest:
+    """
+    Registro persistente (JSON) dos arquivos baixados da ANS.
+    Guarda tamanho, validadores HTTP (ETag/Last-Modified) e SHA-256 de cada arquivo,
+    permitindo retomar downloads interrompidos e revalidar com GET condicional.
+    Thread-safe: pode ser compartilhado entre as threads de download.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.logger = logging.getLogger("ANS_ETL.Manifest")
+        self._lock = threading.Lock()
+        self._entries = self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            # Manifesto corrompido não pode travar o pipeline: recomeça do zero
+            self.logger.warning(f"Manifesto ilegível ({e}). Um novo será criado.")
+            return {}
+
+    def _save(self):
+        # Escrita atômica: um processo morto no meio não deixa JSON pela metade
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._entries, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def get(self, filename):
+        """Retorna uma cópia da entrada do arquivo, ou None."""
+        with self._lock:
+            entry = self._entries.get(filename)
+            return dict(entry) if entry else None
+
+    def update(self, filename, **fields):
+        """Mescla os campos informados na entrada do arquivo e persiste o manifesto."""
+        with self._lock:
+            entry = self._entries.setdefault(filename, {})
+            entry.update(fields)
+            entry['updated_at'] = datetime.now().isoformat(timespec='seconds')
+            self._save()
+
+    def is_complete(self, filename, local_path):
+        """
+        Verifica se o arquivo local corresponde a um download completo registrado.
+        Usa só o tamanho (checagem barata); o conteúdo é conferido por is_verified.
+        """
+        entry = self.get(filename)
+        return bool(
+            entry and entry.get('complete')
+            and os.path.exists(local_path)
+            and os.path.getsize(local_path) == entry.get('size')
+        )
+
+    def is_verified(self, filename, local_path):
+        """
+        Download completo cujo conteúdo confere: recalcula o SHA-256 do arquivo local e
+        o compara com o registrado. Entrada sem SHA-256 não é considerada verificada.
+        """
+        if not self.is_complete(filename, local_path):
+            return False
+        expected = self.get(filename).get('sha256')
+        return bool(expected) and self.sha256_of(local_path).hexdigest() == expected
+
+    @staticmethod
+    def conditional_headers(entry):
+        """Monta os cabeçalhos de GET condicional a partir dos validadores salvos."""
+        headers = {}
+        if not entry:
+            return headers
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    @staticmethod
+    def sha256_of(path, chunk_size=1024 * 1024):
+        """
+        Calcula o SHA-256 de um arquivo em blocos.
+        Retorna o objeto hashlib (não o hexdigest) para permitir continuar o hash
+        ao anexar os bytes de um download retomado.
+        """
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(chunk_size), b''):
+                digest.update(block)
+        return digest
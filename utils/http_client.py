@@ -3,7 +3,7 @@ from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 import urllib3
 import logging
-from config import HTTP_TIMEOUT, MAX_RETRIES, BACKOFF_FACTOR, HEADERS
+from config import HTTP_TIMEOUT, MAX_RETRIES, BACKOFF_FACTOR, HEADERS, HTTP_POOL_SIZE
 
 # Desabilita o aviso de SSL inseguro (Necessário para ANS)
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -12,8 +12,9 @@ class HttpClient:
     """
     Cliente HTTP Wrapper resiliente com suporte a Retries automáticos e Timeout.
     Padrão Singleton implícito pelo uso de requests.Session.
+    O pool de conexões é dimensionado para ser compartilhado entre threads de download.
     """
-    def __init__(self):
+    def __init__(self, pool_size=HTTP_POOL_SIZE):
         self.session = requests.Session()
         self.session.headers.update(HEADERS)
         
@@ -25,7 +26,12 @@ class HttpClient:
             allowed_methods=["HEAD", "GET", "OPTIONS"]
         )
         
-        adapter = HTTPAdapter(max_retries=retry_strategy)
+        # pool_maxsize >= nº de workers evita descarte de conexões keep-alive sob concorrência
+        adapter = HTTPAdapter(
+            max_retries=retry_strategy,
+            pool_connections=pool_size,
+            pool_maxsize=pool_size
+        )
         
         # Monta o adaptador para http e https
         self.session.mount("https://", adapter)
@@ -33,9 +39,11 @@ class HttpClient:
         
         self.logger = logging.getLogger("ANS_ETL.HTTP")
 
-    def get(self, url, stream=False):
+    def get(self, url, stream=False, headers=None):
         """
         Executa uma requisição GET com tratamento de erros centralizado.
+        'headers' permite requisições condicionais (If-None-Match) e parciais (Range);
+        respostas 304 e 206 são retornadas normalmente ao chamador.
         """
         try:
             # verify=False é necessário para o governo.br
@@ -43,7 +51,8 @@ class HttpClient:
                 url, 
                 timeout=HTTP_TIMEOUT, 
                 verify=False, 
-                stream=stream
+                stream=stream,
+                headers=headers
             )
             response.raise_for_status()
             return response
@@ -61,5 +70,15 @@ class HttpClient:
             self.logger.error(f"Erro desconhecido em GET {url}: {e}")
             raise
 
+    def head(self, url):
+        """Executa um HEAD (metadados sem corpo), seguindo redirecionamentos."""
+        try:
+            response = self.session.head(url, timeout=HTTP_TIMEOUT, verify=False, allow_redirects=True)
+            response.raise_for_status()
+            return response
+        except Exception as e:
+            self.logger.error(f"Erro em HEAD {url}: {e}")
+            raise
+
     def close(self):
         self.session.close()
\ No newline at end of file
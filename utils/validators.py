@@ -1,6 +1,12 @@
 import re
+import numpy as np
+import pandas as pd
 
 class CNPJValidator:
+    # Pesos do Módulo 11 para o 1º e o 2º dígito verificador
+    PESOS_1 = np.array([5, 4, 3, 2, 9, 8, 7, 6, 5, 4, 3, 2])
+    PESOS_2 = np.array([6, 5, 4, 3, 2, 9, 8, 7, 6, 5, 4, 3, 2])
+
     @staticmethod
     def validate(cnpj: str) -> bool:
         """
@@ -46,4 +52,67 @@ class CNPJValidator:
         cnpj = re.sub(r'\D', '', str(cnpj))
         if len(cnpj) != 14:
             return cnpj # Retorna sujo se não tiver tamanho
-        return f"{cnpj[:2]}.{cnpj[2:5]}.{cnpj[5:8]}/{cnpj[8:12]}-{cnpj[12:]}"
\ No newline at end of file
+        return f"{cnpj[:2]}.{cnpj[2:5]}.{cnpj[5:8]}/{cnpj[8:12]}-{cnpj[12:]}"
+
+    # --- API em lote (vetorizada) ---
+    @staticmethod
+    def _factorize(values):
+        """
+        Reduz a entrada aos valores distintos (poucos milhares de CNPJs para milhões de linhas).
+        Retorna (códigos por linha, dígitos limpos de cada valor distinto); nulos têm código -1.
+        """
+        codes, uniques = pd.factorize(pd.Series(values, dtype=object))
+        # Limpeza com `re` (mesma semântica de \D da versão escalar), só nos valores distintos
+        digits = pd.Series([re.sub(r'\D', '', str(u)) for u in uniques], dtype=object)
+        return codes, digits
+
+    @classmethod
+    def _validate_digits(cls, digits):
+        """Valida um array de strings só com dígitos, todas de uma vez (matriz N x 14)."""
+        result = np.zeros(len(digits), dtype=bool)
+        candidates = np.flatnonzero((digits.str.len() == 14).to_numpy() & digits.map(str.isascii).to_numpy())
+        if len(candidates):
+            raw = ''.join(digits.iloc[candidates]).encode('ascii')
+            matrix = (np.frombuffer(raw, dtype=np.uint8).reshape(-1, 14) - ord('0')).astype(np.int64)
+
+            resto_1 = (matrix[:, :12] @ cls.PESOS_1) % 11
+            digito_1 = np.where(resto_1 < 2, 0, 11 - resto_1)
+            resto_2 = (matrix[:, :13] @ cls.PESOS_2) % 11
+            digito_2 = np.where(resto_2 < 2, 0, 11 - resto_2)
+
+            # Sequências repetidas (00000000000000, 111...) passam no Módulo 11, mas são inválidas
+            repetido = (matrix == matrix[:, :1]).all(axis=1)
+            result[candidates] = (matrix[:, 12] == digito_1) & (matrix[:, 13] == digito_2) & ~repetido
+
+        # Dígitos não-ASCII (ex: numerais Unicode) seguem o caminho escalar
+        for i in np.flatnonzero((digits.str.len() == 14).to_numpy() & ~digits.map(str.isascii).to_numpy()):
+            result[i] = CNPJValidator.validate(digits.iloc[i])
+        return result
+
+    @classmethod
+    def validate_many(cls, values) -> np.ndarray:
+        """
+        Versão em lote de validate: valida cada CNPJ distinto uma única vez, com aritmética
+        NumPy sobre a matriz de dígitos, e replica o resultado para todas as linhas.
+        Recebe: Series/lista/array de CNPJs (com ou sem pontuação, nulos aceitos).
+        Retorna: array booleano alinhado à entrada.
+        """
+        codes, digits = cls._factorize(values)
+        valid = cls._validate_digits(digits)
+        return np.where(codes >= 0, valid[np.maximum(codes, 0)] if len(valid) else False, False)
+
+    @classmethod
+    def format_many(cls, values) -> np.ndarray:
+        """
+        Versão em lote de format (XX.XXX.XXX/XXXX-XX), calculada por valor distinto.
+        Valores sem 14 dígitos voltam só com os dígitos; nulos viram ''.
+        Retorna: array de strings alinhado à entrada.
+        """
+        codes, digits = cls._factorize(values)
+        formatted = digits.where(
+            digits.str.len() != 14,
+            digits.str[:2] + '.' + digits.str[2:5] + '.' + digits.str[5:8] + '/' + digits.str[8:12] + '-' + digits.str[12:]
+        ).to_numpy(dtype=object)
+        if not len(formatted):
+            return np.full(len(codes), '', dtype=object)
+        return np.where(codes >= 0, formatted[np.maximum(codes, 0)], '')